@@ -0,0 +1,107 @@
+"""
+Measure the memory of stored conversation turns and how long building a
+request body from them takes, for Message objects and for plain dicts
+
+    python benchmarks/conversation_memory.py --conversations 10000
+"""
+import argparse
+import gc
+import json
+import random
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from conversation_store import Conversation, Message  # noqa: E402
+from gptbot import encode_payload  # noqa: E402
+
+WORDS = "the a of to and in is it you that was for on are with as I his they be".split()
+ROLES = ("user", "assistant")
+
+
+def make_content(rng: random.Random, chars: int) -> str:
+    words = []
+    length = 0
+    while length < chars:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)
+
+
+def build(kind: str, options: dict) -> list:
+    """
+    Build the conversations, a turn is one message with its token count
+    """
+    rng = random.Random(options["seed"])
+    conversations = []
+    for _ in range(options["conversations"]):
+        turns = [
+            (
+                "system" if i == 0 else ROLES[i % 2],
+                make_content(rng, options["content_chars"]),
+                # counts above 256 aren't cached small ints
+                rng.randrange(257, 1000),
+            )
+            for i in range(options["turns"])
+        ]
+        if kind == "message":
+            conversations.append(Conversation([Message(*turn) for turn in turns]))
+        else:
+            # messages and token counts as they were kept before Message
+            conversations.append(
+                (
+                    [{"role": role, "content": content} for role, content, _ in turns],
+                    [num_tokens for _, _, num_tokens in turns],
+                )
+            )
+    return conversations
+
+
+def measure(kind: str, options: dict) -> dict:
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    conversations = build(kind, options)
+    gc.collect()
+    stored = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    size = 0
+    for conversation in conversations:
+        if kind == "message":
+            body = encode_payload(
+                {"model": "gpt-3.5-turbo", "messages": conversation.messages}
+            )
+        else:
+            body = json.dumps(
+                {"model": "gpt-3.5-turbo", "messages": conversation[0]}
+            ).encode()
+        size += len(body)
+    elapsed = time.perf_counter() - start
+
+    turns = options["conversations"] * options["turns"]
+    return {
+        "bytes_per_turn": stored / turns,
+        "body_build_seconds": elapsed,
+        "body_build_us": elapsed / len(conversations) * 1e6,
+        "body_bytes": size / len(conversations),
+    }
+
+
+def main(options: dict) -> None:
+    results = {kind: measure(kind, options) for kind in ("dict", "message")}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--conversations", type=int, default=10000)
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--content-chars", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    main(vars(parser.parse_args()))
@@ -0,0 +1,446 @@
+"""
+Local stand-ins for Mattermost, OpenAI and stable-diffusion-webui
+"""
+import asyncio
+import base64
+import io
+import itertools
+import json
+import random
+import time
+from typing import Optional
+from aiohttp import web
+from PIL import Image
+
+
+class FakeMattermost:
+    """
+    Enough of the Mattermost v4 REST API and websocket for the bot,
+    pushes posted events and records when the bot replies to them
+    """
+
+    def __init__(self, bot_username: str = "bot", echo: bool = True) -> None:
+        self.bot_username = bot_username
+        # push the bot's own posts back like a real server does
+        self.echo = echo
+        self.bot_id = "bot" + "0" * 23
+        self.token = "benchmarktoken"
+        self.ids = itertools.count()
+        self.seq = itertools.count(1)
+        self.websockets: set[web.WebSocketResponse] = set()
+        self.connected = asyncio.Event()
+
+        # root id -> (first reply time, last write time)
+        self.replies: dict[str, list[float]] = {}
+        # post id -> root id of posts the bot created
+        self.bot_posts: dict[str, str] = {}
+        # root id -> posts the bot created for it
+        self.reply_posts: dict[str, int] = {}
+        # channel id -> post id -> post, for catching up over REST
+        self.channel_posts: dict[str, dict[str, dict]] = {}
+        self.busy_replies = 0
+        self.requests = 0
+        self.drops = 0
+
+        self.app = web.Application(client_max_size=64 * 1024 * 1024)
+        self.app.add_routes(
+            [
+                web.post("/api/v4/users/login", self.login),
+                web.get("/api/v4/users/{user_id}", self.get_user),
+                web.get("/api/v4/users/{user_id}/teams", self.get_teams),
+                web.get(
+                    "/api/v4/users/{user_id}/teams/{team_id}/channels",
+                    self.get_channels,
+                ),
+                web.get("/api/v4/channels/{channel_id}/posts", self.get_posts),
+                web.get("/api/v4/posts/{post_id}/thread", self.get_thread),
+                web.post("/api/v4/users/{user_id}/typing", self.typing),
+                web.post("/api/v4/posts", self.create_post),
+                web.put("/api/v4/posts/{post_id}/patch", self.patch_post),
+                web.post("/api/v4/files", self.upload_file),
+                web.get("/api/v4/websocket", self.websocket),
+            ]
+        )
+
+    def new_id(self) -> str:
+        return f"{next(self.ids):026d}"
+
+    def user(self) -> dict:
+        return {"id": self.bot_id, "username": self.bot_username}
+
+    async def login(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        return web.json_response(self.user(), headers={"Token": self.token})
+
+    async def get_user(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        return web.json_response(self.user())
+
+    async def get_teams(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        return web.json_response([{"id": "team", "name": "team"}])
+
+    async def get_channels(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        return web.json_response(
+            [
+                {
+                    "id": channel_id,
+                    "team_id": "team",
+                    "last_post_at": max(p["create_at"] for p in posts.values()),
+                }
+                for channel_id, posts in self.channel_posts.items()
+            ]
+        )
+
+    async def get_posts(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        since = int(request.query.get("since", 0))
+        posts = {
+            post_id: post
+            for post_id, post in self.channel_posts.get(
+                request.match_info["channel_id"], {}
+            ).items()
+            if post.get("update_at", 0) >= since
+        }
+        order = sorted(posts, key=lambda p: posts[p]["create_at"], reverse=True)
+        return web.json_response({"order": order, "posts": posts})
+
+    async def get_thread(self, request: web.Request) -> web.Response:
+        """
+        Posts of a thread older than fromCreateAt, newest first, perPage at
+        a time, every page holds the root
+        """
+        self.requests += 1
+        root_id = request.match_info["post_id"]
+        per_page = int(request.query.get("perPage", 0))
+        before = int(request.query.get("fromCreateAt", 0))
+        thread = [
+            post
+            for posts in self.channel_posts.values()
+            for post in posts.values()
+            if post["id"] == root_id or post["root_id"] == root_id
+        ]
+        root = [post for post in thread if post["id"] == root_id]
+        replies = sorted(
+            (
+                post
+                for post in thread
+                if post["root_id"] == root_id
+                and (not before or post["create_at"] < before)
+            ),
+            key=lambda post: post["create_at"],
+            reverse=True,
+        )
+        has_next = bool(per_page) and len(replies) > per_page
+        if per_page:
+            replies = replies[:per_page]
+        posts = {post["id"]: post for post in root + replies}
+        return web.json_response(
+            {"order": list(posts), "posts": posts, "has_next": has_next}
+        )
+
+    async def typing(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        return web.json_response({"status": "OK"})
+
+    def record_write(
+        self, root_id: str, message: str = "", created: bool = False
+    ) -> None:
+        now = time.monotonic()
+        if message.startswith("Bot is busy") or message.startswith(
+            "Image generation is busy"
+        ):
+            self.busy_replies += 1
+            return
+        if created:
+            self.reply_posts[root_id] = self.reply_posts.get(root_id, 0) + 1
+        times = self.replies.setdefault(root_id, [now, now])
+        times[1] = now
+
+    async def create_post(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        options = await request.json()
+        post = self.make_post(
+            options.get("channel_id", ""),
+            self.bot_id,
+            options.get("message", ""),
+            options.get("root_id", ""),
+        )
+        post["file_ids"] = options.get("file_ids", [])
+        self.bot_posts[post["id"]] = options.get("root_id", "")
+        self.record_write(options.get("root_id", ""), post["message"], created=True)
+        if self.echo:
+            await self.push_post(post, self.bot_username)
+        else:
+            self.store(post)
+        return web.json_response(post, status=201)
+
+    async def patch_post(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        post_id = request.match_info["post_id"]
+        options = await request.json()
+        self.record_write(self.bot_posts.get(post_id, ""), options.get("message", ""))
+        return web.json_response({"id": post_id, **options})
+
+    async def upload_file(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        # drain the multipart body like a real server would
+        await request.read()
+        return web.json_response(
+            {"file_infos": [{"id": self.new_id()}], "client_ids": []}, status=201
+        )
+
+    async def websocket(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse(heartbeat=None)
+        await ws.prepare(request)
+        async for msg in ws:
+            data = json.loads(msg.data)
+            if data.get("action") == "authentication_challenge":
+                await ws.send_str(json.dumps({"status": "OK", "seq_reply": 1}))
+                await ws.send_str(
+                    json.dumps(
+                        {
+                            "event": "hello",
+                            "data": {"server_version": "benchmark"},
+                            "broadcast": {"user_id": self.bot_id},
+                            "seq": 0,
+                        }
+                    )
+                )
+                self.websockets.add(ws)
+                self.connected.set()
+        self.websockets.discard(ws)
+        return ws
+
+    def make_post(
+        self, channel_id: str, user_id: str, message: str, root_id: str = ""
+    ) -> dict:
+        now = int(time.time() * 1000)
+        return {
+            "id": self.new_id(),
+            "create_at": now,
+            "update_at": now,
+            "user_id": user_id,
+            "channel_id": channel_id,
+            "root_id": root_id,
+            "message": message,
+            "type": "",
+            "props": {},
+        }
+
+    def store(self, post: dict) -> None:
+        # synthetic traffic leaves the time to the server
+        if not post.get("create_at"):
+            post["create_at"] = post["update_at"] = int(time.time() * 1000)
+        self.channel_posts.setdefault(post["channel_id"], {})[post["id"]] = post
+
+    async def push(self, frame: str) -> None:
+        """
+        Send a raw websocket frame to every connected client, posts are
+        stored even when no client is connected
+        """
+        event = json.loads(frame)
+        if event.get("event") == "posted":
+            self.store(json.loads(event["data"]["post"]))
+        for ws in list(self.websockets):
+            await ws.send_str(frame)
+
+    async def drop(self) -> None:
+        """
+        Close every websocket like a server restart or network blip
+        """
+        self.drops += 1
+        self.connected.clear()
+        for ws in list(self.websockets):
+            self.websockets.discard(ws)
+            await ws.close()
+
+    async def push_post(self, post: dict, sender_name: str) -> None:
+        await self.push(
+            json.dumps(
+                {
+                    "event": "posted",
+                    "data": {
+                        "channel_display_name": post["channel_id"],
+                        "channel_name": post["channel_id"],
+                        "channel_type": "O",
+                        "post": json.dumps(post),
+                        "sender_name": sender_name,
+                        "team_id": "team",
+                    },
+                    "broadcast": {"channel_id": post["channel_id"]},
+                    "seq": next(self.seq),
+                }
+            )
+        )
+
+
+def make_image(width: int = 512, height: int = 512) -> str:
+    """
+    Encode a noisy png as base64 so that conversion does real work
+    """
+    img = Image.frombytes(
+        "RGB", (width, height), random.Random(0).randbytes(width * height * 3)
+    )
+    output = io.BytesIO()
+    img.save(output, format="png")
+    return base64.b64encode(output.getvalue()).decode("ascii")
+
+
+class FakeOpenAI:
+    """
+    OpenAI-compatible chat completions (JSON and SSE) and image generation,
+    plus the stable-diffusion-webui txt2img endpoint
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.5,
+        token_delay: float = 0.02,
+        completion_tokens: int = 50,
+        error_rate: float = 0.0,
+        image_latency: float = 2.0,
+        image_size: int = 512,
+    ) -> None:
+        # seconds until the response (or the first token) is sent
+        self.latency = latency
+        # seconds between streamed tokens
+        self.token_delay = token_delay
+        self.completion_tokens = completion_tokens
+        # fraction of chat requests answered with 429
+        self.error_rate = error_rate
+        self.image_latency = image_latency
+        self.image = make_image(image_size, image_size)
+        self.random = random.Random(0)
+
+        self.requests = 0
+        self.rate_limited = 0
+        # characters of the chat messages sent to us
+        self.prompt_chars = 0
+
+        self.app = web.Application(client_max_size=64 * 1024 * 1024)
+        self.app.add_routes(
+            [
+                web.post("/v1/chat/completions", self.chat_completions),
+                web.post("/v1/embeddings", self.embeddings),
+                web.post("/v1/images/generations", self.images_generations),
+                web.post("/sdapi/v1/txt2img", self.txt2img),
+            ]
+        )
+
+    def rate_limit_headers(self) -> dict:
+        return {
+            "x-ratelimit-limit-requests": "3500",
+            "x-ratelimit-remaining-requests": "3499",
+            "x-ratelimit-reset-requests": "17ms",
+            "x-ratelimit-limit-tokens": "90000",
+            "x-ratelimit-remaining-tokens": "89000",
+            "x-ratelimit-reset-tokens": "666ms",
+        }
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        payload = await request.json()
+        self.prompt_chars += sum(
+            len(message.get("content") or "") for message in payload["messages"]
+        )
+        if self.random.random() < self.error_rate:
+            self.rate_limited += 1
+            return web.json_response(
+                {"error": {"message": "Rate limit reached", "type": "requests"}},
+                status=429,
+                headers={**self.rate_limit_headers(), "retry-after": "1"},
+            )
+        await asyncio.sleep(self.latency)
+        words = ["lorem"] * self.completion_tokens
+        if not payload.get("stream"):
+            return web.json_response(
+                {
+                    "id": "chatcmpl-benchmark",
+                    "object": "chat.completion",
+                    "model": payload.get("model"),
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {
+                                "role": "assistant",
+                                "content": " ".join(words),
+                            },
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": {
+                        "prompt_tokens": 10,
+                        "completion_tokens": self.completion_tokens,
+                        "total_tokens": 10 + self.completion_tokens,
+                    },
+                },
+                headers=self.rate_limit_headers(),
+            )
+
+        response = web.StreamResponse(
+            headers={"Content-Type": "text/event-stream", **self.rate_limit_headers()}
+        )
+        await response.prepare(request)
+        deltas = [{"role": "assistant"}] + [{"content": word + " "} for word in words]
+        for delta in deltas:
+            chunk = {
+                "id": "chatcmpl-benchmark",
+                "object": "chat.completion.chunk",
+                "model": payload.get("model"),
+                "choices": [{"index": 0, "delta": delta, "finish_reason": None}],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await asyncio.sleep(self.token_delay)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def embeddings(self, request: web.Request) -> web.Response:
+        """
+        Bag of words vectors, similar texts get similar embeddings
+        """
+        self.requests += 1
+        payload = await request.json()
+        texts = payload["input"]
+        if isinstance(texts, str):
+            texts = [texts]
+        data = []
+        for i, text in enumerate(texts):
+            embedding = [0.0] * 64
+            for word in text.lower().split():
+                embedding[sum(word.encode()) % 64] += 1.0
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        return web.json_response(
+            {"object": "list", "data": data, "model": payload.get("model")}
+        )
+
+    async def images_generations(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        payload = await request.json()
+        await asyncio.sleep(self.image_latency)
+        return web.json_response(
+            {"data": [{"b64_json": self.image}] * payload.get("n", 1)}
+        )
+
+    async def txt2img(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        payload = await request.json()
+        await asyncio.sleep(self.image_latency)
+        return web.json_response(
+            {"images": [self.image] * payload.get("batch_size", 1)}
+        )
+
+
+async def start(app: web.Application, host: str = "127.0.0.1", port: int = 0):
+    """
+    Serve app on host:port, return the runner and the bound port
+    """
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    sockets = site._server.sockets
+    bound_port: Optional[int] = sockets[0].getsockname()[1] if sockets else port
+    return runner, bound_port
@@ -0,0 +1,327 @@
+"""
+Drive a real Bot against local fake servers and report its performance
+
+The fake Mattermost, OpenAI and sdwui servers and the load generator run
+in a child process so that the event loop lag and peak RSS measured here
+belong to the bot alone.
+
+    python benchmarks/run.py --messages 500 --rate 20 --output results.json
+    python benchmarks/run.py --baseline results.json
+    python benchmarks/run.py --replay frames.jsonl.gz --speed 10
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+import resource
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "src"))
+
+
+def percentiles(values: list[float]) -> dict:
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def rank(p: float) -> float:
+        return values[min(len(values) - 1, int(p * len(values)))]
+
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": rank(0.50),
+        "p95": rank(0.95),
+        "p99": rank(0.99),
+        "max": values[-1],
+    }
+
+
+async def generate_load(options: dict, conn) -> None:
+    from fakes import FakeMattermost, FakeOpenAI, start
+    from traffic import command_root, recorded, synthetic
+
+    if options["replay"]:
+        frames = recorded(options["replay"], options["speed"])
+    else:
+        frames = synthetic(
+            options["messages"],
+            options["rate"],
+            options["users"],
+            options["channels"],
+            options["mix"],
+            burst=options["burst"],
+            seed=options["seed"],
+        )
+    if options["save_traffic"]:
+        from frame_recorder import write_frames
+
+        frames = list(frames)
+        write_frames(options["save_traffic"], frames)
+
+    mattermost = FakeMattermost(
+        bot_username=options["bot_username"],
+        # recordings already contain the bot's own posts
+        echo=not options["replay"],
+    )
+    openai = FakeOpenAI(
+        latency=options["openai_latency"],
+        token_delay=options["token_delay"],
+        completion_tokens=options["completion_tokens"],
+        error_rate=options["error_rate"],
+        image_latency=options["image_latency"],
+    )
+    runners = []
+    runner, mattermost_port = await start(mattermost.app)
+    runners.append(runner)
+    runner, openai_port = await start(openai.app)
+    runners.append(runner)
+    conn.send({"mattermost": mattermost_port, "openai": openai_port})
+
+    await asyncio.wait_for(mattermost.connected.wait(), timeout=60)
+
+    # drop the websocket evenly spread over the traffic
+    drop_at = set()
+    if options["disconnects"]:
+        frames = list(frames)
+        step = len(frames) / (options["disconnects"] + 1)
+        drop_at = {int(step * (i + 1)) for i in range(options["disconnects"])}
+    # redeliver some commands like an at-least-once server would
+    redeliver = random.Random(options["seed"])
+
+    # root id -> push time of commands the bot should reply to
+    pushed: dict[str, float] = {}
+    frame_count = 0
+    start_time = time.monotonic()
+    for offset, frame in frames:
+        delay = start_time + offset - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if frame_count in drop_at:
+            await mattermost.drop()
+        root_id = command_root(frame, options["bot_username"])
+        if root_id is not None:
+            pushed[root_id] = time.monotonic()
+        await mattermost.push(frame)
+        if root_id is not None and redeliver.random() < options["duplicates"]:
+            await mattermost.push(frame)
+        frame_count += 1
+    push_time = time.monotonic() - start_time
+
+    # wait until every message got a reply and streaming edits settled
+    deadline = time.monotonic() + options["timeout"]
+    while time.monotonic() < deadline:
+        last_write = max((t[1] for t in mattermost.replies.values()), default=0.0)
+        if (
+            all(post_id in mattermost.replies for post_id in pushed)
+            and time.monotonic() - last_write > options["settle"]
+        ):
+            break
+        await asyncio.sleep(0.05)
+
+    first_reply, complete = [], []
+    for post_id, pushed_at in pushed.items():
+        if post_id in mattermost.replies:
+            first, last = mattermost.replies[post_id]
+            first_reply.append(first - pushed_at)
+            complete.append(last - pushed_at)
+    finished = [pushed[p] + c for p, c in zip(pushed, complete)]
+    elapsed = (max(finished) - start_time) if finished else 0.0
+
+    conn.send(
+        {
+            "frames": frame_count,
+            "messages": len(pushed),
+            "completed": len(complete),
+            "unanswered": len(pushed) - len(complete),
+            "busy_replies": mattermost.busy_replies,
+            "disconnects": mattermost.drops,
+            # commands answered more than once
+            "duplicate_replies": sum(
+                1 for root_id in pushed if mattermost.reply_posts.get(root_id, 0) > 1
+            ),
+            "push_time": push_time,
+            "elapsed": elapsed,
+            "throughput": len(complete) / elapsed if elapsed else 0.0,
+            "first_reply_latency": percentiles(first_reply),
+            "complete_latency": percentiles(complete),
+            "mattermost_requests": mattermost.requests,
+            "openai_requests": openai.requests,
+            "openai_rate_limited": openai.rate_limited,
+            "openai_prompt_chars": openai.prompt_chars,
+        }
+    )
+    for runner in runners:
+        await runner.cleanup()
+
+
+def run_fakes(options: dict, conn) -> None:
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    asyncio.run(generate_load(options, conn))
+
+
+class LagMonitor:
+    """
+    Sample how late the event loop wakes up a sleeping task
+    """
+
+    def __init__(self, interval: float = 0.01) -> None:
+        self.interval = interval
+        self.samples: list[float] = []
+
+    async def run(self) -> None:
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(time.monotonic() - start - self.interval, 0.0))
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def benchmark(options: dict) -> dict:
+    from bot import Bot
+
+    context = multiprocessing.get_context("spawn")
+    conn, child_conn = context.Pipe()
+    process = context.Process(target=run_fakes, args=(options, child_conn))
+    process.start()
+    try:
+        ports = await asyncio.to_thread(conn.recv)
+        openai_url = f"http://127.0.0.1:{ports['openai']}"
+        bot = Bot(
+            server_url="127.0.0.1",
+            port=ports["mattermost"],
+            scheme="http",
+            username=options["bot_username"],
+            email="bot@example.com",
+            password="password",
+            openai_api_key="sk-benchmark",
+            gpt_api_endpoint=f"{openai_url}/v1/chat/completions",
+            embeddings_endpoint=f"{openai_url}/v1/embeddings",
+            image_generation_endpoint=f"{openai_url}/sdapi/v1/txt2img",
+            image_generation_backend="sdwui",
+            stream_reply=options["stream"],
+            **json.loads(options["bot_options"]),
+        )
+        await bot.login()
+        lag = LagMonitor()
+        lag_task = asyncio.create_task(lag.run())
+        bot_task = asyncio.create_task(bot.run())
+        results = await asyncio.to_thread(conn.recv)
+        results["ingest"] = bot.ingest_stats()
+        lag_task.cancel()
+        await bot.close(bot_task)
+    finally:
+        process.join(timeout=10)
+        if process.is_alive():
+            process.terminate()
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak_rss //= 1024
+    return {
+        "commit": git_commit(),
+        "timestamp": int(time.time()),
+        "options": options,
+        **results,
+        "event_loop_lag": percentiles(lag.samples),
+        "peak_rss_mb": peak_rss / 1024,
+    }
+
+
+def compare(baseline: dict, results: dict) -> None:
+    """
+    Print the relative change of the headline numbers
+    """
+    rows = [
+        ("throughput", lambda r: r["throughput"]),
+        ("first reply p50", lambda r: r["first_reply_latency"]["p50"]),
+        ("first reply p99", lambda r: r["first_reply_latency"]["p99"]),
+        ("complete p50", lambda r: r["complete_latency"]["p50"]),
+        ("complete p99", lambda r: r["complete_latency"]["p99"]),
+        ("loop lag p99", lambda r: r["event_loop_lag"]["p99"]),
+        ("prompt chars", lambda r: r["openai_prompt_chars"]),
+        ("peak rss mb", lambda r: r["peak_rss_mb"]),
+    ]
+    print(f"{'':20}{baseline['commit']:>12}{results['commit']:>12}{'change':>10}")
+    for name, get in rows:
+        try:
+            old, new = get(baseline), get(results)
+        except KeyError:
+            continue
+        change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+        print(f"{name:20}{old:12.4f}{new:12.4f}{change:>10}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument(
+        "--rate", type=float, default=20.0, help="messages per second, 0 for max"
+    )
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--channels", type=int, default=5)
+    parser.add_argument("--mix", default="chat=0.7,gpt=0.2,pic=0.05,help=0.05")
+    parser.add_argument(
+        "--burst", type=int, default=1, help="messages that arrive at once"
+    )
+    parser.add_argument("--replay", help="replay a websocket recording instead")
+    parser.add_argument(
+        "--speed", type=float, default=1.0, help="replay speed, 0 for max"
+    )
+    parser.add_argument("--save-traffic", help="save the traffic as a recording")
+    parser.add_argument("--stream", action="store_true", help="stream replies")
+    parser.add_argument("--openai-latency", type=float, default=0.5)
+    parser.add_argument("--token-delay", type=float, default=0.01)
+    parser.add_argument("--completion-tokens", type=int, default=50)
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="fraction of 429 responses"
+    )
+    parser.add_argument("--image-latency", type=float, default=2.0)
+    parser.add_argument(
+        "--bot-options", default="{}", help="extra Bot arguments as JSON"
+    )
+    parser.add_argument(
+        "--disconnects", type=int, default=0, help="websocket drops during the run"
+    )
+    parser.add_argument(
+        "--duplicates", type=float, default=0.0, help="fraction of commands sent twice"
+    )
+    parser.add_argument("--bot-username", default="bot")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument(
+        "--settle", type=float, default=1.0, help="quiet seconds before stopping"
+    )
+    parser.add_argument("--output", help="write results as JSON")
+    parser.add_argument("--baseline", help="compare with earlier results")
+    options = vars(parser.parse_args())
+    output, baseline = options.pop("output"), options.pop("baseline")
+
+    results = asyncio.run(benchmark(options))
+    print(json.dumps(results, indent=2))
+    if output:
+        Path(output).write_text(json.dumps(results, indent=2))
+    if baseline:
+        compare(json.loads(Path(baseline).read_text()), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Measure how long keeping a !chat conversation within its token limit takes,
+with cached per-message token counts and by re-encoding the history
+
+    python benchmarks/token_count.py --turns 200
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+import httpx  # noqa: E402
+from gptbot import Chatbot  # noqa: E402
+
+WORDS = "the a of to and in is it you that was for on are with as I his they be".split()
+
+
+def make_turns(turns: int, words: int, seed: int) -> list[tuple[str, str]]:
+    rng = random.Random(seed)
+    return [
+        (
+            "user" if i % 2 == 0 else "assistant",
+            " ".join(rng.choice(WORDS) for _ in range(words)),
+        )
+        for i in range(turns)
+    ]
+
+
+def cached(chatbot: Chatbot, turns: list[tuple[str, str]]) -> int:
+    """
+    What Chatbot does: counts are taken once per message
+    """
+    chatbot.reset(convo_id="benchmark")
+    for role, content in turns:
+        chatbot.add_to_conversation(content, role, convo_id="benchmark")
+        chatbot._Chatbot__truncate_conversation(convo_id="benchmark")
+        chatbot.get_max_tokens("benchmark")
+    return chatbot.get_token_count("benchmark")
+
+
+def recount(chatbot: Chatbot, turns: list[tuple[str, str]]) -> int:
+    """
+    What Chatbot did before: every check encodes the whole history
+    """
+    messages = [{"role": "system", "content": chatbot.system_prompt}]
+
+    def token_count() -> int:
+        return sum(chatbot.get_message_token_count(m) for m in messages) + 5
+
+    for role, content in turns:
+        messages.append({"role": role, "content": content})
+        while token_count() > chatbot.truncate_limit and len(messages) > 1:
+            messages.pop(1)
+        chatbot.max_tokens - token_count()
+    return token_count()
+
+
+async def main(options: dict) -> None:
+    aclient = httpx.AsyncClient()
+    chatbot = Chatbot(aclient, api_key="sk-benchmark", engine=options["engine"])
+    turns = make_turns(options["turns"], options["words"], options["seed"])
+    results = {}
+    for name, run in (("recount", recount), ("cached", cached)):
+        start = time.perf_counter()
+        token_count = run(chatbot, turns)
+        results[name] = {
+            "seconds": time.perf_counter() - start,
+            "token_count": token_count,
+        }
+    print(json.dumps(results, indent=2))
+    await aclient.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--words", type=int, default=150, help="words per message")
+    parser.add_argument("--engine", default="gpt-3.5-turbo-16k")
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main(vars(parser.parse_args())))
@@ -0,0 +1,130 @@
+"""
+Websocket traffic for the benchmark, recorded or synthetic
+"""
+import json
+import random
+import re
+import sys
+import uuid
+from pathlib import Path
+from typing import Iterator, Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from frame_recorder import read_frames  # noqa: E402
+
+COMMAND_PROMPTS = {
+    "chat": "!chat Tell me something about the history of the number {i}",
+    "gpt": "!gpt Summarize the plot of a movie about the number {i}",
+    "pic": "!pic a watercolor painting of a lighthouse",
+    "help": "!help",
+    "new": "!new",
+    "usage": "!usage",
+    # plain chatter the bot has to decode and ignore
+    "none": "Has anyone seen the meeting notes from number {i}?",
+}
+
+
+# commands the bot replies to, see Bot.get_command
+COMMAND_PATTERN = re.compile(r"^\s*!(?:(?:gpt|chat|pic)\s*.+$|new|help|usage)")
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    """
+    Parse a command mix like chat=0.7,gpt=0.2,pic=0.1
+    """
+    weights = {}
+    for item in mix.split(","):
+        command, _, weight = item.partition("=")
+        if command not in COMMAND_PROMPTS:
+            raise ValueError(f"unknown command {command}")
+        weights[command] = float(weight or 1)
+    return weights
+
+
+def posted_frame(
+    post_id: str, user: str, user_id: str, channel_id: str, message: str, seq: int
+) -> str:
+    post = {
+        "id": post_id,
+        "create_at": 0,
+        "update_at": 0,
+        "user_id": user_id,
+        "channel_id": channel_id,
+        "root_id": "",
+        "message": message,
+        "type": "",
+        "props": {},
+    }
+    return json.dumps(
+        {
+            "event": "posted",
+            "data": {
+                "channel_display_name": channel_id,
+                "channel_name": channel_id,
+                "channel_type": "O",
+                "post": json.dumps(post),
+                "sender_name": user,
+                "team_id": "team",
+            },
+            "broadcast": {"channel_id": channel_id},
+            "seq": seq,
+        }
+    )
+
+
+def synthetic(
+    messages: int,
+    rate: float,
+    users: int,
+    channels: int,
+    mix: str,
+    burst: int = 1,
+    seed: int = 0,
+) -> Iterator[tuple[float, str]]:
+    """
+    Generate posted frames, burst messages from different users arrive at once
+    """
+    rng = random.Random(seed)
+    weights = parse_mix(mix)
+    commands = list(weights)
+    for i in range(messages):
+        user = rng.randrange(users)
+        command = rng.choices(commands, list(weights.values()))[0]
+        yield (
+            (i // burst) * burst / rate if rate else 0.0,
+            posted_frame(
+                uuid.UUID(int=rng.getrandbits(128)).hex[:26],
+                f"user{user}",
+                f"user{user:022d}",
+                f"channel{user % channels}",
+                COMMAND_PROMPTS[command].format(i=i),
+                i + 1,
+            ),
+        )
+
+
+def recorded(path: str, speed: float = 1.0) -> Iterator[tuple[float, str]]:
+    """
+    Replay a recording speed times faster, 0 for as fast as possible
+    """
+    for offset, frame in read_frames(path):
+        yield (offset / speed if speed else 0.0), frame
+
+
+def command_root(frame: str, bot_username: str) -> Optional[str]:
+    """
+    Get the root id the bot replies to, None if the frame isn't a command
+    """
+    try:
+        data = json.loads(frame)
+        if data.get("event") != "posted":
+            return None
+        if data["data"].get("sender_name") == bot_username:
+            return None
+        post = json.loads(data["data"]["post"])
+    except (ValueError, KeyError, TypeError):
+        return None
+    if not COMMAND_PATTERN.match(post.get("message", "")):
+        return None
+    return post.get("root_id") or post.get("id")
@@ -0,0 +1,87 @@
+"""
+Measure how many websocket events per second Bot.websocket_handler gets
+through when none of them are commands
+
+    python benchmarks/websocket_handler.py --events 50000
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from traffic import posted_frame, synthetic  # noqa: E402
+
+
+def make_frames(kind: str, events: int, bot_id: str) -> list[str]:
+    if kind == "chatter":
+        return [
+            frame
+            for _, frame in synthetic(events, 0, users=50, channels=10, mix="none=1")
+        ]
+    if kind == "own":
+        # the bot's own replies echoed back, some of them quoting a command
+        return [
+            posted_frame(
+                f"{i:026d}", "bot", bot_id, "channel", f"Use !chat to ask {i}!", i
+            )
+            for i in range(events)
+        ]
+    if kind == "typing":
+        return [
+            json.dumps(
+                {
+                    "event": "typing",
+                    "data": {"parent_id": "", "user_id": f"user{i % 50:022d}"},
+                    "broadcast": {"channel_id": "channel"},
+                    "seq": i,
+                }
+            )
+            for i in range(events)
+        ]
+    raise ValueError(kind)
+
+
+async def measure(bot, frames: list[str]) -> float:
+    start = time.perf_counter()
+    for frame in frames:
+        await bot.websocket_handler(frame)
+    return len(frames) / (time.perf_counter() - start)
+
+
+async def main(options: dict) -> None:
+    import bot as bot_module
+    from bot import Bot
+
+    if options["no_orjson"]:
+        bot_module.json_loads = json.loads
+    bot = Bot(
+        server_url="localhost",
+        username="bot",
+        email="bot@example.com",
+        password="password",
+        openai_api_key="sk-benchmark",
+    )
+    bot.bot_id = "bot" + "0" * 23
+    results = {}
+    for kind in ("chatter", "own", "typing"):
+        frames = make_frames(kind, options["events"], bot.bot_id)
+        # warm up
+        await measure(bot, frames[:1000])
+        results[kind] = await measure(bot, frames)
+    results["json"] = bot_module.json_loads.__module__
+    print(json.dumps({"events_per_second": results}, indent=2))
+    for pool in bot.http_pools.values():
+        await pool.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--events", type=int, default=50000)
+    parser.add_argument(
+        "--no-orjson", action="store_true", help="use json even if orjson is there"
+    )
+    asyncio.run(main(vars(parser.parse_args())))
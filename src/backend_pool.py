@@ -0,0 +1,233 @@
+"""
+Pool of OpenAI-compatible endpoints with latency-aware routing and failover
+"""
+import asyncio
+import statistics
+import time
+from typing import Awaitable, Callable, Optional, TypeVar
+import httpx
+from tenacity import (
+    AsyncRetrying,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+from log import getlogger
+
+logger = getlogger()
+
+T = TypeVar("T")
+
+
+class UpstreamError(Exception):
+    def __init__(self, status_code: int, message: str) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def is_retryable(e: BaseException) -> bool:
+    """
+    Rate limits, server errors and connection problems are worth a retry
+    """
+    if isinstance(e, UpstreamError):
+        return e.status_code == 429 or e.status_code >= 500
+    return isinstance(e, httpx.TransportError)
+
+
+class Endpoint:
+    def __init__(self, url: str, api_key: str = None) -> None:
+        self.url = url
+        self.api_key = api_key
+
+        # exponentially weighted moving average of the latency in seconds
+        self.latency: Optional[float] = None
+        self.inflight = 0
+        # circuit breaker, open until open_until, then half-open until a
+        # trial request succeeds, 0 when closed
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.trial = False
+
+        # statistics
+        self.requests = 0
+        self.failures = 0
+
+    def available(self, now: float) -> bool:
+        """
+        Closed, or half-open without a trial request in flight
+        """
+        return self.open_until <= now and not (self.open_until and self.trial)
+
+    def score(self, default_latency: float) -> float:
+        """
+        Lower is better, untried endpoints count as default_latency
+        """
+        latency = self.latency if self.latency is not None else default_latency
+        return latency * (self.inflight + 1)
+
+    def stats(self) -> dict:
+        return {
+            "url": self.url,
+            "latency": self.latency,
+            "inflight": self.inflight,
+            "requests": self.requests,
+            "failures": self.failures,
+            "open": self.open_until > time.monotonic(),
+            "half_open": 0 < self.open_until <= time.monotonic(),
+        }
+
+
+class BackendPool:
+    def __init__(
+        self,
+        endpoints: list[Endpoint],
+        ewma_alpha: float = 0.3,
+        failure_threshold: int = 3,
+        cooldown: float = 30.0,
+        max_attempts: int = 3,
+        hedge_delay: Optional[float] = None,
+        default_latency: float = 1.0,
+    ) -> None:
+        if not endpoints:
+            raise ValueError("at least one endpoint must be provided")
+        self.endpoints = endpoints
+        self.ewma_alpha = ewma_alpha
+        # consecutive failures before an endpoint is taken out of rotation
+        self.failure_threshold = failure_threshold
+        # seconds before an unhealthy endpoint gets a trial request
+        self.cooldown = cooldown
+        self.max_attempts = max_attempts
+        # seconds to wait before sending a duplicate request elsewhere
+        self.hedge_delay = hedge_delay
+        # latency of untried endpoints while no endpoint has one
+        self.default_latency = default_latency
+
+        self.hedged = 0
+
+    def select(self, exclude: set[Endpoint] = None) -> Endpoint:
+        """
+        Pick the healthy endpoint with the best latency and load
+        """
+        now = time.monotonic()
+        candidates = [
+            endpoint
+            for endpoint in self.endpoints
+            if endpoint not in (exclude or ()) and endpoint.available(now)
+        ]
+        if not candidates:
+            # everything is unhealthy or already tried, fall back to the
+            # endpoint that recovers first
+            candidates = sorted(
+                [e for e in self.endpoints if e not in (exclude or ())]
+                or self.endpoints,
+                key=lambda e: e.open_until,
+            )[:1]
+        # untried endpoints count as typical ones, their load still matters
+        latencies = [e.latency for e in self.endpoints if e.latency is not None]
+        default_latency = (
+            statistics.median(latencies) if latencies else self.default_latency
+        )
+        return min(candidates, key=lambda e: e.score(default_latency))
+
+    def observe_latency(self, endpoint: Endpoint, latency: float) -> None:
+        if endpoint.latency is None:
+            endpoint.latency = latency
+        else:
+            endpoint.latency += self.ewma_alpha * (latency - endpoint.latency)
+
+    def record_success(self, endpoint: Endpoint, latency: float) -> None:
+        self.observe_latency(endpoint, latency)
+        endpoint.consecutive_failures = 0
+        endpoint.open_until = 0.0
+
+    def record_failure(self, endpoint: Endpoint, e: BaseException) -> None:
+        endpoint.failures += 1
+        if not is_retryable(e):
+            # the request was bad, not the endpoint
+            return
+        endpoint.consecutive_failures += 1
+        if endpoint.consecutive_failures >= self.failure_threshold:
+            endpoint.open_until = time.monotonic() + self.cooldown
+            logger.warning(f"{endpoint.url} is unhealthy, retry in {self.cooldown}s")
+
+    async def __send(
+        self, endpoint: Endpoint, send: Callable[[Endpoint], Awaitable[T]]
+    ) -> T:
+        endpoint.requests += 1
+        endpoint.inflight += 1
+        start = time.monotonic()
+        # past its cooldown, this is the one request that may close it
+        trial = 0 < endpoint.open_until <= start and not endpoint.trial
+        if trial:
+            endpoint.trial = True
+        try:
+            result = await send(endpoint)
+        except asyncio.CancelledError:
+            # lost a hedge, it took at least this long
+            self.observe_latency(endpoint, time.monotonic() - start)
+            raise
+        except Exception as e:
+            self.record_failure(endpoint, e)
+            raise
+        finally:
+            endpoint.inflight -= 1
+            if trial:
+                endpoint.trial = False
+        self.record_success(endpoint, time.monotonic() - start)
+        return result
+
+    async def __attempt(
+        self,
+        send: Callable[[Endpoint], Awaitable[T]],
+        tried: set[Endpoint],
+        hedge: bool,
+    ) -> T:
+        endpoint = self.select(exclude=tried)
+        tried.add(endpoint)
+        if not hedge or self.hedge_delay is None or len(self.endpoints) < 2:
+            return await self.__send(endpoint, send)
+
+        # hedged request, first success wins
+        tasks = [asyncio.create_task(self.__send(endpoint, send))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay)
+            if not done:
+                self.hedged += 1
+                second = self.select(exclude=tried)
+                tried.add(second)
+                tasks.append(asyncio.create_task(self.__send(second, send)))
+            error = None
+            for future in asyncio.as_completed(tasks):
+                try:
+                    return await future
+                except Exception as e:
+                    error = e
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def request(
+        self, send: Callable[[Endpoint], Awaitable[T]], hedge: bool = True
+    ) -> T:
+        """
+        Call send with an endpoint, retrying with jitter on other endpoints
+        """
+        tried: set[Endpoint] = set()
+        async for attempt in AsyncRetrying(
+            wait=wait_random_exponential(min=0.5, max=5),
+            stop=stop_after_attempt(self.max_attempts),
+            retry=retry_if_exception(is_retryable),
+            reraise=True,
+        ):
+            with attempt:
+                if len(tried) >= len(self.endpoints):
+                    # every endpoint had its chance, start over
+                    tried.clear()
+                return await self.__attempt(send, tried, hedge)
+
+    def stats(self) -> dict:
+        return {
+            "hedged": self.hedged,
+            "endpoints": [endpoint.stats() for endpoint in self.endpoints],
+        }
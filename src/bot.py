@@ -1,19 +1,64 @@
 import sys
-import aiofiles.os
 from mattermostdriver import AsyncDriver
-from typing import Optional
+from typing import AsyncGenerator, Optional
 import json
 import asyncio
+import contextvars
+import importlib
 import re
 import os
+import time
+from functools import partial
 from pathlib import Path
 from gptbot import Chatbot
+from conversation_store import ConversationStore
+from response_cache import ResponseCache
+from image_cache import ImageCache
+from backend_pool import BackendPool, Endpoint
+from model_router import ModelRouter
+from usage_ledger import UsageLedger
+import usage_ledger
+from rate_limiter import RateLimiter
+from frame_recorder import FrameRecorder
+from ingest import Backoff, SeenPosts
 from log import getlogger
-import httpx
+import log
+from scheduler import Scheduler
+import scheduler
+from thread_history import ThreadHistory
+import http_pool
 import imagegen
+import metrics
+import startup
+import tracing
 
 logger = getlogger()
 
+try:
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# mattermost rejects posts longer than this
+MAX_POST_LENGTH = 16383
+
+# command -> scheduler backend it is limited by
+COMMAND_BACKENDS = {
+    "gpt": "chat",
+    "chat": "chat",
+    "pic": "image",
+    "new": "local",
+    "help": "local",
+    "usage": "local",
+}
+# commands that need something after them
+PROMPT_COMMANDS = {"gpt", "chat", "pic"}
+COMMAND_PROG = re.compile(r"^\s*!(gpt|chat|pic|new|help|usage)(?:\s*(.+))?$")
+# the event type of a raw frame, the nested post is escaped and can't match
+EVENT_PROG = re.compile(r'"event":\s*"(\w+)"')
+
 
 class Bot:
     def __init__(
@@ -27,6 +72,27 @@ class Bot:
         openai_api_key: Optional[str] = None,
         gpt_api_endpoint: Optional[str] = None,
         gpt_model: Optional[str] = None,
+        gpt_api_endpoints: Optional[list[dict]] = None,
+        hedge_delay: Optional[float] = None,
+        rate_limit_rpm: Optional[int] = None,
+        rate_limit_tpm: Optional[int] = None,
+        metrics_port: Optional[int] = None,
+        metrics_host: Optional[str] = None,
+        trace_log: Optional[bool] = False,
+        trace_buffer_size: Optional[int] = None,
+        profile_every: Optional[int] = None,
+        profile_dir: Optional[str] = None,
+        websocket_record_path: Optional[str] = None,
+        websocket_record_anonymize: Optional[bool] = False,
+        log_level: Optional[str] = None,
+        log_file: Optional[str] = None,
+        log_max_bytes: Optional[int] = None,
+        log_backup_count: Optional[int] = None,
+        log_rotate_when: Optional[str] = None,
+        log_json: Optional[bool] = False,
+        log_event_levels: Optional[dict[str, str]] = None,
+        log_event_sampling: Optional[dict[str, float]] = None,
+        tiktoken_cache_dir: Optional[str] = None,
         max_tokens: Optional[int] = None,
         top_p: Optional[float] = None,
         presence_penalty: Optional[float] = None,
@@ -42,7 +108,59 @@ class Bot:
         sdwui_cfg_scale: Optional[float] = None,
         image_format: Optional[str] = None,
         timeout: Optional[float] = 120.0,
+        stream_reply: Optional[bool] = False,
+        stream_edit_interval: Optional[float] = None,
+        max_concurrent_tasks: Optional[int] = None,
+        max_concurrent_chat: Optional[int] = None,
+        max_concurrent_image: Optional[int] = None,
+        image_max_batch_size: Optional[int] = None,
+        image_cache_size: Optional[int] = None,
+        max_queue_size: Optional[int] = None,
+        conversation_ttl: Optional[float] = None,
+        conversation_token_budget: Optional[int] = None,
+        conversation_db_path: Optional[str] = None,
+        response_cache_size: Optional[int] = None,
+        response_cache_ttl: Optional[float] = None,
+        response_cache_nondeterministic: Optional[bool] = False,
+        http_pools: Optional[dict[str, dict]] = None,
+        context_selection: Optional[str] = None,
+        context_token_budget: Optional[int] = None,
+        context_recent_messages: Optional[int] = None,
+        context_top_m: Optional[int] = None,
+        embeddings_endpoint: Optional[str] = None,
+        embeddings_model: Optional[str] = None,
+        compact_threshold: Optional[int] = None,
+        compact_model: Optional[str] = None,
+        compact_keep_messages: Optional[int] = None,
+        compact_summary_tokens: Optional[int] = None,
+        model_tiers: Optional[list[dict]] = None,
+        command_models: Optional[dict[str, str]] = None,
+        usage_window: Optional[float] = None,
+        user_token_quota: Optional[int] = None,
+        channel_token_quota: Optional[int] = None,
+        user_image_quota: Optional[int] = None,
+        channel_image_quota: Optional[int] = None,
+        usage_db_path: Optional[str] = None,
+        websocket_reconnect_delay: Optional[float] = None,
+        websocket_reconnect_max_delay: Optional[float] = None,
+        seen_posts_size: Optional[int] = None,
+        catch_up_margin: Optional[float] = None,
+        conversation_scope: Optional[str] = None,
+        thread_history_tokens: Optional[int] = None,
+        thread_page_size: Optional[int] = None,
     ) -> None:
+        log.configure(
+            level=log_level or "INFO",
+            # empty to disable
+            log_file=log_file if log_file is not None else "bot.log",
+            max_bytes=log_max_bytes or 10 * 1024 * 1024,
+            backup_count=log_backup_count if log_backup_count is not None else 5,
+            rotate_when=log_rotate_when or None,
+            json_format=log_json or False,
+            event_levels=log_event_levels,
+            event_sampling=log_event_sampling,
+        )
+
         if server_url is None:
             raise ValueError("server url must be provided")
 
@@ -70,6 +188,10 @@ class Bot:
             logger.error("image_generation_backend must be openai or sdwui or localai")
             sys.exit(1)
 
+        if context_selection not in ["hashing", "embeddings", "", None]:
+            logger.error("context_selection must be hashing or embeddings")
+            sys.exit(1)
+
         if image_format not in ["jpeg", "png", None]:
             logger.error("image_format should be jpeg or png, leave blank for jpeg")
             sys.exit(1)
@@ -84,10 +206,12 @@ class Bot:
         self.gpt_api_endpoint = (
             gpt_api_endpoint or "https://api.openai.com/v1/chat/completions"
         )
+        # extra OpenAI-compatible endpoints, [{"url": ..., "api_key": ...}]
+        self.gpt_api_endpoints: list[dict] = gpt_api_endpoints or []
         self.gpt_model: str = gpt_model or "gpt-3.5-turbo"
         self.max_tokens: int = max_tokens or 4000
         self.top_p: float = top_p or 1.0
-        self.temperature: float = temperature or 0.8
+        self.temperature: float = temperature if temperature is not None else 0.8
         self.presence_penalty: float = presence_penalty or 0.0
         self.frequency_penalty: float = frequency_penalty or 0.0
         self.reply_count: int = reply_count or 1
@@ -119,31 +243,210 @@ class Bot:
 
         self.timeout = timeout or 120.0
 
+        self.stream_reply: bool = stream_reply or False
+        self.stream_edit_interval: float = stream_edit_interval or 1.0
+
+        self.max_concurrent_chat: int = max_concurrent_chat or 8
+        self.max_concurrent_image: int = max_concurrent_image or 1
+        self.image_max_batch_size: int = image_max_batch_size or 4
+
+        # websocket event scheduler
+        self.scheduler = Scheduler(
+            max_concurrency=max_concurrent_tasks or 16,
+            backend_limits={
+                "chat": self.max_concurrent_chat,
+                # let enough !pic jobs through for the image queue to batch them
+                "image": self.max_concurrent_image * self.image_max_batch_size,
+            },
+            max_queue_size=max_queue_size or 100,
+        )
+        # busy and quota notices being posted, see send_notice
+        self.notice_tasks: set[asyncio.Task] = set()
+
         self.bot_id = None
 
         self.base_path = Path(os.path.dirname(__file__)).parent
 
-        if not os.path.exists(self.base_path / "images"):
-            os.mkdir(self.base_path / "images")
+        # generated image cache, size in MB, 0 to disable
+        self.image_cache: Optional[ImageCache] = None
+        if image_cache_size:
+            self.image_cache = ImageCache(
+                # apart from the images saved by !pic
+                self.base_path / "images" / "cache",
+                image_cache_size * 1024 * 1024,
+            )
+
+        # one connection pool per upstream so a slow image backend can't
+        # hold the connections chat completions need
+        self.http_pools = http_pool.make_pools(
+            {
+                "chat": {
+                    # hedged requests can double the connections in use
+                    "max_connections": self.max_concurrent_chat * 2,
+                    "max_keepalive_connections": self.max_concurrent_chat,
+                    "keepalive_expiry": 60.0,
+                    "read_timeout": self.timeout,
+                    "prewarm": 2,
+                },
+                "image": {
+                    "max_connections": self.max_concurrent_image * 2,
+                    "max_keepalive_connections": self.max_concurrent_image,
+                    "keepalive_expiry": 30.0,
+                    "read_timeout": 180.0,
+                },
+                "download": {
+                    "max_connections": 4,
+                    "max_keepalive_connections": 2,
+                    "keepalive_expiry": 10.0,
+                    "read_timeout": self.timeout,
+                },
+            },
+            http_pools,
+        )
+
+        # image generation job queue
+        self.image_queue = imagegen.ImageQueue(
+            self.http_pools["image"].client,
+            self.image_generation_endpoint,
+            self.image_generation_backend,
+            concurrency=self.max_concurrent_image,
+            max_batch_size=self.image_max_batch_size,
+            download_client=self.http_pools["download"].client,
+        )
+
+        # !chat history per user, or per thread rebuilt from mattermost
+        self.conversation_scope: str = conversation_scope or "user"
+        if self.conversation_scope not in ["user", "thread"]:
+            logger.error("conversation_scope must be user or thread")
+            sys.exit(1)
+
+        # conversation history store
+        self.conversation_store = ConversationStore(
+            # 0 means no limit, threads can always be rebuilt so they expire
+            ttl=conversation_ttl
+            or (3600.0 if self.conversation_scope == "thread" else None),
+            token_budget=conversation_token_budget or None,
+            db_path=conversation_db_path,
+        )
+        # flushes the store, started by run()
+        self.conversation_store_task: Optional[asyncio.Task] = None
+
+        # !gpt response cache
+        self.response_cache = ResponseCache(
+            max_size=response_cache_size if response_cache_size is not None else 256,
+            ttl=response_cache_ttl or 3600.0,
+            cache_nondeterministic=response_cache_nondeterministic or False,
+        )
+
+        # chat completion endpoints
+        self.backend_pool = BackendPool(
+            [Endpoint(self.gpt_api_endpoint, self.openai_api_key)]
+            + [
+                Endpoint(endpoint["url"], endpoint.get("api_key", self.openai_api_key))
+                for endpoint in self.gpt_api_endpoints
+            ],
+            # 0 means no hedging
+            hedge_delay=hedge_delay or None,
+        )
+
+        # requests/tokens per minute admission, 0 to only learn the limits
+        # from response headers
+        self.rate_limiter = RateLimiter(
+            requests_per_minute=rate_limit_rpm or None,
+            tokens_per_minute=rate_limit_tpm or None,
+        )
+
+        # tokenizer files are read from here instead of being downloaded,
+        # the docker image bundles them in tiktoken_cache
+        if tiktoken_cache_dir:
+            os.environ["TIKTOKEN_CACHE_DIR"] = tiktoken_cache_dir
+        elif (self.base_path / "tiktoken_cache").is_dir():
+            os.environ.setdefault(
+                "TIKTOKEN_CACHE_DIR", str(self.base_path / "tiktoken_cache")
+            )
+        startup.mark("configure")
+
+        # send the recent and the most relevant messages of long !chat
+        # histories instead of all of them
+        self.context_selector = None
+        if context_selection:
+            # numpy is only needed for this
+            try:
+                context_selector = importlib.import_module("context_selector")
+            except ImportError as e:
+                logger.error(f"context_selection needs numpy, pip install numpy: {e}")
+                sys.exit(1)
+            if context_selection == "embeddings":
+                embedder = context_selector.EmbeddingsClient(
+                    self.http_pools["chat"].client,
+                    embeddings_endpoint or "https://api.openai.com/v1/embeddings",
+                    api_key=self.openai_api_key,
+                    model=embeddings_model or "text-embedding-ada-002",
+                )
+            else:
+                embedder = context_selector.HashingVectorizer()
+            self.context_selector = context_selector.ContextSelector(
+                embedder,
+                token_budget=context_token_budget or 2000,
+                recent_messages=context_recent_messages or 6,
+                top_m=context_top_m if context_top_m is not None else 4,
+            )
 
-        #  httpx session
-        self.httpx_client = httpx.AsyncClient()
+        # cheapest model that fits each request, [{"model": ..., "max_tokens": ...}]
+        self.model_router: Optional[ModelRouter] = None
+        if model_tiers:
+            self.model_router = ModelRouter(
+                model_tiers,
+                # e.g. {"chat": "gpt-4"} to start !chat from that tier
+                command_models=command_models,
+                default_max_tokens=self.max_tokens,
+            )
+            # keep as much history as the largest tier takes
+            self.max_tokens = self.model_router.max_tokens
+            truncate_limit = self.max_tokens - self.model_router.reply_tokens
+        else:
+            truncate_limit = None
+
+        # tokens and images per user and channel, quotas of 0 mean no limit
+        self.usage_ledger = UsageLedger(
+            window=usage_window or 3600.0,
+            user_token_quota=user_token_quota or None,
+            channel_token_quota=channel_token_quota or None,
+            user_image_quota=user_image_quota or None,
+            channel_image_quota=channel_image_quota or None,
+            db_path=usage_db_path,
+        )
+        # flushes the ledger, started by run()
+        self.usage_ledger_task: Optional[asyncio.Task] = None
 
-        # initialize Chatbot object
+        # initialize Chatbot object, this loads the tokenizer
         self.chatbot = Chatbot(
-            aclient=self.httpx_client,
+            aclient=self.http_pools["chat"].client,
             api_key=self.openai_api_key,
             api_url=self.gpt_api_endpoint,
             engine=self.gpt_model,
-            timeout=self.timeout,
             max_tokens=self.max_tokens,
+            truncate_limit=truncate_limit,
             top_p=self.top_p,
             presence_penalty=self.presence_penalty,
             frequency_penalty=self.frequency_penalty,
             reply_count=self.reply_count,
             system_prompt=self.system_prompt,
             temperature=self.temperature,
+            conversation_store=self.conversation_store,
+            response_cache=self.response_cache,
+            backend_pool=self.backend_pool,
+            rate_limiter=self.rate_limiter,
+            context_selector=self.context_selector,
+            model_router=self.model_router,
+            usage_ledger=self.usage_ledger,
+            # 0 means no compaction
+            compact_threshold=compact_threshold or None,
+            compact_model=compact_model,
+            compact_keep_messages=compact_keep_messages or 4,
+            compact_summary_tokens=compact_summary_tokens or 300,
         )
+        startup.mark("tokenizer")
 
         # login relative info
         if email is None and password is None:
@@ -160,55 +463,352 @@ class Bot:
             }
         )
 
-        # regular expression to match keyword
-        self.gpt_prog = re.compile(r"^\s*!gpt\s*(.+)$")
-        self.chat_prog = re.compile(r"^\s*!chat\s*(.+)$")
-        self.pic_prog = re.compile(r"^\s*!pic\s*(.+)$")
-        self.help_prog = re.compile(r"^\s*!help\s*.*$")
-        self.new_prog = re.compile(r"^\s*!new\s*.*$")
+        # rebuilds a thread's conversation when it isn't in the store
+        self.thread_history = ThreadHistory(
+            self.driver,
+            self.parse_command,
+            self.chatbot.get_message_token_count,
+            # history that fits next to the system prompt
+            token_budget=thread_history_tokens
+            or self.chatbot.truncate_limit - self.chatbot.get_token_count(),
+            page_size=thread_page_size or 60,
+        )
+
+        # reconnect after the websocket drops, then catch up over REST
+        self.closing = False
+        self.backoff = Backoff(
+            initial=websocket_reconnect_delay or 1.0,
+            maximum=websocket_reconnect_max_delay or 60.0,
+        )
+        # posts already queued, a post may arrive over both paths
+        self.seen_posts = SeenPosts(seen_posts_size or 10000)
+        # seconds before the last event to catch up from, for clock skew
+        self.catch_up_margin: float = (
+            catch_up_margin if catch_up_margin is not None else 60.0
+        )
+        # wall clock time of the last websocket frame
+        self.last_event_at: Optional[float] = None
+        self.connected = False
+        self.catch_up_task: Optional[asyncio.Task] = None
+        self.reconnects = 0
+        self.catch_ups = 0
+        self.catch_up_posts = 0
+        self.catch_up_commands = 0
+        self.duplicate_posts = 0
+
+        # metrics endpoint, started from main.py, 0 to disable
+        self.metrics_port: int = metrics_port or 0
+        self.metrics_host: str = metrics_host or "0.0.0.0"
+        metrics.REGISTRY.register_stats("scheduler", self.scheduler.stats)
+        metrics.REGISTRY.register_stats(
+            "conversation_store", self.conversation_store.stats
+        )
+        metrics.REGISTRY.register_stats("response_cache", self.response_cache.stats)
+        metrics.REGISTRY.register_stats("image_queue", self.image_queue.stats)
+        if self.image_cache is not None:
+            metrics.REGISTRY.register_stats("image_cache", self.image_cache.stats)
+        metrics.REGISTRY.register_stats("rate_limiter", self.rate_limiter.stats)
+        metrics.REGISTRY.register_stats("backend_pool", self.backend_pool.stats)
+        metrics.REGISTRY.register_stats("startup", startup.stats)
+        metrics.REGISTRY.register_stats("compaction", self.chatbot.compaction_stats)
+        metrics.REGISTRY.register_stats("usage_ledger", self.usage_ledger.stats)
+        metrics.REGISTRY.register_stats("ingest", self.ingest_stats)
+        if self.conversation_scope == "thread":
+            metrics.REGISTRY.register_stats("thread_history", self.thread_history.stats)
+        if self.model_router is not None:
+            metrics.REGISTRY.register_stats("model_router", self.model_router.stats)
+        if self.context_selector is not None:
+            metrics.REGISTRY.register_stats(
+                "context_selector", self.context_selector.stats
+            )
+        for name, pool in self.http_pools.items():
+            metrics.REGISTRY.register_stats(f"http_{name}", pool.stats)
+
+        # per-message trace spans, profile every Nth message, 0 to disable
+        tracing.TRACER.configure(
+            log_traces=trace_log or False,
+            buffer_size=trace_buffer_size or 100,
+            profile_every=profile_every or 0,
+            profile_dir=profile_dir or str(self.base_path / "profiles"),
+        )
+
+        # raw websocket frames for replay, see benchmarks/
+        self.frame_recorder: Optional[FrameRecorder] = None
+        if websocket_record_path:
+            self.frame_recorder = FrameRecorder(
+                websocket_record_path,
+                anonymize=websocket_record_anonymize or False,
+                keep={self.username},
+            )
 
     # close session
     async def close(self, task: asyncio.Task) -> None:
-        await self.httpx_client.aclose()
+        self.closing = True
+        if self.catch_up_task is not None:
+            self.catch_up_task.cancel()
+        await self.scheduler.close()
+        for notice_task in list(self.notice_tasks):
+            notice_task.cancel()
+        await asyncio.gather(*self.notice_tasks, return_exceptions=True)
+        await self.image_queue.close()
+        await self.chatbot.close()
+        if self.conversation_store_task is not None:
+            self.conversation_store_task.cancel()
+        await self.conversation_store.close()
+        if self.usage_ledger_task is not None:
+            self.usage_ledger_task.cancel()
+        await self.usage_ledger.close()
+        for pool in self.http_pools.values():
+            await pool.close()
+        if self.frame_recorder is not None:
+            self.frame_recorder.close()
         self.driver.disconnect()
         task.cancel()
 
+    # import what the first command would otherwise wait for
+    def warm_up(self) -> None:
+        if self.image_generation_endpoint and self.image_generation_backend:
+            importlib.import_module("PIL.Image")
+
     async def login(self) -> None:
         await self.driver.login()
         # get user id
         resp = await self.driver.users.get_user(user_id="me")
         self.bot_id = resp["id"]
+        await self.warm_up_connections()
+
+    # open upstream connections before the first command needs them
+    async def warm_up_connections(self) -> None:
+        image_urls = []
+        if self.image_generation_endpoint and self.image_generation_backend:
+            image_urls.append(self.image_generation_endpoint)
+        await asyncio.gather(
+            self.http_pools["chat"].warm_up(
+                [endpoint.url for endpoint in self.backend_pool.endpoints]
+            ),
+            self.http_pools["image"].warm_up(image_urls),
+            # localai links its images on its own host
+            self.http_pools["download"].warm_up(
+                image_urls if self.image_generation_backend == "localai" else []
+            ),
+        )
 
     async def run(self) -> None:
-        await self.driver.init_websocket(self.websocket_handler)
+        self.conversation_store_task = asyncio.create_task(
+            self.conversation_store.run()
+        )
+        self.usage_ledger_task = asyncio.create_task(self.usage_ledger.run())
+        # init_websocket returns when the connection drops
+        while not self.closing:
+            try:
+                await self.driver.init_websocket(self.websocket_handler)
+            except Exception as e:
+                logger.warning(f"Websocket connection failed: {e}")
+            if self.closing:
+                break
+            self.reconnects += 1
+            delay = self.backoff.next()
+            logger.warning(f"Websocket disconnected, reconnecting in {delay:.1f}s")
+            await asyncio.sleep(delay)
 
     # websocket handler
     async def websocket_handler(self, message) -> None:
-        logger.info(message)
-        response = json.loads(message)
-        if "event" in response:
-            event_type = response["event"]
-            if event_type == "posted":
-                raw_data = response["data"]["post"]
-                raw_data_dict = json.loads(raw_data)
-                user_id = raw_data_dict["user_id"]
-                root_id = (
-                    raw_data_dict["root_id"]
-                    if raw_data_dict["root_id"]
-                    else raw_data_dict["id"]
+        if self.frame_recorder is not None:
+            self.frame_recorder.record(message)
+        # most frames are chatter, only decode posts that can hold a command
+        match = EVENT_PROG.search(message)
+        event_type = match.group(1) if match else None
+        log.log_event(event_type, message)
+        previous_event_at, self.last_event_at = self.last_event_at, time.time()
+        if event_type is None:
+            return
+        if event_type == "hello":
+            self.backoff.reset()
+            if not startup.reported:
+                startup.mark("websocket")
+                startup.report()
+            if self.connected and previous_event_at is not None:
+                # posts made while disconnected were never sent to us
+                self.catch_up_task = asyncio.create_task(
+                    self.catch_up(previous_event_at - self.catch_up_margin)
                 )
-                channel_id = raw_data_dict["channel_id"]
-                sender_name = response["data"]["sender_name"]
-                raw_message = raw_data_dict["message"]
+            self.connected = True
+        metrics.WEBSOCKET_EVENTS.inc(event_type)
+        if event_type != "posted" or "!" not in message:
+            return
 
-                try:
-                    asyncio.create_task(
-                        self.message_callback(
-                            raw_message, channel_id, user_id, sender_name, root_id
-                        )
-                    )
-                except Exception as e:
-                    await self.send_message(channel_id, f"{e}", root_id)
+        decode_start = time.perf_counter()
+        response = json_loads(message)
+        raw_data_dict = json_loads(response["data"]["post"])
+        decode_end = time.perf_counter()
+        await self.handle_post(
+            raw_data_dict, response["data"]["sender_name"], decode_start, decode_end
+        )
+
+    # queue a command post, True if it was queued or answered
+    async def handle_post(
+        self,
+        raw_data_dict: dict,
+        sender_name: str,
+        decode_start: Optional[float] = None,
+        decode_end: Optional[float] = None,
+    ) -> bool:
+        user_id = raw_data_dict["user_id"]
+        # prevent command trigger loop
+        if user_id == self.bot_id:
+            return False
+        raw_message = raw_data_dict["message"]
+        backend = self.get_backend(raw_message)
+        if backend is None or sender_name == self.username:
+            return False
+        # a post caught up over REST may also have arrived on the websocket
+        if not self.seen_posts.add(raw_data_dict["id"]):
+            self.duplicate_posts += 1
+            return False
+        root_id = (
+            raw_data_dict["root_id"]
+            if raw_data_dict["root_id"]
+            else raw_data_dict["id"]
+        )
+        channel_id = raw_data_dict["channel_id"]
+
+        # over quota requests never reach the queue
+        if self.reject_over_quota(backend, channel_id, user_id, root_id):
+            return True
+
+        # the post id correlates every span of this message
+        trace = tracing.new_trace(raw_data_dict["id"], start=decode_start)
+        with tracing.use_trace(trace):
+            if decode_start is not None:
+                trace.add_span("decode", decode_start, decode_end - decode_start)
+            position = self.scheduler.submit(
+                # the turns of a conversation run in order, as in handle_message
+                root_id if self.conversation_scope == "thread" else user_id,
+                backend,
+                partial(
+                    self.message_callback,
+                    raw_message,
+                    channel_id,
+                    user_id,
+                    sender_name,
+                    root_id,
+                    raw_data_dict["id"],
+                ),
+            )
+            if position < 0:
+                self.send_notice(channel_id, scheduler.BUSY_MESSAGE, root_id)
+                tracing.finish_trace()
+            elif position > 0:
+                self.send_notice(
+                    channel_id,
+                    scheduler.QUEUED_MESSAGE.format(position=position),
+                    root_id,
+                )
+        return True
+
+    async def catch_up(self, since: float) -> None:
+        """
+        Queue the commands posted in the bot's channels since a wall clock
+        time, the websocket doesn't replay events missed while it was down
+        """
+        since_ms = int(since * 1000)
+        self.catch_ups += 1
+        try:
+            channel_ids = set()
+            for team in await self.driver.teams.get_user_teams(self.bot_id):
+                channels = await self.driver.channels.get_channels_for_user(
+                    self.bot_id, team["id"]
+                )
+                for channel in channels:
+                    # skip channels without new posts, saves a request each
+                    if channel.get("last_post_at", since_ms) >= since_ms:
+                        channel_ids.add(channel["id"])
+            posts = []
+            for channel_id in channel_ids:
+                resp = await self.driver.posts.get_posts_for_channel(
+                    channel_id, params={"since": since_ms}
+                )
+                posts.extend(resp["posts"].values())
+        except Exception as e:
+            logger.error(f"Could not catch up on missed posts: {e}", exc_info=True)
+            return
+
+        # "since" also returns posts edited or deleted since then
+        posts = [
+            post
+            for post in posts
+            if post["create_at"] >= since_ms
+            and not post.get("delete_at")
+            and not post.get("type")
+        ]
+        posts.sort(key=lambda post: post["create_at"])
+        queued = 0
+        for post in posts:
+            # the bot's own posts are skipped by user id
+            if await self.handle_post(post, ""):
+                queued += 1
+        self.catch_up_posts += len(posts)
+        self.catch_up_commands += queued
+        logger.info(
+            f"Caught up on {len(posts)} posts in {len(channel_ids)} channels, "
+            f"{queued} commands queued"
+        )
+
+    def ingest_stats(self) -> dict:
+        return {
+            "reconnects": self.reconnects,
+            "catch_ups": self.catch_ups,
+            "catch_up_posts": self.catch_up_posts,
+            "catch_up_commands": self.catch_up_commands,
+            "duplicate_posts": self.duplicate_posts,
+            "seen_posts": len(self.seen_posts),
+        }
+
+    # get the scheduler backend a message is limited by, None if not a command
+    def get_backend(self, message: str) -> Optional[str]:
+        return COMMAND_BACKENDS.get(self.get_command(message))
+
+    # get the command name of a message, None if not a command
+    def get_command(self, message: str) -> Optional[str]:
+        return self.parse_command(message)[0]
+
+    # split a message into command name and prompt, (None, None) if not a command
+    def parse_command(self, message: str) -> tuple[Optional[str], Optional[str]]:
+        match = COMMAND_PROG.match(message)
+        if match is None:
+            return None, None
+        command, prompt = match.groups()
+        if prompt is None and command in PROMPT_COMMANDS:
+            return None, None
+        return command, prompt
+
+    # tell the sender when a request is over quota, True if it is
+    def reject_over_quota(
+        self, backend: Optional[str], channel_id: str, user_id: str, root_id: str
+    ) -> bool:
+        if backend is None or backend == "local":
+            return False
+        reason = self.usage_ledger.check(user_id, channel_id, backend)
+        if reason is None:
+            return False
+        self.send_notice(channel_id, reason, root_id)
+        return True
+
+    # rebuild a thread's conversation after an eviction or a restart
+    async def hydrate_thread(self, root_id: str, post_id: Optional[str]) -> None:
+        # a post that starts a thread has no history
+        if (
+            root_id == post_id
+            or await self.chatbot.conversation.load(root_id) is not None
+        ):
+            return
+        with tracing.span("hydrate_thread"):
+            messages, tokens = await self.thread_history.load(
+                root_id, self.bot_id, post_id
+            )
+        # another message of the thread may have been answered meanwhile
+        if root_id not in self.chatbot.conversation:
+            self.chatbot.restore(root_id, messages, tokens)
 
     # message callback
     async def message_callback(
@@ -218,54 +818,108 @@ class Bot:
         user_id: str,
         sender_name: str,
         root_id: str,
+        post_id: Optional[str] = None,
+    ) -> None:
+        start = time.monotonic()
+        command = self.get_command(raw_message)
+        # upstream tokens of this message are charged to the sender
+        usage_ledger.current_account.set((user_id, channel_id))
+        try:
+            # requests answered while this one was queued may have used
+            # up the quota
+            if self.reject_over_quota(
+                self.get_backend(raw_message), channel_id, user_id, root_id
+            ):
+                return
+            await self.handle_message(
+                raw_message, channel_id, user_id, sender_name, root_id, post_id
+            )
+        finally:
+            if command is not None:
+                metrics.COMMAND_LATENCY.observe(time.monotonic() - start, command)
+            tracing.finish_trace()
+
+    # command dispatch
+    async def handle_message(
+        self,
+        raw_message: str,
+        channel_id: str,
+        user_id: str,
+        sender_name: str,
+        root_id: str,
+        post_id: Optional[str] = None,
     ) -> None:
         # prevent command trigger loop
         if sender_name != self.username:
-            message = raw_message
+            command, prompt = self.parse_command(raw_message)
+            convo_id = root_id if self.conversation_scope == "thread" else user_id
 
             if (
                 self.openai_api_key is not None
                 or self.gpt_api_endpoint != "https://api.openai.com/v1/chat/completions"
+                or self.gpt_api_endpoints
             ):
                 # !gpt command trigger handler
-                if self.gpt_prog.match(message):
-                    prompt = self.gpt_prog.match(message).group(1)
+                if command == "gpt":
                     try:
                         # sending typing state
-                        await self.driver.users.publish_user_typing(
-                            self.bot_id,
-                            options={
-                                "channel_id": channel_id,
-                            },
-                        )
-                        response = await self.chatbot.oneTimeAsk(prompt)
-                        await self.send_message(channel_id, f"{response}", root_id)
+                        with tracing.span("publish_user_typing"):
+                            await self.driver.users.publish_user_typing(
+                                self.bot_id,
+                                options={
+                                    "channel_id": channel_id,
+                                },
+                            )
+                        if self.stream_reply:
+                            await self.send_stream_message(
+                                channel_id,
+                                self.chatbot.oneTimeAskStream(prompt, command="gpt"),
+                                root_id,
+                                command="gpt",
+                            )
+                        else:
+                            response = await self.chatbot.oneTimeAsk(
+                                prompt, command="gpt"
+                            )
+                            await self.send_message(channel_id, f"{response}", root_id)
                     except Exception as e:
                         logger.error(e, exc_info=True)
                         raise Exception(e)
 
                 # !chat command trigger handler
-                elif self.chat_prog.match(message):
-                    prompt = self.chat_prog.match(message).group(1)
+                elif command == "chat":
                     try:
                         # sending typing state
-                        await self.driver.users.publish_user_typing(
-                            self.bot_id,
-                            options={
-                                "channel_id": channel_id,
-                            },
-                        )
-                        response = await self.chatbot.ask_async_v2(
-                            prompt=prompt, convo_id=user_id
-                        )
-                        await self.send_message(channel_id, f"{response}", root_id)
+                        with tracing.span("publish_user_typing"):
+                            await self.driver.users.publish_user_typing(
+                                self.bot_id,
+                                options={
+                                    "channel_id": channel_id,
+                                },
+                            )
+                        if self.conversation_scope == "thread":
+                            await self.hydrate_thread(root_id, post_id)
+                        if self.stream_reply:
+                            await self.send_stream_message(
+                                channel_id,
+                                self.chatbot.ask_stream_async(
+                                    prompt=prompt, convo_id=convo_id, command="chat"
+                                ),
+                                root_id,
+                                command="chat",
+                            )
+                        else:
+                            response = await self.chatbot.ask_async_v2(
+                                prompt=prompt, convo_id=convo_id, command="chat"
+                            )
+                            await self.send_message(channel_id, f"{response}", root_id)
                     except Exception as e:
                         logger.error(e, exc_info=True)
                         raise Exception(e)
 
             # !new command trigger handler
-            if self.new_prog.match(message):
-                self.chatbot.reset(convo_id=user_id)
+            if command == "new":
+                self.chatbot.reset(convo_id=convo_id)
                 try:
                     await self.send_message(
                         channel_id,
@@ -279,49 +933,87 @@ class Bot:
 
             # !pic command trigger handler
             if self.image_generation_endpoint and self.image_generation_backend:
-                if self.pic_prog.match(message):
-                    prompt = self.pic_prog.match(message).group(1)
+                if command == "pic":
                     # generate image
                     try:
                         # sending typing state
-                        await self.driver.users.publish_user_typing(
-                            self.bot_id,
-                            options={
-                                "channel_id": channel_id,
-                            },
-                        )
-                        image_path_list = await imagegen.get_images(
-                            self.httpx_client,
-                            self.image_generation_endpoint,
+                        with tracing.span("publish_user_typing"):
+                            await self.driver.users.publish_user_typing(
+                                self.bot_id,
+                                options={
+                                    "channel_id": channel_id,
+                                },
+                            )
+                        settings = {
+                            "size": self.image_generation_size,
+                            "width": self.image_generation_width,
+                            "height": self.image_generation_height,
+                            "steps": self.sdwui_steps,
+                            "sampler_name": self.sdwui_sampler_name,
+                            "cfg_scale": self.sdwui_cfg_scale,
+                            "image_format": self.image_format,
+                        }
+                        if self.image_cache is not None:
+                            key = self.image_cache.make_key(
+                                prompt,
+                                endpoint=self.image_generation_endpoint,
+                                **settings,
+                            )
+                            data = await self.image_cache.get(key, self.image_format)
+                            if data is not None:
+                                await self.send_file(
+                                    channel_id,
+                                    f"{prompt}",
+                                    f"{key}.{self.image_format}",
+                                    data,
+                                    root_id,
+                                )
+                                return
+
+                        job = self.image_queue.submit(
                             prompt,
-                            self.image_generation_backend,
-                            timeount=self.timeout,
                             api_key=self.openai_api_key,
-                            output_path=self.base_path / "images",
-                            n=1,
-                            size=self.image_generation_size,
-                            width=self.image_generation_width,
-                            height=self.image_generation_height,
-                            steps=self.sdwui_steps,
-                            sampler_name=self.sdwui_sampler_name,
-                            cfg_scale=self.sdwui_cfg_scale,
-                            image_format=self.image_format,
+                            **settings,
                         )
+                        position = self.image_queue.position(job)
+                        if position > 0:
+                            await self.send_message(
+                                channel_id,
+                                imagegen.QUEUED_MESSAGE.format(position=position),
+                                root_id,
+                            )
+                        images = await job.future
+                        self.usage_ledger.charge(images=len(images))
+                        if self.image_cache is not None and images:
+                            await self.image_cache.put(
+                                key, self.image_format, images[0][1]
+                            )
                         # send image
-                        for image_path in image_path_list:
+                        for filename, data in images:
                             await self.send_file(
                                 channel_id,
                                 f"{prompt}",
-                                image_path,
+                                filename,
+                                data,
                                 root_id,
                             )
-                            await aiofiles.os.remove(image_path)
                     except Exception as e:
                         logger.error(e, exc_info=True)
                         raise Exception(e)
 
+            # !usage command trigger handler
+            if command == "usage":
+                try:
+                    await self.send_message(
+                        channel_id,
+                        self.usage_ledger.usage(user_id, channel_id),
+                        root_id,
+                    )
+                except Exception as e:
+                    logger.error(e, exc_info=True)
+
             # !help command trigger handler
-            if self.help_prog.match(message):
+            if command == "help":
                 try:
                     await self.send_message(channel_id, self.help(), root_id)
                 except Exception as e:
@@ -329,40 +1021,120 @@ class Bot:
 
     # send message to room
     async def send_message(self, channel_id: str, message: str, root_id: str) -> None:
-        await self.driver.posts.create_post(
-            options={
-                "channel_id": channel_id,
-                "message": message,
-                "root_id": root_id,
-            }
+        with tracing.span("create_post"):
+            await self.driver.posts.create_post(
+                options={
+                    "channel_id": channel_id,
+                    "message": message,
+                    "root_id": root_id,
+                }
+            )
+
+    # post a notice in the background, the websocket handler doesn't wait
+    # for it and a burst of posts doesn't queue behind the REST calls
+    def send_notice(self, channel_id: str, message: str, root_id: str) -> None:
+        # a fresh context keeps it out of the trace of the message
+        task = asyncio.create_task(
+            self.__send_notice(channel_id, message, root_id),
+            context=contextvars.Context(),
         )
+        self.notice_tasks.add(task)
+        task.add_done_callback(self.notice_tasks.discard)
+
+    async def __send_notice(self, channel_id: str, message: str, root_id: str) -> None:
+        try:
+            await self.send_message(channel_id, message, root_id)
+        except Exception as e:
+            logger.error(e, exc_info=True)
+
+    # send streaming response to room
+    async def send_stream_message(
+        self,
+        channel_id: str,
+        stream: AsyncGenerator[str, None],
+        root_id: str,
+        command: str = None,
+    ) -> None:
+        # the post is created on the first token, then patched at most once
+        # per stream_edit_interval with everything received in between
+        start = time.monotonic()
+        first_token = True
+        post_id = None
+        message = ""
+        posted_length = 0
+        last_edit = 0.0
+        async for content in stream:
+            if content and first_token:
+                first_token = False
+                if command is not None:
+                    metrics.TIME_TO_FIRST_TOKEN.observe(
+                        time.monotonic() - start, command
+                    )
+            message += content
+            # roll over into follow-up posts
+            while len(message) > MAX_POST_LENGTH:
+                head = message[:MAX_POST_LENGTH]
+                message = message[MAX_POST_LENGTH:]
+                if post_id is None:
+                    await self.send_message(channel_id, head, root_id)
+                else:
+                    await self.driver.posts.patch_post(
+                        post_id, options={"message": head}
+                    )
+                post_id = None
+                posted_length = 0
+            if not message.strip():
+                continue
+            if post_id is None:
+                with tracing.span("create_post"):
+                    resp = await self.driver.posts.create_post(
+                        options={
+                            "channel_id": channel_id,
+                            "message": message,
+                            "root_id": root_id,
+                        }
+                    )
+                post_id = resp["id"]
+                posted_length = len(message)
+                last_edit = time.monotonic()
+            elif time.monotonic() - last_edit >= self.stream_edit_interval:
+                await self.driver.posts.patch_post(
+                    post_id, options={"message": message}
+                )
+                posted_length = len(message)
+                last_edit = time.monotonic()
+
+        # final edit
+        if post_id is not None and posted_length != len(message):
+            await self.driver.posts.patch_post(post_id, options={"message": message})
 
     # send file to room
     async def send_file(
-        self, channel_id: str, message: str, filepath: str, root_id: str
+        self, channel_id: str, message: str, filename: str, data: bytes, root_id: str
     ) -> None:
-        filename = os.path.split(filepath)[-1]
         try:
-            file_id = await self.driver.files.upload_file(
-                channel_id=channel_id,
-                files={
-                    "files": (filename, open(filepath, "rb")),
-                },
-            )
+            with tracing.span("upload_file", bytes=len(data)):
+                file_id = await self.driver.files.upload_file(
+                    channel_id=channel_id,
+                    files={
+                        "files": (filename, data),
+                    },
+                )
             file_id = file_id["file_infos"][0]["id"]
         except Exception as e:
             logger.error(e, exc_info=True)
             raise Exception(e)
 
         try:
-            await self.driver.posts.create_post(
-                options={
-                    "channel_id": channel_id,
-                    "message": message,
-                    "file_ids": [file_id],
-                    "root_id": root_id,
-                }
-            )
+            with tracing.span("create_post"):
+                await self.driver.posts.create_post(
+                    options={
+                        "channel_id": channel_id,
+                        "message": message,
+                        "file_ids": [file_id],
+                        "root_id": root_id,
+                    }
+                )
 
         except Exception as e:
             logger.error(e, exc_info=True)
@@ -375,6 +1147,7 @@ class Bot:
             + "!chat [content], chat with context conversation\n"
             + "!pic [prompt], Image generation with DALL·E or LocalAI or stable-diffusion-webui\n"  # noqa: E501
             + "!new, start a new conversation\n"
+            + "!usage, your and this channel's recent token and image usage\n"
             + "!help, help message"
         )
         return help_info
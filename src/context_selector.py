@@ -0,0 +1,226 @@
+"""
+Retrieval-based context selection for long conversations
+
+Instead of sending the whole (FIFO-truncated) history, send the system
+prompt, the most recent messages and the older messages most similar to
+the prompt, within a token budget. Messages are embedded once, either
+with a local hashing vectorizer or an OpenAI-compatible embeddings
+endpoint, and kept in a matrix per conversation.
+"""
+import itertools
+import re
+import zlib
+from collections import OrderedDict
+from typing import Optional
+import httpx
+import numpy as np
+from conversation_store import Conversation, Message
+from log import getlogger
+
+logger = getlogger()
+
+WORD_PROG = re.compile(r"\w+")
+
+
+class HashingVectorizer:
+    """
+    Signed feature hashing of words and word pairs, needs no model
+    """
+
+    def __init__(self, dim: int = 1024) -> None:
+        self.dim = dim
+
+    def transform(self, texts: list[str]) -> np.ndarray:
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = WORD_PROG.findall(text.lower())
+            bigrams = map(" ".join, zip(words, words[1:]))
+            for feature in itertools.chain(words, bigrams):
+                # crc32 is stable across processes, hash() is not
+                h = zlib.crc32(feature.encode("utf-8"))
+                matrix[row, h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        return normalize(matrix)
+
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        return self.transform(texts)
+
+
+class EmbeddingsClient:
+    """
+    OpenAI-compatible /v1/embeddings endpoint
+    """
+
+    def __init__(
+        self,
+        aclient: httpx.AsyncClient,
+        url: str,
+        api_key: Optional[str] = None,
+        model: str = "text-embedding-ada-002",
+    ) -> None:
+        self.aclient = aclient
+        self.url = url
+        self.api_key = api_key
+        self.model = model
+
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        response = await self.aclient.post(
+            self.url,
+            headers={"Authorization": f"Bearer {self.api_key}"},
+            # empty input is rejected
+            json={"model": self.model, "input": [text or " " for text in texts]},
+        )
+        if response.status_code != 200:
+            raise Exception(
+                f"{response.status_code} {response.reason_phrase} {response.text}"
+            )
+        data = sorted(response.json()["data"], key=lambda item: item["index"])
+        return normalize(np.array([item["embedding"] for item in data], np.float32))
+
+
+def normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class ConversationIndex:
+    """
+    Embeddings of a conversation's messages after the system prompt,
+    row i belongs to messages[i]
+    """
+
+    __slots__ = ("messages", "matrix")
+
+    def __init__(self) -> None:
+        self.messages: list[Message] = []
+        self.matrix: Optional[np.ndarray] = None
+
+
+class ContextSelector:
+    def __init__(
+        self,
+        embedder,
+        token_budget: int = 2000,
+        recent_messages: int = 6,
+        top_m: int = 4,
+        max_conversations: int = 256,
+    ) -> None:
+        # HashingVectorizer or EmbeddingsClient
+        self.embedder = embedder
+        # prompt tokens sent per request, including the system prompt
+        self.token_budget = token_budget
+        self.recent_messages = recent_messages
+        self.top_m = top_m
+        self.max_conversations = max_conversations
+
+        # convo_id -> index, least recently used first
+        self.indexes: OrderedDict[str, ConversationIndex] = OrderedDict()
+
+        # statistics
+        self.selections = 0
+        self.retrieved_messages = 0
+        self.dropped_messages = 0
+        self.tokens_sent = 0
+        self.tokens_history = 0
+        self.embed_errors = 0
+
+    async def __matrix(self, convo_id: str, history: list[Message]) -> np.ndarray:
+        """
+        Embed the messages not indexed yet, return the rows of history
+        """
+        index = self.indexes.pop(convo_id, None)
+        if index is not None and index.messages and history:
+            # truncation drops the oldest messages, find where history starts
+            start = next(
+                (i for i, m in enumerate(index.messages) if m is history[0]), None
+            )
+            if start is None:
+                index = None
+            else:
+                index.messages = index.messages[start:]
+                index.matrix = index.matrix[start:]
+                if len(index.messages) > len(history) or any(
+                    a is not b for a, b in zip(index.messages, history)
+                ):
+                    # reset or reloaded
+                    index = None
+        if index is None:
+            index = ConversationIndex()
+
+        new = history[len(index.messages) :]
+        if new:
+            vectors = await self.embedder.embed([m.content for m in new])
+            index.matrix = (
+                vectors if index.matrix is None else np.vstack((index.matrix, vectors))
+            )
+            index.messages.extend(new)
+
+        self.indexes[convo_id] = index
+        while len(self.indexes) > self.max_conversations:
+            self.indexes.popitem(last=False)
+        return index.matrix
+
+    async def select(
+        self, convo_id: str, conversation: Conversation
+    ) -> tuple[list[Message], int]:
+        """
+        Get the messages to send and their token count
+        """
+        # the conversation may be compacted while the embeddings are awaited
+        messages = list(conversation.messages)
+        tokens = [message.tokens for message in messages]
+        token_total = sum(tokens)
+        if token_total <= self.token_budget:
+            return messages, token_total
+
+        budget = self.token_budget - tokens[0]
+        # newest first, the prompt is always sent
+        recent = []
+        i = len(messages) - 1
+        while i >= 1 and len(recent) < self.recent_messages:
+            if recent and tokens[i] > budget:
+                break
+            budget -= tokens[i]
+            recent.append(i)
+            i -= 1
+
+        # messages[1:i + 1] are candidates for retrieval
+        retrieved = []
+        if i >= 1 and self.top_m > 0 and budget > 0:
+            try:
+                matrix = await self.__matrix(convo_id, messages[1:])
+            except Exception as e:
+                self.embed_errors += 1
+                logger.warning(f"Could not embed conversation {convo_id}: {e}")
+            else:
+                # similarity of every candidate to the prompt
+                scores = matrix[:i] @ matrix[len(messages) - 2]
+                for row in np.argsort(-scores, kind="stable"):
+                    if len(retrieved) >= self.top_m or scores[row] <= 0:
+                        break
+                    if tokens[row + 1] <= budget:
+                        budget -= tokens[row + 1]
+                        retrieved.append(row + 1)
+
+        selected = [0] + sorted(retrieved) + recent[::-1]
+        token_count = sum(tokens[j] for j in selected)
+        self.selections += 1
+        self.retrieved_messages += len(retrieved)
+        self.dropped_messages += len(messages) - len(selected)
+        self.tokens_sent += token_count
+        self.tokens_history += token_total
+        return [messages[j] for j in selected], token_count
+
+    def forget(self, convo_id: str) -> None:
+        self.indexes.pop(convo_id, None)
+
+    def stats(self) -> dict:
+        return {
+            "conversations": len(self.indexes),
+            "selections": self.selections,
+            "retrieved_messages": self.retrieved_messages,
+            "dropped_messages": self.dropped_messages,
+            "tokens_sent": self.tokens_sent,
+            "tokens_history": self.tokens_history,
+            "embed_errors": self.embed_errors,
+        }
@@ -0,0 +1,364 @@
+"""
+Memory-bounded conversation store with optional SQLite persistence
+
+Conversations live in an in-memory LRU bounded by a TTL and a global token
+budget. When a database path is given, changed conversations are written
+behind to SQLite (WAL) in a worker thread and evicted or cold conversations
+are rehydrated lazily by load(), also in a worker thread. Conversations
+with a request in flight are pinned and never evicted.
+
+Messages are kept as the JSON they are sent as, so a request body is
+joined from the fragments of its messages instead of encoding them again.
+"""
+import asyncio
+import json
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+from log import getlogger
+
+logger = getlogger()
+
+try:
+    import orjson
+
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:
+
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+    json_loads = json.loads
+
+
+class Message:
+    """
+    A message as its {"role", "content"} JSON fragment and its token count
+    """
+
+    __slots__ = ("role", "tokens", "fragment")
+
+    def __init__(self, role: str, content: str, tokens: int = 0) -> None:
+        # there are only a few roles, every message shares their strings
+        self.role: str = sys.intern(role)
+        self.tokens: int = tokens
+        # not orjson, it over-allocates what it returns and this is kept
+        self.fragment: bytes = json.dumps(
+            {"role": role, "content": content},
+            ensure_ascii=False,
+            separators=(",", ":"),
+        ).encode()
+
+    @property
+    def content(self) -> str:
+        return json_loads(self.fragment)["content"]
+
+
+class Conversation:
+    """
+    Messages of a conversation with their cached token counts
+    """
+
+    __slots__ = ("messages", "token_total")
+
+    def __init__(self, messages: list[Message] = None) -> None:
+        self.messages: list[Message] = messages or []
+        self.token_total: int = sum(message.tokens for message in self.messages)
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    @property
+    def tokens(self) -> list[int]:
+        """
+        Token count of every message, index aligned with self.messages
+        """
+        return [message.tokens for message in self.messages]
+
+    def append(self, message: Message) -> None:
+        self.messages.append(message)
+        self.token_total += message.tokens
+
+    def pop(self, index: int = -1) -> Message:
+        message = self.messages.pop(index)
+        self.token_total -= message.tokens
+        return message
+
+    def replace(self, start: int, end: int, message: Message) -> None:
+        """
+        Replace messages[start:end] with a single message, in a new list
+        so that readers of the old one don't see it change
+        """
+        self.token_total += message.tokens - sum(
+            m.tokens for m in self.messages[start:end]
+        )
+        self.messages = self.messages[:start] + [message] + self.messages[end:]
+
+    def dumps(self) -> str:
+        # {"messages": [{"role", "content"}], "tokens": [...]}
+        return (
+            b'{"messages":['
+            + b",".join(message.fragment for message in self.messages)
+            + b'],"tokens":'
+            + json_dumps(self.tokens)
+            + b"}"
+        ).decode()
+
+    @classmethod
+    def loads(cls, data: str) -> "Conversation":
+        data = json_loads(data)
+        return cls(
+            [
+                Message(message["role"], message["content"], num_tokens)
+                for message, num_tokens in zip(data["messages"], data["tokens"])
+            ]
+        )
+
+
+class ConversationStore:
+    def __init__(
+        self,
+        ttl: Optional[float] = None,
+        token_budget: Optional[int] = None,
+        db_path: Optional[str] = None,
+        flush_interval: float = 5.0,
+    ) -> None:
+        # seconds since last access before a conversation is evicted
+        self.ttl = ttl
+        # total tokens kept in memory across all conversations
+        self.token_budget = token_budget
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+
+        # convo_id -> (conversation, last access, accounted tokens),
+        # least recently used first
+        self.cache: OrderedDict[str, tuple[Conversation, float, int]] = OrderedDict()
+        self.resident_tokens = 0
+        # conversations changed since the last flush
+        self.dirty: dict[str, Conversation] = {}
+        # conversations being written by flush(), until the write commits
+        self.flushing: dict[str, Conversation] = {}
+        # convo_id -> requests in flight, these are never evicted
+        self.pinned: dict[str, int] = {}
+
+        # statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.db: Optional[sqlite3.Connection] = None
+        self.db_lock = threading.Lock()
+        if db_path:
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS conversations "
+                "(convo_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL)"
+            )
+            self.db.commit()
+
+    def __contains__(self, convo_id: str) -> bool:
+        return self.get(convo_id) is not None
+
+    def __getitem__(self, convo_id: str) -> Conversation:
+        conversation = self.get(convo_id)
+        if conversation is None:
+            raise KeyError(convo_id)
+        return conversation
+
+    def __setitem__(self, convo_id: str, conversation: Conversation) -> None:
+        """
+        Insert or update a conversation, call again after mutating it
+        """
+        self.__remove(convo_id)
+        self.__insert(convo_id, conversation)
+        if self.db is not None:
+            self.dirty[convo_id] = conversation
+        self.__evict(keep=convo_id)
+
+    def __delitem__(self, convo_id: str) -> None:
+        self.__remove(convo_id)
+        self.dirty.pop(convo_id, None)
+        self.flushing.pop(convo_id, None)
+        if self.db is not None:
+            with self.db_lock:
+                self.db.execute(
+                    "DELETE FROM conversations WHERE convo_id = ?", (convo_id,)
+                )
+                self.db.commit()
+
+    def pin(self, convo_id: str) -> None:
+        """
+        Keep a conversation in memory until unpin(), e.g. while a request
+        that will add to it is in flight
+        """
+        self.pinned[convo_id] = self.pinned.get(convo_id, 0) + 1
+
+    def unpin(self, convo_id: str) -> None:
+        count = self.pinned.pop(convo_id) - 1
+        if count > 0:
+            self.pinned[convo_id] = count
+
+    def get(self, convo_id: str) -> Optional[Conversation]:
+        """
+        Get a conversation that is in memory, see load() for the database
+        """
+        conversation = self.__lookup(convo_id)
+        if conversation is None:
+            self.misses += 1
+        return conversation
+
+    async def load(self, convo_id: str) -> Optional[Conversation]:
+        """
+        Get a conversation, rehydrating it from the database on a miss
+        """
+        conversation = self.__lookup(convo_id)
+        if conversation is not None:
+            return conversation
+        self.misses += 1
+        if self.db is None:
+            return None
+
+        # the flush worker holds db_lock while writing, wait for it off the loop
+        try:
+            conversation = await asyncio.to_thread(self.__load, convo_id)
+        except Exception as e:
+            logger.error(e, exc_info=True)
+            return None
+        # it may have been created meanwhile, that one is newer
+        current = self.__lookup(convo_id)
+        if current is not None:
+            return current
+        if conversation is not None:
+            self.__insert(convo_id, conversation)
+            self.__evict(keep=convo_id)
+        return conversation
+
+    def __lookup(self, convo_id: str) -> Optional[Conversation]:
+        """
+        Get a conversation from the cache or the unwritten changes
+        """
+        self.__evict()
+        if convo_id in self.cache:
+            self.hits += 1
+            conversation, _, num_tokens = self.cache.pop(convo_id)
+            self.cache[convo_id] = (conversation, time.monotonic(), num_tokens)
+            return conversation
+
+        conversation = self.dirty.get(convo_id)
+        if conversation is None:
+            conversation = self.flushing.get(convo_id)
+        if conversation is not None:
+            self.__insert(convo_id, conversation)
+            self.__evict(keep=convo_id)
+        return conversation
+
+    def __load(self, convo_id: str) -> Optional[Conversation]:
+        with self.db_lock:
+            if self.db is None:
+                return None
+            row = self.db.execute(
+                "SELECT data FROM conversations WHERE convo_id = ?", (convo_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return Conversation.loads(row[0])
+
+    def __insert(self, convo_id: str, conversation: Conversation) -> None:
+        num_tokens = conversation.token_total
+        self.cache[convo_id] = (conversation, time.monotonic(), num_tokens)
+        self.resident_tokens += num_tokens
+
+    def __remove(self, convo_id: str) -> None:
+        if convo_id in self.cache:
+            _, _, num_tokens = self.cache.pop(convo_id)
+            self.resident_tokens -= num_tokens
+
+    def __evict(self, keep: str = None) -> None:
+        """
+        Evict expired conversations and the least recently used ones
+        until the token budget is met
+        """
+        now = time.monotonic()
+        resident_tokens = self.resident_tokens
+        evicted = []
+        for convo_id, (_, last_access, num_tokens) in self.cache.items():
+            expired = self.ttl is not None and now - last_access > self.ttl
+            over_budget = (
+                self.token_budget is not None and resident_tokens > self.token_budget
+            )
+            if not expired and not over_budget:
+                break
+            if convo_id == keep or convo_id in self.pinned:
+                continue
+            evicted.append(convo_id)
+            resident_tokens -= num_tokens
+        for convo_id in evicted:
+            # dirty conversations stay in self.dirty until they are flushed
+            self.__remove(convo_id)
+            self.evictions += 1
+
+    def __write(self, items: list[tuple[str, str]]) -> None:
+        now = time.time()
+        with self.db_lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO conversations (convo_id, data, updated_at) "
+                "VALUES (?, ?, ?)",
+                [(convo_id, data, now) for convo_id, data in items],
+            )
+            self.db.commit()
+
+    async def flush(self) -> None:
+        """
+        Write changed conversations to the database
+        """
+        if self.db is None or not self.dirty:
+            return
+        dirty, self.dirty = self.dirty, {}
+        # the database has the old rows until the write commits, load()
+        # finds these meanwhile
+        self.flushing = dirty
+        # serialize on the event loop so the worker never sees a half-updated list
+        items = [(convo_id, c.dumps()) for convo_id, c in dirty.items()]
+        try:
+            await asyncio.to_thread(self.__write, items)
+        except Exception as e:
+            logger.error(e, exc_info=True)
+            # keep newer changes, retry the rest on the next flush
+            self.dirty = dirty | self.dirty
+        finally:
+            self.flushing = {}
+
+    async def run(self) -> None:
+        """
+        Flush changed conversations periodically
+        """
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def close(self) -> None:
+        await self.flush()
+        if self.db is not None:
+            with self.db_lock:
+                self.db.close()
+                self.db = None
+
+    def stats(self) -> dict:
+        """
+        Get cache statistics
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "resident_conversations": len(self.cache),
+            "resident_tokens": self.resident_tokens,
+            "dirty": len(self.dirty),
+            "pinned": len(self.pinned),
+        }
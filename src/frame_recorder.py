@@ -0,0 +1,154 @@
+"""
+Record raw websocket frames for later replay
+
+Recordings are gzipped JSON lines of [seconds since the first frame, frame].
+Anonymized recordings replace ids and names with salted hashes and the
+words of messages with stand-in words, keeping the command, the length
+and the repetition of words so the tokenizer sees similar input.
+"""
+import gzip
+import hashlib
+import json
+import os
+import re
+import time
+from typing import Iterator
+from log import getlogger
+
+logger = getlogger()
+
+# keys whose string values identify someone or something
+NAME_KEYS = {
+    "sender_name",
+    "channel_name",
+    "channel_display_name",
+    "name",
+    "display_name",
+    "username",
+    "nickname",
+    "first_name",
+    "last_name",
+    "email",
+    "token",
+}
+# keys whose string values are free text
+TEXT_KEYS = {"message", "hashtags", "header", "purpose"}
+# keys whose values are ids or lists of ids, besides id, *_id and *_ids
+ID_KEYS = {"mentions", "followers"}
+# keys whose string values are JSON encoded inside the event
+JSON_KEYS = {"post", "mentions", "followers"}
+# keys of objects keyed by user id
+ID_MAP_KEYS = {"omit_users"}
+# keys of objects that are dropped, post props carry webhook and override
+# names, user props custom statuses
+DROP_KEYS = {"props"}
+
+VOCABULARY = (
+    "the of and to in is you that it he was for on are as with his they at be "
+    "this have from or one had by word but not what all were we when your can "
+    "said there use an each which she do how their if will up other about out "
+    "many then them these so some her would make like him into time has look"
+).split()
+
+COMMAND_PATTERN = re.compile(r"^\s*!\w+")
+WORD_PATTERN = re.compile(r"\w+")
+
+
+class FrameRecorder:
+    def __init__(self, path: str, anonymize: bool = False, keep: set = None) -> None:
+        self.path = path
+        self.anonymize = anonymize
+        # values left as they are, like the bot's own username
+        self.keep = keep or set()
+        self.salt = os.urandom(16)
+        self.file = gzip.open(path, "at", encoding="utf-8")
+        self.start = None
+        self.frames = 0
+
+    def record(self, frame: str) -> None:
+        now = time.monotonic()
+        if self.start is None:
+            self.start = now
+        if self.anonymize:
+            frame = self.anonymize_frame(frame)
+        self.file.write(json.dumps([round(now - self.start, 6), frame]) + "\n")
+        self.frames += 1
+
+    def hash(self, value: str) -> str:
+        if value in self.keep:
+            return value
+        return hashlib.sha256(self.salt + value.encode("utf-8")).hexdigest()[:26]
+
+    def scramble(self, text: str) -> str:
+        """
+        Swap every word for a stand-in word, keep a leading command
+        """
+        match = COMMAND_PATTERN.match(text)
+        prefix = match.group(0) if match else ""
+
+        def replace(word: re.Match) -> str:
+            digest = hashlib.sha256(self.salt + word.group(0).encode("utf-8")).digest()
+            return VOCABULARY[digest[0] % len(VOCABULARY)]
+
+        return prefix + WORD_PATTERN.sub(replace, text[len(prefix) :])
+
+    def anonymize_value(self, key: str, value):
+        if key in DROP_KEYS and isinstance(value, dict):
+            return {}
+        if key in ID_MAP_KEYS and isinstance(value, dict):
+            return {self.hash(k): v for k, v in value.items()}
+        if isinstance(value, dict):
+            return {k: self.anonymize_value(k, v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self.anonymize_value(key, v) for v in value]
+        if not isinstance(value, str) or not value:
+            return value
+        if key in JSON_KEYS and value[0] in "[{":
+            try:
+                decoded = json.loads(value)
+            except ValueError:
+                decoded = None
+            if isinstance(decoded, (dict, list)):
+                return json.dumps(self.anonymize_value(key, decoded))
+        if key in TEXT_KEYS:
+            return self.scramble(value)
+        if key == "id" or key in ID_KEYS or key.endswith("_id") or key.endswith("_ids"):
+            return self.hash(value)
+        if key in NAME_KEYS:
+            prefix = "@" if value.startswith("@") else ""
+            return prefix + self.hash(value.lstrip("@"))[:12]
+        return value
+
+    def anonymize_frame(self, frame: str) -> str:
+        try:
+            data = json.loads(frame)
+        except ValueError:
+            return frame
+        return json.dumps(self.anonymize_value("", data))
+
+    def close(self) -> None:
+        try:
+            self.file.close()
+        except OSError as e:
+            logger.error(e, exc_info=True)
+        logger.info(f"Recorded {self.frames} websocket frames to {self.path}")
+
+
+def read_frames(path: str) -> Iterator[tuple[float, str]]:
+    """
+    Read a recording, yield (seconds since the first frame, frame)
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                offset, frame = json.loads(line)
+                yield offset, frame
+
+
+def write_frames(path: str, frames: Iterator[tuple[float, str]]) -> None:
+    """
+    Write (seconds since the first frame, frame) pairs as a recording
+    """
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        for offset, frame in frames:
+            f.write(json.dumps([round(offset, 6), frame]) + "\n")
@@ -2,12 +2,29 @@
 Code derived from https://github.com/acheong08/ChatGPT/blob/main/src/revChatGPT/V3.py
 A simple wrapper for the official ChatGPT API
 """
+import asyncio
+import contextvars
+import hashlib
 import json
-from typing import AsyncGenerator
-from tenacity import retry, wait_random_exponential, stop_after_attempt
+import time
+from functools import partial
+from typing import TYPE_CHECKING, AsyncGenerator, Optional
 import httpx
 import tiktoken
+from backend_pool import BackendPool, Endpoint, UpstreamError
+from conversation_store import Conversation, ConversationStore, Message, json_dumps
+from response_cache import ResponseCache
+from rate_limiter import RateLimiter
+from log import getlogger
+import metrics
+import tracing
 
+if TYPE_CHECKING:
+    from context_selector import ContextSelector
+    from model_router import ModelRouter
+    from usage_ledger import UsageLedger
+
+logger = getlogger()
 
 ENGINES = [
     "gpt-3.5-turbo",
@@ -20,6 +37,24 @@ ENGINES = [
     "gpt-4-32k-0613",
 ]
 
+ENCODING = "cl100k_base"
+
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+SUMMARY_PROMPT = (
+    "Summarize the following conversation between a user and an assistant. "
+    "Keep names, facts, decisions and open questions, and be concise.\n\n"
+)
+
+
+def encode_payload(payload: dict) -> bytes:
+    """
+    Encode a request body, joining the fragments of its messages
+    """
+    fields = {key: value for key, value in payload.items() if key != "messages"}
+    body = json_dumps(fields)
+    messages = b",".join(message.fragment for message in payload["messages"])
+    return body[:-1] + (b"," if fields else b"") + b'"messages":[' + messages + b"]}"
+
 
 class Chatbot:
     """
@@ -41,6 +76,17 @@ class Chatbot:
         reply_count: int = 1,
         truncate_limit: int = None,
         system_prompt: str = None,
+        conversation_store: ConversationStore = None,
+        response_cache: ResponseCache = None,
+        backend_pool: BackendPool = None,
+        rate_limiter: RateLimiter = None,
+        context_selector: "ContextSelector" = None,
+        model_router: "ModelRouter" = None,
+        usage_ledger: "UsageLedger" = None,
+        compact_threshold: int = None,
+        compact_model: str = None,
+        compact_keep_messages: int = 4,
+        compact_summary_tokens: int = 300,
     ) -> None:
         """
         Initialize Chatbot with API key (from https://platform.openai.com/account/api-keys)
@@ -76,18 +122,44 @@ class Chatbot:
         self.presence_penalty: float = presence_penalty
         self.frequency_penalty: float = frequency_penalty
         self.reply_count: int = reply_count
-        self.timeout: float = timeout
+        # None leaves it to the client
+        self.timeout = timeout if timeout is not None else httpx.USE_CLIENT_DEFAULT
 
         self.aclient = aclient
+        self.response_cache = response_cache
+        self.pool: BackendPool = backend_pool or BackendPool(
+            [Endpoint(self.api_url, self.api_key)]
+        )
+        self.rate_limiter = rate_limiter
+        # send relevant history instead of all of it, needs numpy
+        self.context_selector = context_selector
+        # pick the model per request instead of always using engine
+        self.model_router = model_router
+        # charges upstream tokens to the user and channel asking
+        self.usage_ledger = usage_ledger
 
-        self.conversation: dict[str, list[dict]] = {
-            "default": [
-                {
-                    "role": "system",
-                    "content": system_prompt,
-                },
-            ],
-        }
+        # summarize the oldest messages once a conversation grows past
+        # compact_threshold tokens, None to disable
+        self.compact_threshold = compact_threshold
+        self.compact_model: str = compact_model or "gpt-3.5-turbo"
+        self.compact_keep_messages = compact_keep_messages
+        self.compact_summary_tokens = compact_summary_tokens
+        # convo_id -> running compaction
+        self.compactions: dict[str, asyncio.Task] = {}
+        # statistics
+        self.compacted = 0
+        self.compact_failures = 0
+        self.compact_stale = 0
+        self.compact_tokens_before = 0
+        self.compact_tokens_after = 0
+        self.compact_summary_cost = 0
+
+        # every supported engine uses the gpt-3.5-turbo encoding, unknown ones
+        # are counted with it too, tiktoken keeps it loaded for the process
+        self.encoding = tiktoken.get_encoding(ENCODING)
+
+        self.conversation: ConversationStore = conversation_store or ConversationStore()
+        self.reset(convo_id="default", system_prompt=system_prompt)
 
         if self.get_token_count("default") > self.max_tokens:
             raise Exception("System prompt is too long")
@@ -97,50 +169,64 @@ class Chatbot:
         message: str,
         role: str,
         convo_id: str = "default",
+        conversation: Optional[Conversation] = None,
     ) -> None:
         """
-        Add a message to the conversation
+        Add a message to the conversation, or to the one a request started
+        with, the stored history is never replaced by a fresh one
         """
-        self.conversation[convo_id].append({"role": role, "content": message})
+        message = self.new_message(role, message)
+        if conversation is None:
+            conversation = self.conversation[convo_id]
+        conversation.append(message)
+        self.conversation[convo_id] = conversation
 
     def __truncate_conversation(self, convo_id: str = "default") -> None:
         """
         Truncate the conversation
         """
+        conversation = self.conversation[convo_id]
         while True:
             if (
-                self.get_token_count(convo_id) > self.truncate_limit
-                and len(self.conversation[convo_id]) > 1
+                conversation.token_total + 5 > self.truncate_limit
+                and len(conversation) > 1
             ):
                 # Don't remove the first message
-                self.conversation[convo_id].pop(1)
+                conversation.pop(1)
             else:
                 break
+        self.conversation[convo_id] = conversation
 
     # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+    def get_message_token_count(self, message: dict) -> int:
+        """
+        Get token count of a single message
+        """
+        # every message follows <im_start>{role/name}\n{content}<im_end>\n
+        num_tokens = 5
+        for key, value in message.items():
+            if value:
+                num_tokens += len(self.encoding.encode(value))
+            if key == "name":  # if there's a name, the role is omitted
+                num_tokens += 5  # role is always required and always 1 token
+        return num_tokens
+
+    def new_message(self, role: str, content: str) -> Message:
+        """
+        Create a message with its token count
+        """
+        return Message(
+            role,
+            content,
+            self.get_message_token_count({"role": role, "content": content}),
+        )
+
     def get_token_count(self, convo_id: str = "default") -> int:
         """
         Get token count
         """
-        _engine = self.engine
-        if self.engine not in ENGINES:
-            # use gpt-3.5-turbo to caculate token
-            _engine = "gpt-3.5-turbo"
-        tiktoken.model.MODEL_TO_ENCODING["gpt-4"] = "cl100k_base"
-
-        encoding = tiktoken.encoding_for_model(_engine)
-
-        num_tokens = 0
-        for message in self.conversation[convo_id]:
-            # every message follows <im_start>{role/name}\n{content}<im_end>\n
-            num_tokens += 5
-            for key, value in message.items():
-                if value:
-                    num_tokens += len(encoding.encode(value))
-                if key == "name":  # if there's a name, the role is omitted
-                    num_tokens += 5  # role is always required and always 1 token
-        num_tokens += 5  # every reply is primed with <im_start>assistant
-        return num_tokens
+        # every reply is primed with <im_start>assistant
+        return self.conversation[convo_id].token_total + 5
 
     def get_max_tokens(self, convo_id: str) -> int:
         """
@@ -148,6 +234,30 @@ class Chatbot:
         """
         return self.max_tokens - self.get_token_count(convo_id)
 
+    async def __context(self, convo_id: str) -> tuple[list[Message], int]:
+        """
+        Get the messages to send and their prompt token count
+        """
+        conversation = self.conversation[convo_id]
+        if self.context_selector is None:
+            return conversation.messages, conversation.token_total + 5
+        with tracing.span("select_context"):
+            messages, token_count = await self.context_selector.select(
+                convo_id, conversation
+            )
+        return messages, token_count + 5
+
+    def __route(
+        self, model: Optional[str], command: Optional[str], prompt_tokens: int
+    ) -> tuple[str, int]:
+        """
+        Get the model to ask and its context window
+        """
+        if model is not None or self.model_router is None:
+            return model or self.engine, self.max_tokens
+        tier = self.model_router.route(command, prompt_tokens)
+        return tier.model, tier.max_tokens
+
     async def ask_stream_async(
         self,
         prompt: str,
@@ -155,77 +265,333 @@ class Chatbot:
         convo_id: str = "default",
         model: str = None,
         pass_history: bool = True,
+        command: str = None,
         **kwargs,
     ) -> AsyncGenerator[str, None]:
         """
         Ask a question
         """
-        # Make conversation if it doesn't exist
-        if convo_id not in self.conversation:
-            self.reset(convo_id=convo_id, system_prompt=self.system_prompt)
-        self.add_to_conversation(prompt, "user", convo_id=convo_id)
-        self.__truncate_conversation(convo_id=convo_id)
-        # Get response
-        async with self.aclient.stream(
-            "post",
-            self.api_url,
-            headers={"Authorization": f"Bearer {kwargs.get('api_key', self.api_key)}"},
-            json={
-                "model": model or self.engine,
-                "messages": self.conversation[convo_id] if pass_history else [prompt],
-                "stream": True,
-                # kwargs
-                "temperature": kwargs.get("temperature", self.temperature),
-                "top_p": kwargs.get("top_p", self.top_p),
-                "presence_penalty": kwargs.get(
-                    "presence_penalty",
-                    self.presence_penalty,
-                ),
-                "frequency_penalty": kwargs.get(
-                    "frequency_penalty",
-                    self.frequency_penalty,
-                ),
-                "n": kwargs.get("n", self.reply_count),
-                "user": role,
-                "max_tokens": min(
-                    self.get_max_tokens(convo_id=convo_id),
-                    kwargs.get("max_tokens", self.max_tokens),
-                ),
-            },
-            timeout=kwargs.get("timeout", self.timeout),
-        ) as response:
-            if response.status_code != 200:
-                await response.aread()
-                raise Exception(
-                    f"{response.status_code} {response.reason_phrase} {response.text}",
+        # evicting it meanwhile would lose the history the reply is added to
+        self.conversation.pin(convo_id)
+        try:
+            # Make conversation if it doesn't exist
+            conversation = await self.__start(convo_id)
+            with tracing.span("truncate"):
+                self.add_to_conversation(
+                    prompt, "user", convo_id=convo_id, conversation=conversation
                 )
-
+                self.__truncate_conversation(convo_id=convo_id)
+            messages, prompt_tokens = await self.__context(convo_id)
+            model, window = self.__route(model, command, prompt_tokens)
+            # Get response
             response_role: str = ""
             full_response: str = ""
-            async for line in response.aiter_lines():
-                line = line.strip()
-                if not line:
-                    continue
-                # Remove "data: "
-                line = line[6:]
-                if line == "[DONE]":
-                    break
-                resp: dict = json.loads(line)
-                if "error" in resp:
-                    raise Exception(f"{resp['error']}")
-                choices = resp.get("choices")
-                if not choices:
-                    continue
-                delta: dict[str, str] = choices[0].get("delta")
-                if not delta:
-                    continue
+            async for delta in self.__post_stream(
+                {
+                    "model": model or self.engine,
+                    "messages": messages if pass_history else messages[-1:],
+                    "stream": True,
+                    # kwargs
+                    "temperature": kwargs.get("temperature", self.temperature),
+                    "top_p": kwargs.get("top_p", self.top_p),
+                    "presence_penalty": kwargs.get(
+                        "presence_penalty",
+                        self.presence_penalty,
+                    ),
+                    "frequency_penalty": kwargs.get(
+                        "frequency_penalty",
+                        self.frequency_penalty,
+                    ),
+                    "n": kwargs.get("n", self.reply_count),
+                    "user": role,
+                    "max_tokens": min(
+                        window - prompt_tokens,
+                        kwargs.get("max_tokens", self.max_tokens),
+                    ),
+                },
+                prompt_tokens=prompt_tokens,
+                **kwargs,
+            ):
                 if "role" in delta:
                     response_role = delta["role"]
                 if "content" in delta:
                     content: str = delta["content"]
                     full_response += content
                     yield content
-        self.add_to_conversation(full_response, response_role, convo_id=convo_id)
+            self.add_to_conversation(
+                full_response,
+                response_role,
+                convo_id=convo_id,
+                conversation=conversation,
+            )
+            self.__schedule_compaction(convo_id)
+        finally:
+            self.conversation.unpin(convo_id)
+
+    async def __aiter_deltas(
+        self, response: httpx.Response
+    ) -> AsyncGenerator[dict[str, str], None]:
+        """
+        Parse server-sent events of a streaming completion into deltas
+        """
+        async for line in response.aiter_lines():
+            line = line.strip()
+            if not line:
+                continue
+            # Remove "data: "
+            line = line[6:]
+            if line == "[DONE]":
+                break
+            resp: dict = json.loads(line)
+            if "error" in resp:
+                raise Exception(f"{resp['error']}")
+            choices = resp.get("choices")
+            if not choices:
+                continue
+            delta: dict[str, str] = choices[0].get("delta")
+            if not delta:
+                continue
+            yield delta
+
+    def __headers(self, endpoint: Endpoint, **kwargs) -> dict[str, str]:
+        return {
+            "Authorization": f"Bearer {kwargs.get('api_key', endpoint.api_key)}",
+            "Content-Type": "application/json",
+        }
+
+    def __rate_limit_key(self, endpoint: Endpoint, **kwargs) -> str:
+        # limits apply per api key, don't keep the key itself around
+        api_key = kwargs.get("api_key", endpoint.api_key) or ""
+        return f"{endpoint.url}#{hashlib.sha256(api_key.encode()).hexdigest()[:8]}"
+
+    async def __admit(self, endpoint: Endpoint, cost: int, **kwargs) -> None:
+        """
+        Wait for rate limit budget of the endpoint
+        """
+        if self.rate_limiter is not None:
+            await self.rate_limiter.acquire(
+                self.__rate_limit_key(endpoint, **kwargs), cost
+            )
+
+    def __sync_rate_limit(
+        self, endpoint: Endpoint, response: httpx.Response, **kwargs
+    ) -> None:
+        if self.rate_limiter is not None:
+            self.rate_limiter.update(
+                self.__rate_limit_key(endpoint, **kwargs), response.headers
+            )
+
+    def __request_cost(self, payload: dict, prompt_tokens: int) -> int:
+        """
+        Tokens a request counts against the limit: prompt plus max_tokens
+        """
+        return prompt_tokens + payload.get(
+            "max_tokens", max(self.max_tokens - prompt_tokens, 0)
+        )
+
+    async def __post_once(
+        self, endpoint: Endpoint, payload: dict, body: bytes, cost: int, **kwargs
+    ) -> dict:
+        await self.__admit(endpoint, cost, **kwargs)
+        try:
+            response = await self.aclient.post(
+                url=endpoint.url,
+                headers=self.__headers(endpoint, **kwargs),
+                content=body,
+                timeout=kwargs.get("timeout", self.timeout),
+            )
+        except httpx.TransportError:
+            metrics.UPSTREAM_RESPONSES.inc(endpoint.url, "error")
+            raise
+        metrics.UPSTREAM_RESPONSES.inc(endpoint.url, str(response.status_code))
+        self.__sync_rate_limit(endpoint, response, **kwargs)
+        if response.status_code != 200:
+            raise UpstreamError(
+                response.status_code,
+                f"{response.status_code} {response.reason_phrase} {response.text}",
+            )
+        resp = response.json()
+        usage = resp.get("usage") or {}
+        metrics.PROMPT_TOKENS.inc(
+            payload["model"], amount=usage.get("prompt_tokens", 0)
+        )
+        metrics.COMPLETION_TOKENS.inc(
+            payload["model"], amount=usage.get("completion_tokens", 0)
+        )
+        if self.usage_ledger is not None:
+            self.usage_ledger.charge(
+                usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+            )
+        return resp
+
+    async def __open_stream(
+        self, endpoint: Endpoint, body: bytes, cost: int, **kwargs
+    ) -> httpx.Response:
+        await self.__admit(endpoint, cost, **kwargs)
+        request = self.aclient.build_request(
+            "post",
+            endpoint.url,
+            headers=self.__headers(endpoint, **kwargs),
+            content=body,
+            timeout=kwargs.get("timeout", self.timeout),
+        )
+        try:
+            response = await self.aclient.send(request, stream=True)
+        except httpx.TransportError:
+            metrics.UPSTREAM_RESPONSES.inc(endpoint.url, "error")
+            raise
+        metrics.UPSTREAM_RESPONSES.inc(endpoint.url, str(response.status_code))
+        self.__sync_rate_limit(endpoint, response, **kwargs)
+        if response.status_code != 200:
+            await response.aread()
+            await response.aclose()
+            raise UpstreamError(
+                response.status_code,
+                f"{response.status_code} {response.reason_phrase} {response.text}",
+            )
+        return response
+
+    async def __post(self, payload: dict, prompt_tokens: int, **kwargs) -> dict:
+        """
+        Post a completion request through the backend pool
+        """
+        cost = self.__request_cost(payload, prompt_tokens)
+        # encoded once for every attempt and hedge
+        body = encode_payload(payload)
+        start = time.perf_counter()
+        with tracing.span("upstream", model=payload["model"]):
+            resp = await self.pool.request(
+                partial(
+                    self.__post_once, payload=payload, body=body, cost=cost, **kwargs
+                )
+            )
+        metrics.UPSTREAM_LATENCY.observe(time.perf_counter() - start, payload["model"])
+        return resp
+
+    async def __post_stream(
+        self, payload: dict, prompt_tokens: int, **kwargs
+    ) -> AsyncGenerator[dict[str, str], None]:
+        """
+        Post a streaming completion request through the backend pool,
+        failures are retried until the response starts
+        """
+        cost = self.__request_cost(payload, prompt_tokens)
+        body = encode_payload(payload)
+        request_start = time.perf_counter()
+        with tracing.span("upstream", model=payload["model"]):
+            response = await self.pool.request(
+                partial(self.__open_stream, body=body, cost=cost, **kwargs),
+                hedge=False,
+            )
+        # streaming responses carry no usage, count it ourselves
+        metrics.PROMPT_TOKENS.inc(payload["model"], amount=prompt_tokens)
+        completion: str = ""
+        start = time.perf_counter()
+        try:
+            async for delta in self.__aiter_deltas(response):
+                completion += delta.get("content") or ""
+                yield delta
+        finally:
+            await response.aclose()
+            # includes the time the consumer spent between deltas
+            tracing.record_span("upstream_stream", time.perf_counter() - start)
+            metrics.UPSTREAM_LATENCY.observe(
+                time.perf_counter() - request_start, payload["model"]
+            )
+            completion_tokens = len(self.encoding.encode(completion))
+            metrics.COMPLETION_TOKENS.inc(payload["model"], amount=completion_tokens)
+            if self.usage_ledger is not None:
+                self.usage_ledger.charge(prompt_tokens, completion_tokens)
+
+    def __schedule_compaction(self, convo_id: str) -> None:
+        """
+        Compact the conversation in the background if it grew too long
+        """
+        if self.compact_threshold is None or convo_id in self.compactions:
+            return
+        conversation = self.conversation.get(convo_id)
+        if conversation is None or conversation.token_total <= self.compact_threshold:
+            return
+        # a fresh context keeps it out of the trace of the current message
+        task = asyncio.create_task(
+            self.__compact(convo_id, conversation), context=contextvars.Context()
+        )
+        self.compactions[convo_id] = task
+        task.add_done_callback(lambda _: self.compactions.pop(convo_id, None))
+
+    async def __compact(self, convo_id: str, conversation: Conversation) -> None:
+        """
+        Replace all but the last compact_keep_messages messages after the
+        system prompt with a summary of them
+        """
+        end = len(conversation) - self.compact_keep_messages
+        if end < 3:
+            return
+        span = conversation.messages[1:end]
+        span_tokens = sum(message.tokens for message in span)
+        if span_tokens < 2 * self.compact_summary_tokens:
+            # the summary would hardly be shorter
+            return
+        transcript = "\n".join(f"{m.role}: {m.content}" for m in span)
+        message = self.new_message("user", SUMMARY_PROMPT + transcript)
+        prompt_tokens = message.tokens + 5
+        try:
+            resp = await self.__post(
+                {
+                    "model": self.compact_model,
+                    "messages": [message],
+                    "temperature": 0,
+                    "max_tokens": self.compact_summary_tokens,
+                },
+                prompt_tokens=prompt_tokens,
+            )
+        except Exception as e:
+            self.compact_failures += 1
+            logger.warning(f"Could not compact conversation {convo_id}: {e}")
+            return
+        summary = self.new_message(
+            "system", SUMMARY_PREFIX + resp["choices"][0]["message"]["content"]
+        )
+        self.compact_summary_cost += (resp.get("usage") or {}).get(
+            "total_tokens", prompt_tokens
+        )
+
+        # the conversation went on meanwhile, only swap the span if it is
+        # still where it was
+        if (
+            self.conversation.get(convo_id) is not conversation
+            or len(conversation) < end
+            or any(a is not b for a, b in zip(conversation.messages[1:end], span))
+        ):
+            self.compact_stale += 1
+            return
+        tokens_before = conversation.token_total
+        conversation.replace(1, end, summary)
+        self.conversation[convo_id] = conversation
+        self.compacted += 1
+        self.compact_tokens_before += tokens_before
+        self.compact_tokens_after += conversation.token_total
+        logger.info(
+            f"Compacted conversation {convo_id}: {len(span)} messages of "
+            f"{span_tokens} tokens, {tokens_before} -> "
+            f"{conversation.token_total} tokens"
+        )
+
+    def compaction_stats(self) -> dict:
+        return {
+            "running": len(self.compactions),
+            "compacted": self.compacted,
+            "failures": self.compact_failures,
+            "stale": self.compact_stale,
+            "tokens_before": self.compact_tokens_before,
+            "tokens_after": self.compact_tokens_after,
+            "summary_cost": self.compact_summary_cost,
+        }
+
+    async def close(self) -> None:
+        for task in list(self.compactions.values()):
+            task.cancel()
+        await asyncio.gather(*self.compactions.values(), return_exceptions=True)
 
     async def ask_async(
         self,
@@ -234,6 +600,7 @@ class Chatbot:
         convo_id: str = "default",
         model: str = None,
         pass_history: bool = True,
+        command: str = None,
         **kwargs,
     ) -> str:
         """
@@ -245,6 +612,7 @@ class Chatbot:
             convo_id=convo_id,
             model=model,
             pass_history=pass_history,
+            command=command,
             **kwargs,
         )
         full_response: str = "".join([r async for r in response])
@@ -257,20 +625,160 @@ class Chatbot:
         convo_id: str = "default",
         model: str = None,
         pass_history: bool = True,
+        command: str = None,
         **kwargs,
     ) -> str:
-        # Make conversation if it doesn't exist
-        if convo_id not in self.conversation:
+        # evicting it meanwhile would lose the history the reply is added to
+        self.conversation.pin(convo_id)
+        try:
+            # Make conversation if it doesn't exist
+            conversation = await self.__start(convo_id)
+            with tracing.span("truncate"):
+                self.add_to_conversation(
+                    prompt, "user", convo_id=convo_id, conversation=conversation
+                )
+                self.__truncate_conversation(convo_id=convo_id)
+            messages, prompt_tokens = await self.__context(convo_id)
+            model, window = self.__route(model, command, prompt_tokens)
+            # Get response
+            resp = await self.__post(
+                {
+                    "model": model or self.engine,
+                    "messages": messages if pass_history else messages[-1:],
+                    # kwargs
+                    "temperature": kwargs.get("temperature", self.temperature),
+                    "top_p": kwargs.get("top_p", self.top_p),
+                    "presence_penalty": kwargs.get(
+                        "presence_penalty",
+                        self.presence_penalty,
+                    ),
+                    "frequency_penalty": kwargs.get(
+                        "frequency_penalty",
+                        self.frequency_penalty,
+                    ),
+                    "n": kwargs.get("n", self.reply_count),
+                    "user": role,
+                    "max_tokens": min(
+                        window - prompt_tokens,
+                        kwargs.get("max_tokens", self.max_tokens),
+                    ),
+                },
+                prompt_tokens=prompt_tokens,
+                **kwargs,
+            )
+            full_response = resp["choices"][0]["message"]["content"]
+            self.add_to_conversation(
+                full_response,
+                resp["choices"][0]["message"]["role"],
+                convo_id=convo_id,
+                conversation=conversation,
+            )
+            self.__schedule_compaction(convo_id)
+            return full_response
+        finally:
+            self.conversation.unpin(convo_id)
+
+    async def __start(self, convo_id: str) -> Conversation:
+        """
+        Get the conversation a request adds to, make it if it doesn't exist
+        """
+        conversation = await self.conversation.load(convo_id)
+        if conversation is None:
             self.reset(convo_id=convo_id, system_prompt=self.system_prompt)
-        self.add_to_conversation(prompt, "user", convo_id=convo_id)
+            conversation = self.conversation[convo_id]
+        return conversation
+
+    def reset(self, convo_id: str = "default", system_prompt: str = None) -> None:
+        """
+        Reset the conversation
+        """
+        message = self.new_message("system", system_prompt or self.system_prompt)
+        if self.context_selector is not None:
+            self.context_selector.forget(convo_id)
+        self.conversation[convo_id] = Conversation([message])
+
+    def restore(self, convo_id: str, messages: list[dict], tokens: list[int]) -> None:
+        """
+        Start a conversation from earlier messages and their token counts
+        """
+        self.reset(convo_id=convo_id)
+        conversation = self.conversation[convo_id]
+        for message, num_tokens in zip(messages, tokens):
+            conversation.append(
+                Message(message["role"], message["content"], num_tokens)
+            )
+        self.conversation[convo_id] = conversation
         self.__truncate_conversation(convo_id=convo_id)
-        # Get response
-        response = await self.aclient.post(
-            url=self.api_url,
-            headers={"Authorization": f"Bearer {kwargs.get('api_key', self.api_key)}"},
-            json={
+
+    def __route_prompt(
+        self, prompt: str, role: str, model: Optional[str], command: Optional[str]
+    ) -> str:
+        """
+        Get the model to ask a single prompt
+        """
+        if model is not None or self.model_router is None:
+            return model or self.engine
+        message = self.new_message(role, prompt)
+        # every reply is primed with <im_start>assistant
+        prompt_tokens = message.tokens + 5
+        return self.__route(model, command, prompt_tokens)[0]
+
+    def __cache_key(
+        self, prompt: str, role: str, model: str, **kwargs
+    ) -> Optional[tuple]:
+        """
+        Get the response cache key of a one time ask, None if not cacheable
+        """
+        if self.response_cache is None:
+            return None
+        return self.response_cache.make_key(
+            prompt,
+            role,
+            model or self.engine,
+            kwargs.get("temperature", self.temperature),
+            kwargs.get("top_p", self.top_p),
+            kwargs.get("presence_penalty", self.presence_penalty),
+            kwargs.get("frequency_penalty", self.frequency_penalty),
+        )
+
+    async def oneTimeAsk(
+        self,
+        prompt: str,
+        role: str = "user",
+        model: str = None,
+        command: str = None,
+        **kwargs,
+    ) -> str:
+        """
+        Ask without context conversation
+        """
+        model = self.__route_prompt(prompt, role, model, command)
+        key = self.__cache_key(prompt, role, model, **kwargs)
+        if key is None:
+            response, _ = await self.__one_time_ask(prompt, role, model, **kwargs)
+            return response
+        # identical concurrent prompts share one upstream call
+        return await self.response_cache.get_or_fetch(
+            key, partial(self.__one_time_ask, prompt, role, model, **kwargs)
+        )
+
+    async def __one_time_ask(
+        self,
+        prompt: str,
+        role: str = "user",
+        model: str = None,
+        **kwargs,
+    ) -> tuple[str, int]:
+        """
+        Return the response and the total tokens it cost
+        """
+        message = self.new_message(role, prompt)
+        # every reply is primed with <im_start>assistant
+        prompt_tokens = message.tokens + 5
+        resp = await self.__post(
+            {
                 "model": model or self.engine,
-                "messages": self.conversation[convo_id] if pass_history else [prompt],
+                "messages": [message],
                 # kwargs
                 "temperature": kwargs.get("temperature", self.temperature),
                 "top_p": kwargs.get("top_p", self.top_p),
@@ -282,48 +790,64 @@ class Chatbot:
                     "frequency_penalty",
                     self.frequency_penalty,
                 ),
-                "n": kwargs.get("n", self.reply_count),
                 "user": role,
-                "max_tokens": min(
-                    self.get_max_tokens(convo_id=convo_id),
-                    kwargs.get("max_tokens", self.max_tokens),
-                ),
             },
-            timeout=kwargs.get("timeout", self.timeout),
-        )
-        resp = response.json()
-        full_response = resp["choices"][0]["message"]["content"]
-        self.add_to_conversation(
-            full_response, resp["choices"][0]["message"]["role"], convo_id=convo_id
+            prompt_tokens=prompt_tokens,
+            **kwargs,
         )
-        return full_response
+        usage = resp.get("usage") or {}
+        return resp["choices"][0]["message"]["content"], usage.get("total_tokens", 0)
 
-    def reset(self, convo_id: str = "default", system_prompt: str = None) -> None:
+    async def oneTimeAskStream(
+        self,
+        prompt: str,
+        role: str = "user",
+        model: str = None,
+        command: str = None,
+        **kwargs,
+    ) -> AsyncGenerator[str, None]:
         """
-        Reset the conversation
+        Streaming ask without context conversation
         """
-        self.conversation[convo_id] = [
-            {"role": "system", "content": system_prompt or self.system_prompt},
-        ]
+        model = self.__route_prompt(prompt, role, model, command)
+        key = self.__cache_key(prompt, role, model, **kwargs)
+        message = self.new_message(role, prompt)
+        fetch = partial(self.__one_time_ask_stream, message, role, model, **kwargs)
+        if key is None:
+            async for content in fetch():
+                yield content
+            return
 
-    @retry(wait=wait_random_exponential(min=2, max=5), stop=stop_after_attempt(3))
-    async def oneTimeAsk(
+        def count_tokens(response: str) -> int:
+            # streaming responses carry no usage, count it ourselves
+            return (
+                message.tokens
+                + 5
+                + self.get_message_token_count(
+                    {"role": "assistant", "content": response}
+                )
+            )
+
+        # identical concurrent prompts share one upstream stream
+        async for content in self.response_cache.stream_or_fetch(
+            key, fetch, count_tokens
+        ):
+            yield content
+
+    async def __one_time_ask_stream(
         self,
-        prompt: str,
+        message: Message,
         role: str = "user",
         model: str = None,
         **kwargs,
-    ) -> str:
-        response = await self.aclient.post(
-            url=self.api_url,
-            json={
+    ) -> AsyncGenerator[str, None]:
+        # every reply is primed with <im_start>assistant
+        prompt_tokens = message.tokens + 5
+        async for delta in self.__post_stream(
+            {
                 "model": model or self.engine,
-                "messages": [
-                    {
-                        "role": role,
-                        "content": prompt,
-                    }
-                ],
+                "messages": [message],
+                "stream": True,
                 # kwargs
                 "temperature": kwargs.get("temperature", self.temperature),
                 "top_p": kwargs.get("top_p", self.top_p),
@@ -337,8 +861,8 @@ class Chatbot:
                 ),
                 "user": role,
             },
-            headers={"Authorization": f"Bearer {kwargs.get('api_key', self.api_key)}"},
-            timeout=kwargs.get("timeout", self.timeout),
-        )
-        resp = response.json()
-        return resp["choices"][0]["message"]["content"]
+            prompt_tokens=prompt_tokens,
+            **kwargs,
+        ):
+            if "content" in delta:
+                yield delta["content"]
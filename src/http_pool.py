@@ -0,0 +1,210 @@
+"""
+One httpx client per upstream, each with its own connection pool and
+timeouts so that a slow upstream only ever waits on its own connections
+"""
+import asyncio
+import urllib.request
+from typing import AsyncIterator, Callable, Optional
+from urllib.parse import urlsplit
+import httpx
+from log import getlogger
+
+logger = getlogger()
+
+# settings an upstream pool accepts, see HttpPool
+POOL_SETTINGS = {
+    "max_connections",
+    "max_keepalive_connections",
+    "keepalive_expiry",
+    "http2",
+    "connect_timeout",
+    "read_timeout",
+    "prewarm",
+}
+
+
+def origin(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}/"
+
+
+def proxy_mounts(
+    make_transport: Callable[..., httpx.AsyncBaseTransport]
+) -> dict[str, Optional[httpx.AsyncBaseTransport]]:
+    """
+    Transports for the proxies set in the environment, httpx only reads
+    them itself when it builds the transport
+    """
+    proxies = urllib.request.getproxies()
+    no_proxy = [host.strip() for host in proxies.get("no", "").split(",")]
+    if "*" in no_proxy:
+        return {}
+    mounts: dict[str, Optional[httpx.AsyncBaseTransport]] = {}
+    for scheme in ("http", "https"):
+        url = proxies.get(scheme) or proxies.get("all")
+        if url:
+            mounts[f"{scheme}://"] = make_transport(proxy=url)
+    if mounts:
+        for host in no_proxy:
+            if host:
+                # None is the client's own transport
+                mounts[f"all://*{host.lstrip('.')}"] = None
+    return mounts
+
+
+class CountedStream(httpx.AsyncByteStream):
+    """
+    A response body that ends its request in CountingTransport when closed
+    """
+
+    def __init__(
+        self, stream: httpx.AsyncByteStream, transport: "CountingTransport"
+    ) -> None:
+        self.stream = stream
+        self.transport = transport
+        self.closed = False
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        if not self.closed:
+            self.closed = True
+            self.transport.active -= 1
+            await self.stream.aclose()
+
+
+class CountingTransport(httpx.AsyncBaseTransport):
+    """
+    Count the requests in flight, a request holds its connection until
+    its response is closed
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport) -> None:
+        self.transport = transport
+        self.active = 0
+        self.peak = 0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException:
+            self.active -= 1
+            raise
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=CountedStream(response.stream, self),
+            extensions=response.extensions,
+        )
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+class HttpPool:
+    def __init__(
+        self,
+        name: str,
+        max_connections: int = 10,
+        max_keepalive_connections: int = 5,
+        keepalive_expiry: float = 30.0,
+        http2: bool = False,
+        connect_timeout: float = 10.0,
+        read_timeout: float = 120.0,
+        prewarm: int = 1,
+    ) -> None:
+        self.name = name
+        self.max_connections = max_connections
+        # connections opened per url at login
+        self.prewarm = prewarm
+
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning(f"h2 is not installed, {name} pool uses HTTP/1.1")
+                http2 = False
+
+        limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+
+        def make_transport(**kwargs) -> CountingTransport:
+            return CountingTransport(
+                httpx.AsyncHTTPTransport(http2=http2, limits=limits, **kwargs)
+            )
+
+        self.transports = [make_transport()]
+        mounts = proxy_mounts(make_transport)
+        self.transports.extend(t for t in mounts.values() if t is not None)
+        self.client = httpx.AsyncClient(
+            transport=self.transports[0],
+            mounts=mounts,
+            # waiting for a free connection counts against the read timeout
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            event_hooks={"request": [self.__count_request]},
+        )
+
+        # statistics
+        self.requests = 0
+        self.warmed = 0
+        self.warm_failures = 0
+
+    async def __count_request(self, request: httpx.Request) -> None:
+        self.requests += 1
+
+    async def __warm(self, url: str) -> None:
+        try:
+            await self.client.head(url)
+            self.warmed += 1
+        except httpx.HTTPError as e:
+            self.warm_failures += 1
+            logger.warning(f"Could not pre-warm {self.name} connection to {url}: {e}")
+
+    async def warm_up(self, urls: list[str]) -> None:
+        """
+        Open prewarm keep-alive connections to the origin of each url
+        """
+        origins = {origin(url) for url in urls if url}
+        await asyncio.gather(
+            *(self.__warm(url) for url in origins for _ in range(self.prewarm))
+        )
+
+    def stats(self) -> dict:
+        return {
+            "max_connections": self.max_connections,
+            # each in flight request holds a connection
+            "active_requests": sum(t.active for t in self.transports),
+            "peak_requests": max(t.peak for t in self.transports),
+            "requests": self.requests,
+            "warmed": self.warmed,
+            "warm_failures": self.warm_failures,
+        }
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+
+def make_pools(
+    defaults: dict[str, dict], overrides: Optional[dict[str, dict]] = None
+) -> dict[str, HttpPool]:
+    """
+    Build the named pools from defaults updated with overrides
+    """
+    overrides = overrides or {}
+    for name, settings in overrides.items():
+        if name not in defaults:
+            raise ValueError(f"unknown http pool {name}")
+        unknown = set(settings) - POOL_SETTINGS
+        if unknown:
+            raise ValueError(f"unknown {name} http pool settings {sorted(unknown)}")
+    return {
+        name: HttpPool(name, **{**settings, **overrides.get(name, {})})
+        for name, settings in defaults.items()
+    }
@@ -0,0 +1,118 @@
+"""
+Content-addressed cache of generated images on disk
+"""
+import asyncio
+import hashlib
+import json
+import os
+import re
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+from log import getlogger
+
+logger = getlogger()
+
+# names of the files the cache writes, anything else in its directory is
+# left alone
+FILENAME_PATTERN = re.compile(r"^[0-9a-f]{64}\.(jpeg|png)$")
+
+
+class ImageCache:
+    def __init__(self, directory: Path, max_bytes: int) -> None:
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        # filename -> size in bytes, least recently used first
+        self.index: OrderedDict[str, int] = OrderedDict()
+        self.size = 0
+
+        # statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # rebuild the index from a previous run, oldest access first
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and FILENAME_PATTERN.match(entry.name):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, filename, size in sorted(entries):
+            self.index[filename] = size
+            self.size += size
+        self.__evict()
+
+    @staticmethod
+    def make_key(prompt: str, **kwargs) -> str:
+        """
+        Hash a prompt and its generation settings into a cache key
+        """
+        data = json.dumps([prompt, kwargs], sort_keys=True, default=str)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    async def get(self, key: str, image_format: str) -> Optional[bytes]:
+        """
+        Get cached image data
+        """
+        filename = f"{key}.{image_format}"
+        if filename not in self.index:
+            self.misses += 1
+            return None
+        try:
+            data = await asyncio.to_thread(self.__read, filename)
+        except OSError as e:
+            logger.error(e, exc_info=True)
+            self.size -= self.index.pop(filename)
+            self.misses += 1
+            return None
+        self.index.move_to_end(filename)
+        self.hits += 1
+        return data
+
+    async def put(self, key: str, image_format: str, data: bytes) -> None:
+        """
+        Cache image data, evicting least recently used images over budget
+        """
+        filename = f"{key}.{image_format}"
+        try:
+            await asyncio.to_thread(self.__write, filename, data)
+        except OSError as e:
+            logger.error(e, exc_info=True)
+            return
+        self.size -= self.index.pop(filename, 0)
+        self.index[filename] = len(data)
+        self.size += len(data)
+        self.__evict()
+
+    def __read(self, filename: str) -> bytes:
+        path = self.directory / filename
+        # mtime records the last access for the index of the next run
+        os.utime(path)
+        return path.read_bytes()
+
+    def __write(self, filename: str, data: bytes) -> None:
+        path = self.directory / filename
+        tmp_path = path.with_suffix(path.suffix + ".tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+
+    def __evict(self) -> None:
+        while self.index and self.size > self.max_bytes:
+            filename, size = self.index.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            try:
+                os.remove(self.directory / filename)
+            except OSError as e:
+                logger.error(e, exc_info=True)
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "images": len(self.index),
+            "bytes": self.size,
+        }
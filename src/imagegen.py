@@ -1,9 +1,25 @@
+import asyncio
+import contextvars
+from collections import deque
+from typing import Optional
 import httpx
-from pathlib import Path
 import uuid
 import base64
 import io
-from PIL import Image
+import metrics
+import tracing
+
+# leading bytes of the image formats we can output
+MAGIC_NUMBERS = {
+    "jpeg": b"\xff\xd8\xff",
+    "png": b"\x89PNG\r\n\x1a\n",
+}
+
+# backends that can generate several images of one prompt in a single call
+BATCH_BACKENDS = ["sdwui"]
+
+# notice for image jobs that have to wait
+QUEUED_MESSAGE = "Image generation is busy, your request is queued at position {position}"  # noqa: E501
 
 
 async def get_images(
@@ -11,10 +27,14 @@ async def get_images(
     url: str,
     prompt: str,
     backend_type: str,
-    output_path: str,
+    download_client: Optional[httpx.AsyncClient] = None,
     **kwargs,
-) -> list[str]:
-    timeout = kwargs.get("timeout", 180.0)
+) -> list[tuple[str, bytes]]:
+    """
+    Generate images, return a list of (filename, image data),
+    images given as a url are fetched with download_client
+    """
+    timeout = kwargs.get("timeout", httpx.USE_CLIENT_DEFAULT)
     if backend_type == "openai":
         resp = await aclient.post(
             url,
@@ -30,11 +50,13 @@ async def get_images(
             },
             timeout=timeout,
         )
+        metrics.UPSTREAM_RESPONSES.inc(url, str(resp.status_code))
         if resp.status_code == 200:
             b64_datas = []
             for data in resp.json()["data"]:
                 b64_datas.append(data["b64_json"])
-            return save_images_b64(b64_datas, output_path, **kwargs)
+            with tracing.span("image_decode"):
+                return await asyncio.to_thread(decode_images_b64, b64_datas, **kwargs)
         else:
             raise Exception(
                 f"{resp.status_code} {resp.reason_phrase} {resp.text}",
@@ -56,9 +78,11 @@ async def get_images(
             },
             timeout=timeout,
         )
+        metrics.UPSTREAM_RESPONSES.inc(url, str(resp.status_code))
         if resp.status_code == 200:
             b64_datas = resp.json()["images"]
-            return save_images_b64(b64_datas, output_path, **kwargs)
+            with tracing.span("image_decode"):
+                return await asyncio.to_thread(decode_images_b64, b64_datas, **kwargs)
         else:
             raise Exception(
                 f"{resp.status_code} {resp.reason_phrase} {resp.text}",
@@ -76,31 +100,174 @@ async def get_images(
             },
             timeout=timeout,
         )
+        metrics.UPSTREAM_RESPONSES.inc(url, str(resp.status_code))
         if resp.status_code == 200:
             image_url = resp.json()["data"][0]["url"]
-            return await save_image_url(image_url, aclient, output_path, **kwargs)
+            return await download_image_url(
+                image_url, download_client or aclient, **kwargs
+            )
+        else:
+            raise Exception(
+                f"{resp.status_code} {resp.reason_phrase} {resp.text}",
+            )
+
+
+def convert_image(data: bytes, image_format: str) -> bytes:
+    """
+    Re-encode image data into image_format unless it already is
+    """
+    if data.startswith(MAGIC_NUMBERS[image_format]):
+        return data
+    # PIL is only needed when image generation is enabled
+    from PIL import Image
+
+    img = Image.open(io.BytesIO(data))
+    if image_format == "jpeg" and img.mode not in ("RGB", "L"):
+        # jpeg has no alpha channel
+        img = img.convert("RGB")
+    output = io.BytesIO()
+    img.save(output, format=image_format)
+    return output.getvalue()
 
 
-def save_images_b64(b64_datas: list[str], path: Path, **kwargs) -> list[str]:
-    images_path_list = []
+def decode_images_b64(b64_datas: list[str], **kwargs) -> list[tuple[str, bytes]]:
+    """
+    Decode base64 images, CPU bound, run it in a worker thread
+    """
+    image_format = kwargs.get("image_format", "jpeg")
+    images = []
     for b64_data in b64_datas:
-        image_path = path / (
-            str(uuid.uuid4()) + "." + kwargs.get("image_format", "jpeg")
-        )
-        img = Image.open(io.BytesIO(base64.decodebytes(bytes(b64_data, "utf-8"))))
-        img.save(image_path)
-        images_path_list.append(image_path)
-    return images_path_list
+        data = convert_image(base64.b64decode(b64_data), image_format)
+        images.append((str(uuid.uuid4()) + "." + image_format, data))
+    return images
 
 
-async def save_image_url(
-    url: str, aclient: httpx.AsyncClient, path: Path, **kwargs
-) -> list[str]:
-    images_path_list = []
+async def download_image_url(
+    url: str, aclient: httpx.AsyncClient, **kwargs
+) -> list[tuple[str, bytes]]:
+    image_format = kwargs.get("image_format", "jpeg")
+    images = []
     r = await aclient.get(url)
-    image_path = path / (str(uuid.uuid4()) + "." + kwargs.get("image_format", "jpeg"))
     if r.status_code == 200:
-        img = Image.open(io.BytesIO(r.content))
-        img.save(image_path)
-        images_path_list.append(image_path)
-    return images_path_list
+        with tracing.span("image_decode"):
+            data = await asyncio.to_thread(convert_image, r.content, image_format)
+        images.append((str(uuid.uuid4()) + "." + image_format, data))
+    return images
+
+
+class ImageJob:
+    __slots__ = ("prompt", "kwargs", "key", "future", "context")
+
+    def __init__(self, prompt: str, **kwargs) -> None:
+        self.prompt = prompt
+        self.kwargs = kwargs
+        # jobs with the same key can share one batched call
+        self.key = (prompt, tuple(sorted(kwargs.items())))
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        # a batch is traced as part of its first job
+        self.context = contextvars.copy_context()
+
+
+class ImageQueue:
+    """
+    Image generation job queue with a concurrency limit per backend,
+    queued jobs with identical prompt and settings are batched together
+    """
+
+    def __init__(
+        self,
+        aclient: httpx.AsyncClient,
+        url: str,
+        backend_type: str,
+        concurrency: int = 1,
+        max_batch_size: int = 4,
+        download_client: Optional[httpx.AsyncClient] = None,
+    ) -> None:
+        self.aclient = aclient
+        self.download_client = download_client
+        self.url = url
+        self.backend_type = backend_type
+        self.concurrency = concurrency
+        self.max_batch_size = max_batch_size if backend_type in BATCH_BACKENDS else 1
+
+        self.pending: deque[ImageJob] = deque()
+        self.running = 0
+        self.tasks: set[asyncio.Task] = set()
+
+        # statistics
+        self.batches = 0
+        self.batched_jobs = 0
+
+    def submit(self, prompt: str, **kwargs) -> ImageJob:
+        """
+        Queue a job, await job.future for its list of (filename, image data)
+        """
+        job = ImageJob(prompt, **kwargs)
+        self.pending.append(job)
+        self.__dispatch()
+        return job
+
+    def position(self, job: ImageJob) -> int:
+        """
+        Get the queue position of a job, 0 if it is already running
+        """
+        try:
+            return self.pending.index(job) + 1
+        except ValueError:
+            return 0
+
+    def __dispatch(self) -> None:
+        while self.running < self.concurrency and self.pending:
+            job = self.pending.popleft()
+            batch = [job]
+            for other in list(self.pending):
+                if len(batch) >= self.max_batch_size:
+                    break
+                if other.key == job.key:
+                    self.pending.remove(other)
+                    batch.append(other)
+
+            self.running += 1
+            task = asyncio.create_task(self.__run(batch), context=job.context)
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def __run(self, batch: list[ImageJob]) -> None:
+        try:
+            with tracing.span("image_generation", batch=len(batch)):
+                images = await get_images(
+                    self.aclient,
+                    self.url,
+                    batch[0].prompt,
+                    self.backend_type,
+                    download_client=self.download_client,
+                    **{**batch[0].kwargs, "n": len(batch)},
+                )
+            self.batches += 1
+            self.batched_jobs += len(batch)
+            for i, job in enumerate(batch):
+                if not job.future.done():
+                    job.future.set_result(images[i : i + 1])
+        except Exception as e:
+            for job in batch:
+                if not job.future.done():
+                    job.future.set_exception(e)
+        finally:
+            self.running -= 1
+            self.__dispatch()
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": len(self.pending),
+            "running": self.running,
+            "batches": self.batches,
+            "batched_jobs": self.batched_jobs,
+        }
+
+    async def close(self) -> None:
+        for job in self.pending:
+            job.future.cancel()
+        self.pending.clear()
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
@@ -0,0 +1,52 @@
+"""
+Helpers for resilient websocket event ingestion: reconnect backoff and
+a bounded cache of post ids that were already processed
+"""
+import random
+from collections import OrderedDict
+
+
+class SeenPosts:
+    """
+    The last max_size post ids, oldest are forgotten first
+    """
+
+    def __init__(self, max_size: int = 10000) -> None:
+        self.max_size = max_size
+        self.ids: OrderedDict[str, None] = OrderedDict()
+
+    def __contains__(self, post_id: str) -> bool:
+        return post_id in self.ids
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, post_id: str) -> bool:
+        """
+        Remember a post id, False if it was seen before
+        """
+        if post_id in self.ids:
+            return False
+        self.ids[post_id] = None
+        if len(self.ids) > self.max_size:
+            self.ids.popitem(last=False)
+        return True
+
+
+class Backoff:
+    """
+    Exponential backoff with full jitter
+    """
+
+    def __init__(self, initial: float = 1.0, maximum: float = 60.0) -> None:
+        self.initial = initial
+        self.maximum = maximum
+        self.attempt = 0
+
+    def next(self) -> float:
+        delay = min(self.maximum, self.initial * 2**self.attempt)
+        self.attempt += 1
+        return random.uniform(0, delay)
+
+    def reset(self) -> None:
+        self.attempt = 0
@@ -1,30 +1,165 @@
+"""
+Logging through a queue so that the event loop never waits on a stream or
+a file, handlers run on a background listener thread
+"""
+import atexit
+import json
 import logging
+import logging.handlers
+import queue
+import random
+from typing import Optional
 
+LOGGER_NAME = __name__
 
-def getlogger():
-    # create a custom logger if not already created
-    logger = logging.getLogger(__name__)
-    if not logger.hasHandlers():
-        logger.setLevel(logging.INFO)
+# event type -> level raw websocket frames of that type are logged at
+EVENT_LEVELS: dict[str, int] = {}
+DEFAULT_EVENT_LEVEL = logging.DEBUG
+# event type -> fraction of its frames that are logged
+EVENT_SAMPLING: dict[str, float] = {}
+
+logger = logging.getLogger(LOGGER_NAME)
+log_queue: queue.SimpleQueue = queue.SimpleQueue()
+listener: Optional[logging.handlers.QueueListener] = None
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Put records on the queue as they are, formatting happens on the listener
+    """
 
-        # create handlers
-        info_handler = logging.StreamHandler()
-        error_handler = logging.FileHandler("bot.log", mode="a")
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "function": record.funcName,
+            "message": record.getMessage(),
+        }
+        if hasattr(record, "event"):
+            data["event"] = record.event
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data)
+
+
+def make_handlers(
+    log_file: Optional[str],
+    max_bytes: int,
+    backup_count: int,
+    rotate_when: Optional[str],
+    json_format: bool,
+) -> list[logging.Handler]:
+    info_handler = logging.StreamHandler()
+    handlers = [info_handler]
+    if log_file:
+        # the file is opened on the first error, importing doesn't create it
+        if rotate_when:
+            error_handler = logging.handlers.TimedRotatingFileHandler(
+                log_file, when=rotate_when, backupCount=backup_count, delay=True
+            )
+        else:
+            error_handler = logging.handlers.RotatingFileHandler(
+                log_file,
+                mode="a",
+                maxBytes=max_bytes,
+                backupCount=backup_count,
+                delay=True,
+            )
         error_handler.setLevel(logging.ERROR)
-        info_handler.setLevel(logging.INFO)
+        handlers.append(error_handler)
 
-        # create formatters
-        error_format = logging.Formatter(
-            "%(asctime)s - %(name)s - %(funcName)s - %(levelname)s - %(message)s"
+    if json_format:
+        for handler in handlers:
+            handler.setFormatter(JsonFormatter())
+    else:
+        info_handler.setFormatter(
+            logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
         )
-        info_format = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+        if log_file:
+            error_handler.setFormatter(
+                logging.Formatter(
+                    "%(asctime)s - %(name)s - %(funcName)s - %(levelname)s - %(message)s"  # noqa: E501
+                )
+            )
+    return handlers
+
+
+def start_listener(handlers: list[logging.Handler]) -> None:
+    global listener
+    stop_listener()
+    listener = logging.handlers.QueueListener(
+        log_queue, *handlers, respect_handler_level=True
+    )
+    listener.start()
 
-        # set formatter
-        error_handler.setFormatter(error_format)
-        info_handler.setFormatter(info_format)
 
-        # add handlers to logger
-        logger.addHandler(error_handler)
-        logger.addHandler(info_handler)
+def stop_listener() -> None:
+    """
+    Flush queued records and close the handlers
+    """
+    global listener
+    if listener is not None:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+        listener = None
+
+
+atexit.register(stop_listener)
+
+
+def getlogger():
+    # set up the custom logger if not already done
+    if not logger.hasHandlers():
+        logger.setLevel(logging.INFO)
+        logger.addHandler(DeferredQueueHandler(log_queue))
+        start_listener(make_handlers("bot.log", 10 * 1024 * 1024, 5, None, False))
 
     return logger
+
+
+def configure(
+    level: str = "INFO",
+    log_file: Optional[str] = "bot.log",
+    max_bytes: int = 10 * 1024 * 1024,
+    backup_count: int = 5,
+    rotate_when: Optional[str] = None,
+    json_format: bool = False,
+    event_levels: Optional[dict[str, str]] = None,
+    event_sampling: Optional[dict[str, float]] = None,
+) -> None:
+    """
+    Rebuild the handlers, errors go to log_file rotated at max_bytes,
+    or every rotate_when (e.g. midnight) if given, an empty log_file
+    disables it
+    """
+    getlogger().setLevel(level.upper())
+    start_listener(
+        make_handlers(log_file, max_bytes, backup_count, rotate_when, json_format)
+    )
+    EVENT_LEVELS.clear()
+    for event_type, event_level in (event_levels or {}).items():
+        levelno = logging.getLevelName(event_level.upper())
+        if not isinstance(levelno, int):
+            raise ValueError(f"unknown log level {event_level}")
+        EVENT_LEVELS[event_type] = levelno
+    EVENT_SAMPLING.clear()
+    EVENT_SAMPLING.update(event_sampling or {})
+
+
+def log_event(event_type: Optional[str], frame: str) -> None:
+    """
+    Log a raw websocket frame at the level and sample rate of its event type
+    """
+    level = EVENT_LEVELS.get(event_type, DEFAULT_EVENT_LEVEL)
+    if not logger.isEnabledFor(level):
+        return
+    rate = EVENT_SAMPLING.get(event_type, 1.0)
+    if rate < 1.0 and random.random() >= rate:
+        return
+    logger.log(level, frame, extra={"event": event_type})
@@ -1,5 +1,7 @@
+import startup
 import signal
 from bot import Bot
+import metrics
 import json
 import os
 import sys
@@ -11,6 +13,7 @@ logger = getlogger()
 
 
 async def main():
+    startup.mark("imports")
     config_path = Path(os.path.dirname(__file__)).parent / "config.json"
     if os.path.isfile(config_path):
         fp = open("config.json", "r", encoding="utf-8")
@@ -30,6 +33,10 @@ async def main():
             openai_api_key=config.get("openai_api_key"),
             gpt_api_endpoint=config.get("gpt_api_endpoint"),
             gpt_model=config.get("gpt_model"),
+            gpt_api_endpoints=config.get("gpt_api_endpoints"),
+            hedge_delay=config.get("hedge_delay"),
+            rate_limit_rpm=config.get("rate_limit_rpm"),
+            rate_limit_tpm=config.get("rate_limit_tpm"),
             max_tokens=config.get("max_tokens"),
             top_p=config.get("top_p"),
             presence_penalty=config.get("presence_penalty"),
@@ -45,6 +52,65 @@ async def main():
             sdwui_cfg_scale=config.get("sdwui_cfg_scale"),
             image_format=config.get("image_format"),
             timeout=config.get("timeout"),
+            metrics_port=config.get("metrics_port"),
+            metrics_host=config.get("metrics_host"),
+            stream_reply=config.get("stream_reply"),
+            stream_edit_interval=config.get("stream_edit_interval"),
+            max_concurrent_tasks=config.get("max_concurrent_tasks"),
+            max_concurrent_chat=config.get("max_concurrent_chat"),
+            max_concurrent_image=config.get("max_concurrent_image"),
+            image_max_batch_size=config.get("image_max_batch_size"),
+            image_cache_size=config.get("image_cache_size"),
+            max_queue_size=config.get("max_queue_size"),
+            conversation_ttl=config.get("conversation_ttl"),
+            conversation_token_budget=config.get("conversation_token_budget"),
+            conversation_db_path=config.get("conversation_db_path"),
+            conversation_scope=config.get("conversation_scope"),
+            thread_history_tokens=config.get("thread_history_tokens"),
+            thread_page_size=config.get("thread_page_size"),
+            response_cache_size=config.get("response_cache_size"),
+            response_cache_ttl=config.get("response_cache_ttl"),
+            response_cache_nondeterministic=config.get(
+                "response_cache_nondeterministic"
+            ),
+            trace_log=config.get("trace_log"),
+            trace_buffer_size=config.get("trace_buffer_size"),
+            profile_every=config.get("profile_every"),
+            profile_dir=config.get("profile_dir"),
+            websocket_record_path=config.get("websocket_record_path"),
+            websocket_record_anonymize=config.get("websocket_record_anonymize"),
+            log_level=config.get("log_level"),
+            log_file=config.get("log_file"),
+            log_max_bytes=config.get("log_max_bytes"),
+            log_backup_count=config.get("log_backup_count"),
+            log_rotate_when=config.get("log_rotate_when"),
+            log_json=config.get("log_json"),
+            log_event_levels=config.get("log_event_levels"),
+            log_event_sampling=config.get("log_event_sampling"),
+            tiktoken_cache_dir=config.get("tiktoken_cache_dir"),
+            http_pools=config.get("http_pools"),
+            context_selection=config.get("context_selection"),
+            context_token_budget=config.get("context_token_budget"),
+            context_recent_messages=config.get("context_recent_messages"),
+            context_top_m=config.get("context_top_m"),
+            embeddings_endpoint=config.get("embeddings_endpoint"),
+            embeddings_model=config.get("embeddings_model"),
+            compact_threshold=config.get("compact_threshold"),
+            compact_model=config.get("compact_model"),
+            compact_keep_messages=config.get("compact_keep_messages"),
+            compact_summary_tokens=config.get("compact_summary_tokens"),
+            model_tiers=config.get("model_tiers"),
+            command_models=config.get("command_models"),
+            usage_window=config.get("usage_window"),
+            user_token_quota=config.get("user_token_quota"),
+            channel_token_quota=config.get("channel_token_quota"),
+            user_image_quota=config.get("user_image_quota"),
+            channel_image_quota=config.get("channel_image_quota"),
+            usage_db_path=config.get("usage_db_path"),
+            websocket_reconnect_delay=config.get("websocket_reconnect_delay"),
+            websocket_reconnect_max_delay=config.get("websocket_reconnect_max_delay"),
+            seen_posts_size=config.get("seen_posts_size"),
+            catch_up_margin=config.get("catch_up_margin"),
         )
 
     else:
@@ -58,6 +124,10 @@ async def main():
             openai_api_key=os.environ.get("OPENAI_API_KEY"),
             gpt_api_endpoint=os.environ.get("GPT_API_ENDPOINT"),
             gpt_model=os.environ.get("GPT_MODEL"),
+            gpt_api_endpoints=json.loads(os.environ.get("GPT_API_ENDPOINTS", "[]")),
+            hedge_delay=float(os.environ.get("HEDGE_DELAY", 0)),
+            rate_limit_rpm=int(os.environ.get("RATE_LIMIT_RPM", 0)),
+            rate_limit_tpm=int(os.environ.get("RATE_LIMIT_TPM", 0)),
             max_tokens=int(os.environ.get("MAX_TOKENS", 4000)),
             top_p=float(os.environ.get("TOP_P", 1.0)),
             presence_penalty=float(os.environ.get("PRESENCE_PENALTY", 0.0)),
@@ -73,9 +143,87 @@ async def main():
             sdwui_cfg_scale=float(os.environ.get("SDWUI_CFG_SCALE", 7)),
             image_format=os.environ.get("IMAGE_FORMAT"),
             timeout=float(os.environ.get("TIMEOUT", 120.0)),
+            metrics_port=int(os.environ.get("METRICS_PORT", 0)),
+            metrics_host=os.environ.get("METRICS_HOST"),
+            stream_reply=os.environ.get("STREAM_REPLY", "false").lower() == "true",
+            stream_edit_interval=float(os.environ.get("STREAM_EDIT_INTERVAL", 1.0)),
+            max_concurrent_tasks=int(os.environ.get("MAX_CONCURRENT_TASKS", 16)),
+            max_concurrent_chat=int(os.environ.get("MAX_CONCURRENT_CHAT", 8)),
+            max_concurrent_image=int(os.environ.get("MAX_CONCURRENT_IMAGE", 1)),
+            image_max_batch_size=int(os.environ.get("IMAGE_MAX_BATCH_SIZE", 4)),
+            image_cache_size=int(os.environ.get("IMAGE_CACHE_SIZE", 0)),
+            max_queue_size=int(os.environ.get("MAX_QUEUE_SIZE", 100)),
+            conversation_ttl=float(os.environ.get("CONVERSATION_TTL", 0)),
+            conversation_token_budget=int(
+                os.environ.get("CONVERSATION_TOKEN_BUDGET", 0)
+            ),
+            conversation_db_path=os.environ.get("CONVERSATION_DB_PATH"),
+            conversation_scope=os.environ.get("CONVERSATION_SCOPE"),
+            thread_history_tokens=int(os.environ.get("THREAD_HISTORY_TOKENS", 0)),
+            thread_page_size=int(os.environ.get("THREAD_PAGE_SIZE", 60)),
+            response_cache_size=int(os.environ.get("RESPONSE_CACHE_SIZE", 256)),
+            response_cache_ttl=float(os.environ.get("RESPONSE_CACHE_TTL", 3600.0)),
+            response_cache_nondeterministic=os.environ.get(
+                "RESPONSE_CACHE_NONDETERMINISTIC", "false"
+            ).lower()
+            == "true",
+            trace_log=os.environ.get("TRACE_LOG", "false").lower() == "true",
+            trace_buffer_size=int(os.environ.get("TRACE_BUFFER_SIZE", 100)),
+            profile_every=int(os.environ.get("PROFILE_EVERY", 0)),
+            profile_dir=os.environ.get("PROFILE_DIR"),
+            websocket_record_path=os.environ.get("WEBSOCKET_RECORD_PATH"),
+            websocket_record_anonymize=os.environ.get(
+                "WEBSOCKET_RECORD_ANONYMIZE", "false"
+            ).lower()
+            == "true",
+            log_level=os.environ.get("LOG_LEVEL"),
+            log_file=os.environ.get("LOG_FILE"),
+            log_max_bytes=int(os.environ.get("LOG_MAX_BYTES", 10 * 1024 * 1024)),
+            log_backup_count=int(os.environ.get("LOG_BACKUP_COUNT", 5)),
+            log_rotate_when=os.environ.get("LOG_ROTATE_WHEN"),
+            log_json=os.environ.get("LOG_JSON", "false").lower() == "true",
+            log_event_levels=json.loads(os.environ.get("LOG_EVENT_LEVELS", "{}")),
+            log_event_sampling=json.loads(os.environ.get("LOG_EVENT_SAMPLING", "{}")),
+            tiktoken_cache_dir=os.environ.get("TIKTOKEN_CACHE_DIR"),
+            http_pools=json.loads(os.environ.get("HTTP_POOLS", "{}")),
+            context_selection=os.environ.get("CONTEXT_SELECTION"),
+            context_token_budget=int(os.environ.get("CONTEXT_TOKEN_BUDGET", 2000)),
+            context_recent_messages=int(os.environ.get("CONTEXT_RECENT_MESSAGES", 6)),
+            context_top_m=int(os.environ.get("CONTEXT_TOP_M", 4)),
+            embeddings_endpoint=os.environ.get("EMBEDDINGS_ENDPOINT"),
+            embeddings_model=os.environ.get("EMBEDDINGS_MODEL"),
+            compact_threshold=int(os.environ.get("COMPACT_THRESHOLD", 0)),
+            compact_model=os.environ.get("COMPACT_MODEL"),
+            compact_keep_messages=int(os.environ.get("COMPACT_KEEP_MESSAGES", 4)),
+            compact_summary_tokens=int(os.environ.get("COMPACT_SUMMARY_TOKENS", 300)),
+            model_tiers=json.loads(os.environ.get("MODEL_TIERS", "[]")),
+            command_models=json.loads(os.environ.get("COMMAND_MODELS", "{}")),
+            usage_window=float(os.environ.get("USAGE_WINDOW", 3600.0)),
+            user_token_quota=int(os.environ.get("USER_TOKEN_QUOTA", 0)),
+            channel_token_quota=int(os.environ.get("CHANNEL_TOKEN_QUOTA", 0)),
+            user_image_quota=int(os.environ.get("USER_IMAGE_QUOTA", 0)),
+            channel_image_quota=int(os.environ.get("CHANNEL_IMAGE_QUOTA", 0)),
+            usage_db_path=os.environ.get("USAGE_DB_PATH"),
+            websocket_reconnect_delay=float(
+                os.environ.get("WEBSOCKET_RECONNECT_DELAY", 1.0)
+            ),
+            websocket_reconnect_max_delay=float(
+                os.environ.get("WEBSOCKET_RECONNECT_MAX_DELAY", 60.0)
+            ),
+            seen_posts_size=int(os.environ.get("SEEN_POSTS_SIZE", 10000)),
+            catch_up_margin=float(os.environ.get("CATCH_UP_MARGIN", 60.0)),
         )
 
+    mattermost_bot.warm_up()
+    startup.mark("warm_up")
+
     await mattermost_bot.login()
+    startup.mark("login")
+
+    if mattermost_bot.metrics_port:
+        await metrics.start_server(
+            mattermost_bot.metrics_port, mattermost_bot.metrics_host
+        )
 
     task = asyncio.create_task(mattermost_bot.run())
 
@@ -0,0 +1,202 @@
+"""
+Minimal Prometheus-style metrics with a built-in HTTP endpoint
+"""
+import asyncio
+import bisect
+from typing import Callable, Optional
+from log import getlogger
+
+logger = getlogger()
+
+PREFIX = "mattermost_bot_"
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames=()) -> None:
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def collect(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+        ]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames=(),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> None:
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = buckets
+        # labels -> (per bucket counts with +Inf last, sum)
+        self.values: dict[tuple[str, ...], tuple[list[int], float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        counts, total = self.values.get(labels, ([0] * (len(self.buckets) + 1), 0.0))
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.values[labels] = (counts, total + value)
+
+    def collect(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else str(bound)
+                bucket_labels = format_labels(self.labelnames + ("le",), labels + (le,))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            label_str = format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_str} {total}")
+            lines.append(f"{self.name}_count{label_str} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: list = []
+        # subsystem name -> stats() of that subsystem
+        self.stats_functions: dict[str, Callable[[], dict]] = {}
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def register_stats(self, subsystem: str, stats: Callable[[], dict]) -> None:
+        """
+        Export the numeric values of a stats() dict as gauges
+        """
+        self.stats_functions[subsystem] = stats
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.collect())
+        for subsystem, stats in self.stats_functions.items():
+            try:
+                values = stats()
+            except Exception as e:
+                logger.error(e, exc_info=True)
+                continue
+            for key, value in values.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                name = f"{PREFIX}{subsystem}_{key}"
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+COMMAND_LATENCY = REGISTRY.register(
+    Histogram("command_latency_seconds", "Time to handle a command", ["command"])
+)
+TIME_TO_FIRST_TOKEN = REGISTRY.register(
+    Histogram(
+        "time_to_first_token_seconds",
+        "Time until the first token of a streamed reply",
+        ["command"],
+    )
+)
+UPSTREAM_RESPONSES = REGISTRY.register(
+    Counter(
+        "upstream_responses_total",
+        "Upstream responses by backend and status code",
+        ["backend", "status"],
+    )
+)
+PROMPT_TOKENS = REGISTRY.register(
+    Counter("prompt_tokens_total", "Prompt tokens sent upstream", ["model"])
+)
+COMPLETION_TOKENS = REGISTRY.register(
+    Counter("completion_tokens_total", "Completion tokens received", ["model"])
+)
+MODEL_ROUTES = REGISTRY.register(
+    Counter(
+        "model_routes_total",
+        "Requests routed to a model by command and reason",
+        ["command", "model", "reason"],
+    )
+)
+UPSTREAM_LATENCY = REGISTRY.register(
+    Histogram(
+        "upstream_latency_seconds",
+        "Time until a completion is done, including retries",
+        ["model"],
+    )
+)
+WEBSOCKET_EVENTS = REGISTRY.register(
+    Counter("websocket_events_total", "Websocket events received", ["event"])
+)
+
+
+async def handle_request(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    try:
+        request_line = await reader.readline()
+        # drain headers
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1] == "/metrics":
+            body = REGISTRY.render().encode("utf-8")
+            status = "200 OK"
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            body = b"Not Found\n"
+            status = "404 Not Found"
+            content_type = "text/plain; charset=utf-8"
+        writer.write(
+            (
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode("latin-1")
+            + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.error(e, exc_info=True)
+    finally:
+        writer.close()
+
+
+async def start_server(port: int, host: Optional[str] = None) -> asyncio.Server:
+    """
+    Serve GET /metrics on host:port
+    """
+    server = await asyncio.start_server(handle_request, host or "0.0.0.0", port)
+    logger.info(f"Metrics available at http://{host or '0.0.0.0'}:{port}/metrics")
+    return server
@@ -0,0 +1,94 @@
+"""
+Route each request to the cheapest model whose context window fits it
+"""
+from collections import Counter
+from typing import Optional
+from log import getlogger
+import metrics
+
+logger = getlogger()
+
+
+class Tier:
+    __slots__ = ("model", "max_tokens")
+
+    def __init__(self, model: str, max_tokens: int) -> None:
+        self.model = model
+        # context window, prompt and reply together
+        self.max_tokens = max_tokens
+
+
+class ModelRouter:
+    def __init__(
+        self,
+        tiers: list[dict],
+        command_models: Optional[dict[str, str]] = None,
+        reply_tokens: int = 500,
+        default_max_tokens: int = 4000,
+    ) -> None:
+        """
+        tiers are [{"model": ..., "max_tokens": ...}], cheapest first,
+        command_models maps a command to the model it starts from
+        """
+        if not tiers:
+            raise ValueError("at least one model tier must be provided")
+        self.tiers: list[Tier] = []
+        for tier in tiers:
+            if "model" not in tier or "max_tokens" not in tier:
+                raise ValueError("model tiers need a model and max_tokens")
+            self.tiers.append(Tier(tier["model"], int(tier["max_tokens"])))
+        self.command_models: dict[str, str] = command_models or {}
+        # room left for the reply when checking if a prompt fits
+        self.reply_tokens = reply_tokens
+        # window of overridden models that aren't a tier
+        self.default_max_tokens = default_max_tokens
+
+        # statistics, (command, model, reason) -> requests
+        self.decisions: Counter = Counter()
+
+    @property
+    def max_tokens(self) -> int:
+        return max(tier.max_tokens for tier in self.tiers)
+
+    def route(self, command: Optional[str], prompt_tokens: int) -> Tier:
+        """
+        Pick the first tier, from the command's model on, that fits
+        prompt_tokens plus a reply
+        """
+        tiers = self.tiers
+        reason = "size"
+        override = self.command_models.get(command)
+        if override is not None:
+            start = next(
+                (i for i, tier in enumerate(tiers) if tier.model == override), None
+            )
+            if start is None:
+                # pinned to a model outside the tiers
+                tier = Tier(override, self.default_max_tokens)
+                return self.__record(command, tier, "command", prompt_tokens)
+            tiers = tiers[start:]
+            reason = "command"
+
+        for tier in tiers:
+            if prompt_tokens + self.reply_tokens <= tier.max_tokens:
+                return self.__record(command, tier, reason, prompt_tokens)
+        # too long for every tier, truncation keeps it below the largest
+        return self.__record(command, tiers[-1], "largest", prompt_tokens)
+
+    def __record(
+        self, command: Optional[str], tier: Tier, reason: str, prompt_tokens: int
+    ) -> Tier:
+        command = command or "none"
+        self.decisions[(command, tier.model, reason)] += 1
+        metrics.MODEL_ROUTES.inc(command, tier.model, reason)
+        logger.info(f"Routed {command} of {prompt_tokens} tokens to {tier.model}")
+        return tier
+
+    def stats(self) -> dict:
+        """
+        Decisions by reason, model_routes_total has them by model
+        """
+        stats = {"size": 0, "command": 0, "largest": 0}
+        for (_, _, reason), count in self.decisions.items():
+            stats[reason] += count
+        return stats
@@ -0,0 +1,156 @@
+"""
+Requests-per-minute and tokens-per-minute admission control per API key
+
+Buckets start from the configured limits and are kept in sync with the
+x-ratelimit-* response headers, requests wait in FIFO order until both
+buckets have budget for them.
+"""
+import asyncio
+import re
+import time
+from typing import Optional
+import httpx
+
+DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_duration(value: str) -> Optional[float]:
+    """
+    Parse durations like 1s, 6m0s or 20ms into seconds
+    """
+    matches = DURATION_PATTERN.findall(value)
+    if not matches:
+        return None
+    return sum(float(number) * DURATION_UNITS[unit] for number, unit in matches)
+
+
+class Bucket:
+    """
+    Token bucket refilled continuously over one minute,
+    capacity None means unlimited
+    """
+
+    def __init__(self, capacity: Optional[int] = None) -> None:
+        self.capacity: Optional[float] = capacity
+        self.available: float = capacity or 0.0
+        self.rate: float = (capacity or 0.0) / 60.0
+        self.updated_at = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        if self.capacity is not None:
+            self.available = min(
+                self.capacity, self.available + (now - self.updated_at) * self.rate
+            )
+        self.updated_at = now
+
+    def wait_time(self, cost: float) -> float:
+        """
+        Seconds until cost fits in the bucket
+        """
+        if self.capacity is None:
+            return 0.0
+        self.refill()
+        # a single request larger than the bucket only waits for a full one
+        cost = min(cost, self.capacity)
+        if self.available >= cost:
+            return 0.0
+        return (cost - self.available) / self.rate
+
+    def consume(self, cost: float) -> None:
+        if self.capacity is not None:
+            self.available -= cost
+
+    def sync(self, limit: int, remaining: int, reset: Optional[float]) -> None:
+        """
+        Adopt the provider's view of this bucket
+        """
+        self.capacity = limit
+        self.available = remaining
+        self.updated_at = time.monotonic()
+        if reset:
+            # the bucket is full again after reset seconds
+            self.rate = max(limit - remaining, 1) / reset
+        else:
+            self.rate = limit / 60.0
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+    ) -> None:
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+
+        # key -> (request bucket, token bucket)
+        self.buckets: dict[str, tuple[Bucket, Bucket]] = {}
+        # asyncio.Lock wakes waiters in FIFO order
+        self.locks: dict[str, asyncio.Lock] = {}
+
+        # statistics
+        self.admitted = 0
+        self.delayed = 0
+        self.wait_time_total = 0.0
+
+    def __buckets(self, key: str) -> tuple[Bucket, Bucket]:
+        if key not in self.buckets:
+            self.buckets[key] = (
+                Bucket(self.requests_per_minute),
+                Bucket(self.tokens_per_minute),
+            )
+        return self.buckets[key]
+
+    async def acquire(self, key: str, tokens: int) -> None:
+        """
+        Wait until one request costing tokens fits in the budget of key
+        """
+        requests, token_bucket = self.__buckets(key)
+        lock = self.locks.setdefault(key, asyncio.Lock())
+        start = time.monotonic()
+        async with lock:
+            while True:
+                wait = max(requests.wait_time(1), token_bucket.wait_time(tokens))
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            requests.consume(1)
+            token_bucket.consume(tokens)
+
+        wait_time = time.monotonic() - start
+        self.admitted += 1
+        if wait_time > 0.001:
+            self.delayed += 1
+            self.wait_time_total += wait_time
+
+    def update(self, key: str, headers: httpx.Headers) -> None:
+        """
+        Sync the buckets of key from x-ratelimit-* response headers
+        """
+        requests, token_bucket = self.__buckets(key)
+        for bucket, kind in ((requests, "requests"), (token_bucket, "tokens")):
+            limit = headers.get(f"x-ratelimit-limit-{kind}")
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            if limit is None or remaining is None:
+                continue
+            try:
+                reset = parse_duration(headers.get(f"x-ratelimit-reset-{kind}", ""))
+                bucket.sync(int(limit), int(remaining), reset)
+            except ValueError:
+                continue
+
+    def stats(self) -> dict:
+        return {
+            "admitted": self.admitted,
+            "delayed": self.delayed,
+            "wait_time_total": self.wait_time_total,
+            "buckets": {
+                key: {
+                    "requests_available": requests.available,
+                    "tokens_available": tokens.available,
+                }
+                for key, (requests, tokens) in self.buckets.items()
+            },
+        }
@@ -0,0 +1,188 @@
+"""
+LRU/TTL response cache with single-flight dedupe for one-shot prompts
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import AsyncGenerator, Awaitable, Callable, Optional
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        max_size: int = 256,
+        ttl: float = 3600.0,
+        cache_nondeterministic: bool = False,
+    ) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        # also cache responses sampled with temperature > 0
+        self.cache_nondeterministic = cache_nondeterministic
+
+        # key -> (response, total tokens, expires at), least recently used first
+        self.cache: OrderedDict[tuple, tuple[str, int, float]] = OrderedDict()
+        # key -> future of the upstream call currently in flight
+        self.inflight: dict[tuple, asyncio.Future] = {}
+
+        # statistics
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.saved_tokens = 0
+
+    def make_key(
+        self,
+        prompt: str,
+        role: str,
+        model: str,
+        temperature: float,
+        top_p: float,
+        presence_penalty: float,
+        frequency_penalty: float,
+    ) -> Optional[tuple]:
+        """
+        Get the cache key of a request, None if it must not be cached
+        """
+        if self.max_size <= 0:
+            return None
+        if temperature > 0 and not self.cache_nondeterministic:
+            return None
+        # collapse whitespace
+        prompt = " ".join(prompt.split())
+        return (
+            prompt,
+            role,
+            model,
+            temperature,
+            top_p,
+            presence_penalty,
+            frequency_penalty,
+        )
+
+    def get(self, key: tuple) -> Optional[str]:
+        """
+        Get a cached response
+        """
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        response, num_tokens, expires_at = entry
+        if time.monotonic() > expires_at:
+            del self.cache[key]
+            return None
+        self.cache.move_to_end(key)
+        self.hits += 1
+        self.saved_tokens += num_tokens
+        return response
+
+    def put(self, key: tuple, response: str, num_tokens: int) -> None:
+        """
+        Cache a response with the tokens it cost
+        """
+        self.cache[key] = (response, num_tokens, time.monotonic() + self.ttl)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+    async def get_or_fetch(
+        self, key: tuple, fetch: Callable[[], Awaitable[tuple[str, int]]]
+    ) -> str:
+        """
+        Get a cached response or fetch it, identical concurrent requests
+        share a single upstream call
+        """
+        response = self.get(key)
+        if response is not None:
+            return response
+
+        if key in self.inflight:
+            self.coalesced += 1
+            response, num_tokens = await asyncio.shield(self.inflight[key])
+            self.saved_tokens += num_tokens
+            return response
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        try:
+            response, num_tokens = await fetch()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # don't warn about the exception when nobody was waiting
+            future.exception()
+            raise
+        finally:
+            del self.inflight[key]
+        future.set_result((response, num_tokens))
+        self.put(key, response, num_tokens)
+        return response
+
+    async def stream_or_fetch(
+        self,
+        key: tuple,
+        fetch: Callable[[], AsyncGenerator[str, None]],
+        count_tokens: Callable[[str], int],
+    ) -> AsyncGenerator[str, None]:
+        """
+        Streaming get_or_fetch, the first request streams and identical
+        concurrent requests get the whole response once it is done
+        """
+        response = self.get(key)
+        if response is not None:
+            yield response
+            return
+
+        while key in self.inflight:
+            future = self.inflight[key]
+            try:
+                response, num_tokens = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled() or asyncio.current_task().cancelling():
+                    raise
+                # the first reader went away, stream it ourselves
+                continue
+            self.coalesced += 1
+            self.saved_tokens += num_tokens
+            yield response
+            return
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        chunks = []
+        try:
+            async for chunk in fetch():
+                chunks.append(chunk)
+                yield chunk
+        except Exception as e:
+            future.set_exception(e)
+            # don't warn about the exception when nobody was waiting
+            future.exception()
+            raise
+        except BaseException:
+            # cancelled, or the reader stopped early
+            future.cancel()
+            raise
+        finally:
+            del self.inflight[key]
+        response = "".join(chunks)
+        num_tokens = count_tokens(response)
+        future.set_result((response, num_tokens))
+        self.put(key, response, num_tokens)
+
+    def stats(self) -> dict:
+        """
+        Get cache statistics
+        """
+        lookups = self.hits + self.coalesced + self.misses
+        return {
+            "size": len(self.cache),
+            "hits": self.hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "hit_ratio": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            "saved_tokens": self.saved_tokens,
+        }
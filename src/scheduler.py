@@ -0,0 +1,177 @@
+"""
+Bounded, fair task scheduler for websocket events
+
+Jobs are queued FIFO per conversation key so that the turns of a
+conversation run in order, and dispatched round-robin across keys under a
+global and a per-backend concurrency limit.
+"""
+import asyncio
+import contextvars
+import time
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Optional
+from log import getlogger
+import tracing
+
+logger = getlogger()
+
+# notices for jobs that can't start right away
+BUSY_MESSAGE = "Bot is busy, please try again later"
+QUEUED_MESSAGE = "Bot is busy, your request is queued at position {position}"
+
+
+class Job:
+    __slots__ = ("key", "backend", "func", "enqueued_at", "context")
+
+    def __init__(
+        self, key: str, backend: str, func: Callable[[], Awaitable[None]]
+    ) -> None:
+        self.key = key
+        self.backend = backend
+        self.func = func
+        self.enqueued_at = time.monotonic()
+        # run in the context of the submitter, not of whichever job
+        # finished and dispatched this one
+        self.context = contextvars.copy_context()
+
+
+class Scheduler:
+    def __init__(
+        self,
+        max_concurrency: int = 16,
+        backend_limits: Optional[dict[str, int]] = None,
+        max_queue_size: int = 100,
+    ) -> None:
+        self.max_concurrency = max_concurrency
+        # backends without an entry are only bound by max_concurrency
+        self.backend_limits: dict[str, int] = backend_limits or {}
+        self.max_queue_size = max_queue_size
+
+        # conversation key -> pending jobs, rotated for round-robin
+        self.queues: OrderedDict[str, deque[Job]] = OrderedDict()
+        self.queue_depth = 0
+        self.running = 0
+        self.running_keys: set[str] = set()
+        self.backend_running: dict[str, int] = {}
+        self.tasks: set[asyncio.Task] = set()
+
+        # statistics
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def submit(
+        self, key: str, backend: str, func: Callable[[], Awaitable[None]]
+    ) -> int:
+        """
+        Queue a job, return 0 if it started immediately,
+        its queue position if it has to wait, or -1 if it was rejected
+        """
+        if self.queue_depth >= self.max_queue_size:
+            self.rejected += 1
+            logger.warning(f"Queue is full, rejected {backend} job of {key}")
+            return -1
+
+        self.submitted += 1
+        job = Job(key, backend, func)
+        self.queues.setdefault(key, deque()).append(job)
+        self.queue_depth += 1
+        self.__dispatch()
+        return self.position(job)
+
+    def position(self, job: Job) -> int:
+        """
+        Get the estimated queue position of a pending job, 0 if not pending
+        """
+        queue = self.queues.get(job.key)
+        if not queue or job not in queue:
+            return 0
+        # every other key gets one turn per round
+        rounds = queue.index(job) + 1
+        return rounds + sum(
+            min(len(other), rounds)
+            for key, other in self.queues.items()
+            if key != job.key
+        )
+
+    def __can_run(self, job: Job) -> bool:
+        if job.key in self.running_keys:
+            return False
+        limit = self.backend_limits.get(job.backend)
+        if limit is not None and self.backend_running.get(job.backend, 0) >= limit:
+            return False
+        return True
+
+    def __dispatch(self) -> None:
+        """
+        Start as many jobs as the limits allow, round-robin across keys
+        """
+        while self.running < self.max_concurrency:
+            for key, queue in self.queues.items():
+                if self.__can_run(queue[0]):
+                    break
+            else:
+                return
+
+            job = queue.popleft()
+            self.queue_depth -= 1
+            if queue:
+                # give other keys a turn before this one runs again
+                self.queues.move_to_end(key)
+            else:
+                del self.queues[key]
+
+            wait_time = time.monotonic() - job.enqueued_at
+            self.wait_time_total += wait_time
+            self.wait_time_max = max(self.wait_time_max, wait_time)
+
+            self.running += 1
+            self.running_keys.add(job.key)
+            self.backend_running[job.backend] = (
+                self.backend_running.get(job.backend, 0) + 1
+            )
+            task = asyncio.create_task(self.__run(job), context=job.context)
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def __run(self, job: Job) -> None:
+        tracing.record_span("queue_wait", time.monotonic() - job.enqueued_at)
+        try:
+            await job.func()
+        except Exception as e:
+            # don't let a failed job kill the scheduler
+            logger.error(e, exc_info=True)
+        finally:
+            self.completed += 1
+            self.running -= 1
+            self.running_keys.discard(job.key)
+            self.backend_running[job.backend] -= 1
+            self.__dispatch()
+
+    def stats(self) -> dict:
+        """
+        Get queue depth and wait time statistics
+        """
+        started = self.completed + self.running
+        return {
+            "queue_depth": self.queue_depth,
+            "running": self.running,
+            "backend_running": dict(self.backend_running),
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "wait_time_avg": self.wait_time_total / started if started else 0.0,
+            "wait_time_max": self.wait_time_max,
+        }
+
+    async def close(self) -> None:
+        """
+        Drop pending jobs and cancel running ones
+        """
+        self.queues.clear()
+        self.queue_depth = 0
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
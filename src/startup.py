@@ -0,0 +1,44 @@
+"""
+Startup timing breakdown, import this module first so that the
+imports of everything else are included
+"""
+import time
+from log import getlogger
+
+logger = getlogger()
+
+STARTED_AT = time.perf_counter()
+
+# (phase, seconds) in the order they finished
+phases: list[tuple[str, float]] = []
+last_mark = STARTED_AT
+reported = False
+
+
+def mark(phase: str) -> None:
+    """
+    Record that phase finished now, it started when the previous one ended
+    """
+    global last_mark
+    now = time.perf_counter()
+    phases.append((phase, now - last_mark))
+    last_mark = now
+
+
+def report() -> None:
+    """
+    Log the breakdown once
+    """
+    global reported
+    if reported:
+        return
+    reported = True
+    breakdown = ", ".join(f"{phase} {seconds:.3f}s" for phase, seconds in phases)
+    logger.info(f"Started in {last_mark - STARTED_AT:.3f}s: {breakdown}")
+
+
+def stats() -> dict:
+    return {
+        **{f"{phase}_seconds": seconds for phase, seconds in phases},
+        "total_seconds": last_mark - STARTED_AT,
+    }
@@ -0,0 +1,144 @@
+"""
+Rebuild a thread-scoped !chat conversation from its Mattermost thread
+
+Pages of the thread are fetched newest first until the token budget is
+used up or a !new resets the thread, so only what would be sent again
+is ever read. The bot's replies pair up with the !chat prompts before
+them, everything else in the thread is left out.
+"""
+from typing import Callable, Optional
+from log import getlogger
+import imagegen
+import scheduler
+import usage_ledger
+
+logger = getlogger()
+
+# bot posts that aren't answers, the notices up to their first field
+NOTICE_PREFIXES = tuple(
+    message.partition("{")[0]
+    for message in (
+        scheduler.BUSY_MESSAGE,
+        scheduler.QUEUED_MESSAGE,
+        imagegen.QUEUED_MESSAGE,
+        *usage_ledger.QUOTA_MESSAGES.values(),
+    )
+)
+
+
+class ThreadHistory:
+    def __init__(
+        self,
+        driver,
+        parse_command: Callable[[str], tuple[Optional[str], Optional[str]]],
+        count_tokens: Callable[[dict], int],
+        token_budget: int,
+        page_size: int = 60,
+    ) -> None:
+        self.driver = driver
+        # Bot.parse_command, message -> (command, prompt)
+        self.parse_command = parse_command
+        # Chatbot.get_message_token_count
+        self.count_tokens = count_tokens
+        # tokens of history rebuilt per thread
+        self.token_budget = token_budget
+        self.page_size = page_size
+
+        # statistics
+        self.loads = 0
+        self.pages = 0
+        self.messages = 0
+        self.tokens = 0
+        self.errors = 0
+
+    async def __page(self, root_id: str, cursor: Optional[dict]) -> dict:
+        params = {"perPage": self.page_size, "direction": "up"}
+        if cursor is not None:
+            params["fromPost"] = cursor["id"]
+            params["fromCreateAt"] = cursor["create_at"]
+        self.pages += 1
+        # posts.get_thread doesn't take paging options
+        return await self.driver.client.get(f"/posts/{root_id}/thread", params=params)
+
+    async def load(
+        self, root_id: str, bot_id: str, exclude_id: str
+    ) -> tuple[list[dict], list[int]]:
+        """
+        Get the newest turns of a thread that fit the budget and their
+        token counts, oldest first, exclude_id is the post being answered
+        """
+        self.loads += 1
+        # newest first, (prompt, reply) pairs with their token counts
+        turns: list[tuple[dict, dict, int, int]] = []
+        budget = self.token_budget
+        reply = None
+        root = None
+        seen = set()
+        cursor = None
+        done = False
+        while not done:
+            try:
+                resp = await self.__page(root_id, cursor)
+            except Exception as e:
+                self.errors += 1
+                logger.warning(f"Could not load thread {root_id}: {e}")
+                break
+            posts = [p for p in resp["posts"].values() if p["id"] not in seen]
+            seen.update(p["id"] for p in posts)
+            # every page holds the root, it is the oldest post of all
+            root = root or next((p for p in posts if p["id"] == root_id), None)
+            posts = sorted(
+                (p for p in posts if p["id"] != root_id),
+                key=lambda p: p["create_at"],
+                reverse=True,
+            )
+            if not posts or not resp.get("has_next"):
+                # servers without paging send the whole thread at once
+                done = True
+            if root is not None and (done or not posts):
+                posts.append(root)
+            for post in posts:
+                if post["id"] == exclude_id or post.get("delete_at"):
+                    continue
+                if post["user_id"] == bot_id:
+                    # the last answer after a prompt, not the busy notices
+                    message = post["message"]
+                    if reply is None and not message.startswith(NOTICE_PREFIXES):
+                        reply = {"role": "assistant", "content": message}
+                    continue
+                command, prompt = self.parse_command(post["message"])
+                if command == "new":
+                    done = True
+                    break
+                if command != "chat" or reply is None:
+                    # an answer to another command isn't part of the chat
+                    if command is not None:
+                        reply = None
+                    continue
+                message = {"role": "user", "content": prompt}
+                prompt_tokens = self.count_tokens(message)
+                reply_tokens = self.count_tokens(reply)
+                if prompt_tokens + reply_tokens > budget:
+                    done = True
+                    break
+                budget -= prompt_tokens + reply_tokens
+                turns.append((message, reply, prompt_tokens, reply_tokens))
+                reply = None
+            if posts:
+                cursor = posts[-1]
+
+        turns.reverse()
+        messages = [message for turn in turns for message in turn[:2]]
+        tokens = [num_tokens for turn in turns for num_tokens in turn[2:]]
+        self.messages += len(messages)
+        self.tokens += self.token_budget - budget
+        return messages, tokens
+
+    def stats(self) -> dict:
+        return {
+            "loads": self.loads,
+            "pages": self.pages,
+            "messages": self.messages,
+            "tokens": self.tokens,
+            "errors": self.errors,
+        }
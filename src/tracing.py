@@ -0,0 +1,172 @@
+"""
+Lightweight per-message trace spans and an opt-in sampling profiler
+
+A trace is created for every websocket event, carried through the
+scheduler in a context variable, and finished once the message is
+handled. Finished traces are exported as structured log lines and kept
+in an in-memory ring buffer. Every Nth trace can be profiled with
+cProfile, dumps can be compared between releases with pstats.
+"""
+import contextvars
+import json
+import os
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional
+from log import getlogger
+
+logger = getlogger()
+
+
+class Trace:
+    __slots__ = ("correlation_id", "start", "spans", "profile", "finished")
+
+    def __init__(self, correlation_id: str = None, start: float = None) -> None:
+        self.correlation_id = correlation_id or uuid.uuid4().hex[:16]
+        # perf_counter() of when handling started
+        self.start = start or time.perf_counter()
+        # (name, start offset, duration, attributes)
+        self.spans: list[tuple[str, float, float, dict]] = []
+        self.profile = None
+        self.finished = False
+
+    def add_span(self, name: str, start: float, duration: float, **attrs) -> None:
+        self.spans.append((name, start - self.start, duration, attrs))
+
+    def to_dict(self) -> dict:
+        return {
+            "trace": self.correlation_id,
+            "duration": time.perf_counter() - self.start,
+            "spans": [
+                {"name": name, "start": offset, "duration": duration, **attrs}
+                for name, offset, duration, attrs in self.spans
+            ],
+        }
+
+
+class Tracer:
+    def __init__(self) -> None:
+        self.log_traces = False
+        self.ring_buffer: deque[dict] = deque(maxlen=100)
+        # profile every Nth trace, 0 to disable
+        self.profile_every = 0
+        self.profile_dir = Path("profiles")
+        self.traces = 0
+        self.profiling = False
+
+    def configure(
+        self,
+        log_traces: bool = False,
+        buffer_size: int = 100,
+        profile_every: int = 0,
+        profile_dir: str = None,
+    ) -> None:
+        self.log_traces = log_traces
+        self.ring_buffer = deque(maxlen=buffer_size)
+        self.profile_every = profile_every
+        if profile_dir:
+            self.profile_dir = Path(profile_dir)
+        if profile_every:
+            self.profile_dir.mkdir(parents=True, exist_ok=True)
+
+    def new_trace(self, correlation_id: str = None, start: float = None) -> Trace:
+        trace = Trace(correlation_id, start)
+        self.traces += 1
+        # cProfile can't nest, only one sampled trace at a time
+        if (
+            self.profile_every
+            and not self.profiling
+            and self.traces % self.profile_every == 0
+        ):
+            import cProfile
+
+            self.profiling = True
+            trace.profile = cProfile.Profile()
+            trace.profile.enable()
+        return trace
+
+    def finish(self, trace: Trace) -> None:
+        if trace.finished:
+            return
+        trace.finished = True
+        data = trace.to_dict()
+        self.ring_buffer.append(data)
+        if self.log_traces:
+            logger.info(json.dumps(data))
+        if trace.profile is not None:
+            # the profiler saw every task that ran while the trace was open
+            trace.profile.disable()
+            self.profiling = False
+            path = self.profile_dir / f"{int(time.time())}-{trace.correlation_id}.prof"
+            try:
+                trace.profile.dump_stats(os.fspath(path))
+            except OSError as e:
+                logger.error(e, exc_info=True)
+            trace.profile = None
+
+
+TRACER = Tracer()
+
+current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar(
+    "current_trace", default=None
+)
+
+
+def new_trace(correlation_id: str = None, start: float = None) -> Trace:
+    return TRACER.new_trace(correlation_id, start)
+
+
+@contextmanager
+def use_trace(trace: Trace) -> Iterator[Trace]:
+    """
+    Make trace the current trace, tasks created inside inherit it
+    """
+    token = current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        current_trace.reset(token)
+
+
+def finish_trace() -> None:
+    """
+    Export the current trace
+    """
+    trace = current_trace.get()
+    if trace is not None:
+        TRACER.finish(trace)
+
+
+@contextmanager
+def span(name: str, **attrs) -> Iterator[None]:
+    """
+    Time a stage of the current trace, a no-op without one
+    """
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_span(name, start, time.perf_counter() - start, **attrs)
+
+
+def record_span(name: str, duration: float, **attrs) -> None:
+    """
+    Add an already measured stage that ended now to the current trace
+    """
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add_span(name, time.perf_counter() - duration, duration, **attrs)
+
+
+def recent() -> list[dict]:
+    """
+    Get the most recently finished traces
+    """
+    return list(TRACER.ring_buffer)
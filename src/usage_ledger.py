@@ -0,0 +1,291 @@
+"""
+Per-user and per-channel usage ledger with rolling-window quotas
+
+Tokens and image generations are added to in-memory windows of time
+buckets, so checking a quota is a dictionary lookup and two comparisons.
+When a database path is given, increments are written behind to SQLite
+in batches, buckets that left the window are deleted and the current
+windows are restored on startup.
+"""
+import asyncio
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Optional
+from log import getlogger
+
+logger = getlogger()
+
+# why a request is over quota, per kind of quota
+QUOTA_MESSAGES = {
+    kind: f"The {kind} quota of {{quota}} {{unit}} per {{window}} is used up, "
+    "please try again later"
+    for kind in ("user", "channel")
+}
+
+# (user_id, channel_id) upstream usage is charged to, set per message
+current_account: ContextVar[Optional[tuple[str, str]]] = ContextVar(
+    "current_account", default=None
+)
+
+
+class Window:
+    """
+    Usage of one user or channel over the last buckets
+    """
+
+    __slots__ = ("buckets", "prompt_tokens", "completion_tokens", "images")
+
+    def __init__(self) -> None:
+        # [bucket, prompt tokens, completion tokens, images], oldest first
+        self.buckets: deque[list[int]] = deque()
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.images = 0
+
+    @property
+    def tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def add(
+        self, bucket: int, prompt_tokens: int, completion_tokens: int, images: int
+    ) -> None:
+        if not self.buckets or self.buckets[-1][0] != bucket:
+            self.buckets.append([bucket, 0, 0, 0])
+        entry = self.buckets[-1]
+        entry[1] += prompt_tokens
+        entry[2] += completion_tokens
+        entry[3] += images
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.images += images
+
+    def expire(self, oldest: int) -> None:
+        """
+        Drop buckets before oldest
+        """
+        while self.buckets and self.buckets[0][0] < oldest:
+            _, prompt_tokens, completion_tokens, images = self.buckets.popleft()
+            self.prompt_tokens -= prompt_tokens
+            self.completion_tokens -= completion_tokens
+            self.images -= images
+
+
+class UsageLedger:
+    def __init__(
+        self,
+        window: float = 3600.0,
+        user_token_quota: Optional[int] = None,
+        channel_token_quota: Optional[int] = None,
+        user_image_quota: Optional[int] = None,
+        channel_image_quota: Optional[int] = None,
+        db_path: Optional[str] = None,
+        flush_interval: float = 5.0,
+        buckets: int = 60,
+    ) -> None:
+        # seconds usage counts against the quotas
+        self.window = window
+        # (tokens, images) per window, None for no limit
+        self.quotas = {
+            "user": (user_token_quota, user_image_quota),
+            "channel": (channel_token_quota, channel_image_quota),
+        }
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.bucket_seconds = window / buckets
+        self.buckets = buckets
+
+        # "user:<id>" or "channel:<id>" -> window
+        self.windows: dict[str, Window] = {}
+        # (subject, bucket) -> [prompt tokens, completion tokens, images]
+        # not written yet
+        self.pending: dict[tuple[str, int], list[int]] = {}
+
+        # statistics
+        self.recorded_tokens = 0
+        self.recorded_images = 0
+        self.rejected = 0
+
+        self.db: Optional[sqlite3.Connection] = None
+        self.db_lock = threading.Lock()
+        if db_path:
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS usage "
+                "(subject TEXT NOT NULL, bucket INTEGER NOT NULL, "
+                "prompt_tokens INTEGER NOT NULL, completion_tokens INTEGER NOT NULL, "
+                "images INTEGER NOT NULL, PRIMARY KEY (subject, bucket))"
+            )
+            self.db.commit()
+            self.__restore()
+
+    def __bucket(self) -> int:
+        return int(time.time() // self.bucket_seconds)
+
+    def __restore(self) -> None:
+        """
+        Rebuild the windows from the buckets that are still current
+        """
+        oldest = self.__bucket() - self.buckets + 1
+        rows = self.db.execute(
+            "SELECT subject, bucket, prompt_tokens, completion_tokens, images "
+            "FROM usage WHERE bucket >= ? ORDER BY bucket",
+            (oldest,),
+        ).fetchall()
+        for subject, bucket, prompt_tokens, completion_tokens, images in rows:
+            self.windows.setdefault(subject, Window()).add(
+                bucket, prompt_tokens, completion_tokens, images
+            )
+
+    def __window(self, subject: str) -> Optional[Window]:
+        window = self.windows.get(subject)
+        if window is not None:
+            window.expire(self.__bucket() - self.buckets + 1)
+        return window
+
+    def record(
+        self,
+        user_id: str,
+        channel_id: str,
+        prompt_tokens: int = 0,
+        completion_tokens: int = 0,
+        images: int = 0,
+    ) -> None:
+        bucket = self.__bucket()
+        for subject in (f"user:{user_id}", f"channel:{channel_id}"):
+            window = self.__window(subject)
+            if window is None:
+                window = self.windows[subject] = Window()
+            window.add(bucket, prompt_tokens, completion_tokens, images)
+            if self.db is not None:
+                entry = self.pending.setdefault((subject, bucket), [0, 0, 0])
+                entry[0] += prompt_tokens
+                entry[1] += completion_tokens
+                entry[2] += images
+        self.recorded_tokens += prompt_tokens + completion_tokens
+        self.recorded_images += images
+
+    def charge(
+        self, prompt_tokens: int = 0, completion_tokens: int = 0, images: int = 0
+    ) -> None:
+        """
+        Record usage for the current account, if any
+        """
+        account = current_account.get()
+        if account is not None:
+            self.record(*account, prompt_tokens, completion_tokens, images)
+
+    def check(self, user_id: str, channel_id: str, backend: str) -> Optional[str]:
+        """
+        Get why a request is over quota, None if it may go ahead
+        """
+        for kind, subject_id in (("user", user_id), ("channel", channel_id)):
+            token_quota, image_quota = self.quotas[kind]
+            quota = image_quota if backend == "image" else token_quota
+            if not quota:
+                continue
+            window = self.__window(f"{kind}:{subject_id}")
+            if window is None:
+                continue
+            used = window.images if backend == "image" else window.tokens
+            if used >= quota:
+                self.rejected += 1
+                unit = "images" if backend == "image" else "tokens"
+                return QUOTA_MESSAGES[kind].format(
+                    quota=quota, unit=unit, window=self.__format_window()
+                )
+        return None
+
+    def __format_window(self) -> str:
+        if self.window % 3600 == 0:
+            return f"{int(self.window // 3600)}h"
+        if self.window % 60 == 0:
+            return f"{int(self.window // 60)}m"
+        return f"{self.window:g}s"
+
+    def usage(self, user_id: str, channel_id: str) -> str:
+        """
+        Describe the usage of a user and a channel for !usage
+        """
+        lines = [f"Usage in the last {self.__format_window()}:"]
+        for kind, subject_id in (("user", user_id), ("channel", channel_id)):
+            window = self.__window(f"{kind}:{subject_id}") or Window()
+            token_quota, image_quota = self.quotas[kind]
+            tokens = f"{window.tokens}" + (f"/{token_quota}" if token_quota else "")
+            images = f"{window.images}" + (f"/{image_quota}" if image_quota else "")
+            lines.append(
+                f"{'You' if kind == 'user' else 'This channel'}: {tokens} tokens "
+                f"({window.prompt_tokens} prompt, {window.completion_tokens} "
+                f"completion), {images} images"
+            )
+        return "\n".join(lines)
+
+    def __write(self, items: list[tuple[str, int, int, int, int]], oldest: int) -> None:
+        with self.db_lock:
+            self.db.executemany(
+                "INSERT INTO usage "
+                "(subject, bucket, prompt_tokens, completion_tokens, images) "
+                "VALUES (?, ?, ?, ?, ?) ON CONFLICT (subject, bucket) DO UPDATE SET "
+                "prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+                "completion_tokens = completion_tokens + excluded.completion_tokens, "
+                "images = images + excluded.images",
+                items,
+            )
+            # only the window is ever read again
+            self.db.execute("DELETE FROM usage WHERE bucket < ?", (oldest,))
+            self.db.commit()
+
+    async def flush(self) -> None:
+        """
+        Write pending increments to the database, forget idle windows and
+        delete the buckets that left the window
+        """
+        oldest = self.__bucket() - self.buckets + 1
+        for window in self.windows.values():
+            window.expire(oldest)
+        for subject in [s for s, w in self.windows.items() if not w.buckets]:
+            del self.windows[subject]
+
+        if self.db is None or not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        items = [
+            (subject, bucket, *counts) for (subject, bucket), counts in pending.items()
+        ]
+        try:
+            await asyncio.to_thread(self.__write, items, oldest)
+        except Exception as e:
+            logger.error(e, exc_info=True)
+            # retry on the next flush
+            for key, counts in pending.items():
+                entry = self.pending.setdefault(key, [0, 0, 0])
+                for i, count in enumerate(counts):
+                    entry[i] += count
+
+    async def run(self) -> None:
+        """
+        Flush periodically
+        """
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def close(self) -> None:
+        await self.flush()
+        if self.db is not None:
+            with self.db_lock:
+                self.db.close()
+            self.db = None
+
+    def stats(self) -> dict:
+        return {
+            "subjects": len(self.windows),
+            "recorded_tokens": self.recorded_tokens,
+            "recorded_images": self.recorded_images,
+            "rejected": self.rejected,
+            "pending": len(self.pending),
+        }
@@ -0,0 +1,22 @@
+import sys
+from pathlib import Path
+import pytest
+import tiktoken
+
+# the bot's modules import each other from src
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+
+@pytest.fixture
+def encoding(monkeypatch):
+    """
+    A byte-level encoding, the real one is downloaded on first use
+    """
+    encoding = tiktoken.Encoding(
+        name="bytes",
+        pat_str=r"\S+|\s+",
+        mergeable_ranks={bytes([i]): i for i in range(256)},
+        special_tokens={},
+    )
+    monkeypatch.setattr(tiktoken, "get_encoding", lambda name: encoding)
+    return encoding
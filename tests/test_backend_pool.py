@@ -0,0 +1,125 @@
+import asyncio
+import time
+import pytest
+from backend_pool import BackendPool, Endpoint, UpstreamError
+
+
+def make_pool(**kwargs) -> BackendPool:
+    return BackendPool([Endpoint("a"), Endpoint("b"), Endpoint("c")], **kwargs)
+
+
+def test_untried_endpoints_count_their_load():
+    pool = make_pool()
+    a, b, c = pool.endpoints
+    a.latency, b.latency = 0.5, 1.5
+    # an untried endpoint counts as the median latency of the others
+    assert pool.select() is a
+    c.inflight = 3
+    a.inflight = 1
+    assert pool.select() is a
+    c.inflight = 0
+    a.inflight = 2
+    assert pool.select() is c
+
+
+def test_default_latency_before_any_response():
+    pool = make_pool()
+    a, b, c = pool.endpoints
+    a.inflight = 2
+    b.inflight = 1
+    assert pool.select() is c
+
+
+def test_circuit_opens_and_admits_one_trial():
+    async def run():
+        pool = make_pool(failure_threshold=2, cooldown=30)
+        a = pool.endpoints[0]
+        error = UpstreamError(500, "down")
+        for _ in range(2):
+            pool.record_failure(a, error)
+        assert a.open_until > time.monotonic()
+        assert a not in {pool.select(), pool.select(exclude={pool.select()})}
+
+        # the cooldown is over, a is half-open
+        a.open_until = time.monotonic() - 1
+        release = asyncio.Event()
+
+        async def send(endpoint: Endpoint) -> str:
+            await release.wait()
+            return endpoint.url
+
+        trial = asyncio.create_task(pool._BackendPool__send(a, send))
+        await asyncio.sleep(0)
+        assert a.trial
+        # no other request is let through while the trial is in flight
+        for _ in range(5):
+            assert pool.select() is not a
+        assert a.stats()["half_open"]
+
+        release.set()
+        assert await trial == "a"
+        assert a.open_until == 0.0 and not a.trial
+        assert a.consecutive_failures == 0
+
+    asyncio.run(run())
+
+
+def test_failed_trial_opens_the_circuit_again():
+    async def run():
+        pool = make_pool(failure_threshold=1, cooldown=30)
+        a = pool.endpoints[0]
+        pool.record_failure(a, UpstreamError(503, "down"))
+        a.open_until = time.monotonic() - 1
+
+        async def send(endpoint: Endpoint) -> str:
+            raise UpstreamError(503, "still down")
+
+        with pytest.raises(UpstreamError):
+            await pool._BackendPool__send(a, send)
+        assert a.open_until > time.monotonic()
+        assert not a.trial
+
+    asyncio.run(run())
+
+
+def test_bad_requests_dont_open_the_circuit():
+    pool = make_pool(failure_threshold=1)
+    a = pool.endpoints[0]
+    pool.record_failure(a, UpstreamError(400, "bad request"))
+    assert a.open_until == 0.0
+    assert a.failures == 1
+
+
+def test_request_fails_over_to_another_endpoint():
+    async def run():
+        pool = make_pool(max_attempts=2)
+        calls = []
+
+        async def send(endpoint: Endpoint) -> str:
+            calls.append(endpoint.url)
+            if len(calls) == 1:
+                raise UpstreamError(502, "bad gateway")
+            return endpoint.url
+
+        assert await pool.request(send) == calls[1]
+        assert calls[0] != calls[1]
+
+    asyncio.run(run())
+
+
+def test_hedged_request_takes_the_first_answer():
+    async def run():
+        pool = make_pool(hedge_delay=0.05)
+        a, b, c = pool.endpoints
+        a.latency, b.latency, c.latency = 0.1, 0.2, 0.3
+
+        async def send(endpoint: Endpoint) -> str:
+            await asyncio.sleep(1.0 if endpoint is a else 0.01)
+            return endpoint.url
+
+        assert await pool.request(send) == "b"
+        assert pool.hedged == 1
+        await asyncio.sleep(0)
+        assert a.inflight == 0
+
+    asyncio.run(run())
@@ -0,0 +1,72 @@
+import asyncio
+import pytest
+from conversation_store import Conversation, Message
+
+pytest.importorskip("numpy")
+from context_selector import ContextSelector, HashingVectorizer  # noqa: E402
+
+
+class SlowVectorizer(HashingVectorizer):
+    """
+    Embeds once released, like an embeddings endpoint taking its time
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.waiting = asyncio.Event()
+        self.release = asyncio.Event()
+
+    async def embed(self, texts: list[str]):
+        self.waiting.set()
+        await self.release.wait()
+        return self.transform(texts)
+
+
+def make_conversation() -> Conversation:
+    topics = ["apples", "pears", "plums", "cherries", "grapes", "melons"]
+    messages = [Message("system", "You are a fruit expert", 10)]
+    for topic in topics:
+        messages.append(Message("user", f"tell me about {topic}", 10))
+        messages.append(Message("assistant", f"{topic} are fruit", 10))
+    messages.append(Message("user", "more about pears please", 10))
+    return Conversation(messages)
+
+
+def test_sends_everything_within_budget():
+    selector = ContextSelector(HashingVectorizer(), token_budget=1000)
+    conversation = make_conversation()
+    messages, token_count = asyncio.run(selector.select("a", conversation))
+    assert messages == conversation.messages
+    assert token_count == conversation.token_total
+
+
+def test_selects_recent_and_relevant_messages():
+    selector = ContextSelector(
+        HashingVectorizer(), token_budget=60, recent_messages=2, top_m=2
+    )
+    conversation = make_conversation()
+    messages, token_count = asyncio.run(selector.select("a", conversation))
+    contents = [m.content for m in messages]
+    assert contents[0] == "You are a fruit expert"
+    assert contents[-2:] == ["melons are fruit", "more about pears please"]
+    assert "tell me about pears" in contents
+    assert token_count == 10 * len(messages) <= 60
+
+
+def test_compaction_while_embedding():
+    async def run():
+        embedder = SlowVectorizer()
+        selector = ContextSelector(embedder, token_budget=60, recent_messages=2)
+        conversation = make_conversation()
+        before = list(conversation.messages)
+        select = asyncio.create_task(selector.select("a", conversation))
+        await embedder.waiting.wait()
+        # a background compaction finishes meanwhile
+        conversation.replace(1, 11, Message("system", "Summary: fruit", 10))
+        embedder.release.set()
+        messages, token_count = await select
+        assert all(message in before for message in messages)
+        assert token_count == 10 * len(messages)
+        assert len(conversation) == 5
+
+    asyncio.run(run())
@@ -0,0 +1,170 @@
+import asyncio
+import json
+import time
+import httpx
+from conversation_store import Conversation, ConversationStore, Message
+from gptbot import Chatbot
+
+
+def make_conversation(*contents: str, tokens: int = 10) -> Conversation:
+    return Conversation([Message("user", content, tokens) for content in contents])
+
+
+def contents(conversation: Conversation) -> list[str]:
+    return [message.content for message in conversation.messages]
+
+
+def test_evicts_least_recently_used_over_budget():
+    store = ConversationStore(token_budget=30)
+    for convo_id in "abc":
+        store[convo_id] = make_conversation(convo_id)
+    assert store.get("a") is not None
+    store["d"] = make_conversation("d")
+    assert list(store.cache) == ["c", "a", "d"]
+    assert store.stats()["evictions"] == 1
+    assert store.resident_tokens == 30
+
+
+def test_evicts_expired(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    store = ConversationStore(ttl=60)
+    store["a"] = make_conversation("a")
+    now[0] += 30
+    store["b"] = make_conversation("b")
+    now[0] += 31
+    assert store.get("a") is None
+    assert store.get("b") is not None
+
+
+def test_pinned_conversations_are_not_evicted():
+    store = ConversationStore(token_budget=20)
+    store["a"] = make_conversation("a")
+    store.pin("a")
+    store.pin("a")
+    store["b"] = make_conversation("b")
+    store["c"] = make_conversation("c")
+    assert "a" in store.cache and "b" not in store.cache
+    store.unpin("a")
+    store["d"] = make_conversation("d")
+    assert "a" in store.cache
+    store.unpin("a")
+    store["e"] = make_conversation("e")
+    assert "a" not in store.cache
+    assert store.pinned == {}
+
+
+def test_round_trip_through_the_database(tmp_path):
+    async def run():
+        store = ConversationStore(token_budget=10, db_path=str(tmp_path / "c.db"))
+        store["a"] = make_conversation("hello", "wörld")
+        await store.flush()
+        store["b"] = make_conversation("b")
+        assert store.get("a") is None
+        conversation = await store.load("a")
+        assert contents(conversation) == ["hello", "wörld"]
+        assert conversation.token_total == 20
+        assert await store.load("missing") is None
+        await store.close()
+
+        # and after a restart
+        store = ConversationStore(db_path=str(tmp_path / "c.db"))
+        assert contents(await store.load("b")) == ["b"]
+        await store.close()
+
+    asyncio.run(run())
+
+
+def test_load_during_flush_sees_the_unwritten_change(tmp_path, monkeypatch):
+    async def run():
+        store = ConversationStore(token_budget=25, db_path=str(tmp_path / "c.db"))
+        store["a"] = make_conversation("old")
+        await store.flush()
+
+        conversation = store.get("a")
+        conversation.append(Message("assistant", "new", 10))
+        store["a"] = conversation
+        write = store._ConversationStore__write
+        started = asyncio.Event()
+        loop = asyncio.get_running_loop()
+
+        def slow_write(items):
+            loop.call_soon_threadsafe(started.set)
+            time.sleep(0.2)
+            write(items)
+
+        monkeypatch.setattr(store, "_ConversationStore__write", slow_write)
+        flush = asyncio.create_task(store.flush())
+        await started.wait()
+        # evicted while its new version is being written
+        store["b"] = make_conversation("b")
+        assert "a" not in store.cache
+        assert contents(await store.load("a")) == ["old", "new"]
+        await flush
+        await store.close()
+
+    asyncio.run(run())
+
+
+def test_reply_keeps_history_evicted_during_the_request(tmp_path, encoding):
+    """
+    A flush and other conversations evict a conversation while its
+    request is in flight, the reply must be added to the stored history
+    """
+
+    async def run():
+        requests = []
+        answer = asyncio.Event()
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            requests.append(json.loads(request.content))
+            if len(requests) == 1:
+                await answer.wait()
+            message = {"role": "assistant", "content": f"reply {len(requests)}"}
+            return httpx.Response(200, json={"choices": [{"message": message}]})
+
+        store = ConversationStore(token_budget=200, db_path=str(tmp_path / "c.db"))
+        aclient = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        chatbot = Chatbot(
+            aclient, api_key="sk-test", engine="gpt-3.5-turbo", system_prompt="sys"
+        )
+        chatbot.conversation = store
+        chatbot.reset("alice")
+        for i in range(4):
+            chatbot.add_to_conversation(f"turn {i}", "user", convo_id="alice")
+        await store.flush()
+
+        ask = asyncio.create_task(chatbot.ask_async_v2("question", convo_id="alice"))
+        while not requests:
+            await asyncio.sleep(0.01)
+        await store.flush()
+        for i in range(5):
+            chatbot.reset(f"other {i}")
+            chatbot.add_to_conversation("x" * 100, "user", convo_id=f"other {i}")
+        assert "alice" in store.cache
+        answer.set()
+        assert await ask == "reply 1"
+        await store.flush()
+
+        store.pinned.clear()
+        chatbot.reset("bob")
+        chatbot.add_to_conversation("x" * 300, "user", convo_id="bob")
+        assert "alice" not in store.cache
+        history = contents(await store.load("alice"))
+        assert history == ["sys"] + [f"turn {i}" for i in range(4)] + [
+            "question",
+            "reply 1",
+        ]
+        await aclient.aclose()
+        await store.close()
+
+    asyncio.run(run())
+
+
+def test_replace_leaves_the_old_list_alone():
+    conversation = make_conversation("system", "a", "b", "c", "d")
+    messages = conversation.messages
+    conversation.replace(1, 3, Message("system", "summary", 5))
+    assert contents(conversation) == ["system", "summary", "c", "d"]
+    assert conversation.token_total == 35
+    assert [m.content for m in messages] == ["system", "a", "b", "c", "d"]
@@ -0,0 +1,76 @@
+import json
+from frame_recorder import FrameRecorder, read_frames
+
+USER_IDS = ["alice_uid", "bob_uid", "carol_uid"]
+NAMES = ["alice", "Alice Smith", "Town Square", "town-square", "hook-name"]
+
+
+def make_frame() -> str:
+    post = {
+        "id": "post_id_1",
+        "user_id": "alice_uid",
+        "channel_id": "channel_uid",
+        "root_id": "",
+        "message": "!chat hello @bob how is carol",
+        "props": {
+            "from_webhook": "true",
+            "override_username": "hook-name",
+            "attachments": [{"author_name": "Alice Smith"}],
+        },
+    }
+    return json.dumps(
+        {
+            "event": "posted",
+            "data": {
+                "channel_display_name": "Town Square",
+                "channel_name": "town-square",
+                "channel_type": "O",
+                "mentions": json.dumps(["bob_uid", "carol_uid"]),
+                "followers": json.dumps(["alice_uid"]),
+                "post": json.dumps(post),
+                "sender_name": "@alice",
+                "set_online": True,
+                "team_id": "team_uid",
+            },
+            "broadcast": {
+                "omit_users": {"carol_uid": True},
+                "user_id": "",
+                "channel_id": "channel_uid",
+                "team_id": "",
+            },
+            "seq": 7,
+        }
+    )
+
+
+def test_no_user_id_or_name_survives(tmp_path):
+    path = str(tmp_path / "frames.jsonl.gz")
+    recorder = FrameRecorder(path, anonymize=True, keep={"bot"})
+    recorder.record(make_frame())
+    recorder.close()
+
+    (_, frame), *_ = read_frames(path)
+    for value in USER_IDS + NAMES + ["channel_uid", "team_uid", "post_id_1"]:
+        assert value not in frame
+
+    data = json.loads(frame)
+    post = json.loads(data["data"]["post"])
+    assert post["message"].startswith("!chat ")
+    assert len(post["message"].split()) == 6
+    assert post["props"] == {}
+    # the same id hashes the same everywhere
+    assert json.loads(data["data"]["followers"]) == [post["user_id"]]
+    mentions = json.loads(data["data"]["mentions"])
+    assert list(data["broadcast"]["omit_users"]) == mentions[1:]
+    assert data["data"]["sender_name"].startswith("@")
+    assert data["seq"] == 7
+
+
+def test_records_frames_as_they_are(tmp_path):
+    path = str(tmp_path / "frames.jsonl.gz")
+    recorder = FrameRecorder(path)
+    frame = make_frame()
+    recorder.record(frame)
+    recorder.record("not json")
+    recorder.close()
+    assert [f for _, f in read_frames(path)] == [frame, "not json"]
@@ -0,0 +1,40 @@
+import asyncio
+from image_cache import ImageCache
+
+
+def test_put_get_and_evict_least_recently_used(tmp_path):
+    async def run():
+        cache = ImageCache(tmp_path, max_bytes=20)
+        keys = [ImageCache.make_key(f"prompt {i}", size="256x256") for i in range(3)]
+        await cache.put(keys[0], "png", b"0" * 8)
+        await cache.put(keys[1], "png", b"1" * 8)
+        assert await cache.get(keys[0], "png") == b"0" * 8
+        await cache.put(keys[2], "png", b"2" * 8)
+        assert await cache.get(keys[1], "png") is None
+        assert await cache.get(keys[2], "png") == b"2" * 8
+        assert not (tmp_path / f"{keys[1]}.png").exists()
+        assert cache.stats()["evictions"] == 1
+        assert cache.size == 16
+
+    asyncio.run(run())
+
+
+def test_leaves_other_files_alone(tmp_path):
+    async def run():
+        key = ImageCache.make_key("a prompt")
+        (tmp_path / "saved by pic.png").write_bytes(b"x" * 100)
+        (tmp_path / f"{key}.png.tmp").write_bytes(b"x" * 100)
+        (tmp_path / f"{key}.jpeg").write_bytes(b"x" * 10)
+
+        cache = ImageCache(tmp_path, max_bytes=15)
+        assert list(cache.index) == [f"{key}.jpeg"]
+        await cache.put(ImageCache.make_key("another"), "png", b"y" * 10)
+        assert sorted(p.name for p in tmp_path.iterdir()) == sorted(
+            [
+                "saved by pic.png",
+                f"{key}.png.tmp",
+                f"{ImageCache.make_key('another')}.png",
+            ]
+        )
+
+    asyncio.run(run())
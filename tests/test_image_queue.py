@@ -0,0 +1,104 @@
+import asyncio
+import base64
+import json
+import httpx
+import pytest
+from imagegen import MAGIC_NUMBERS, ImageQueue
+
+PNG = MAGIC_NUMBERS["png"]
+
+
+class Backend:
+    """
+    A stable-diffusion-webui stand-in, calls wait until released
+    """
+
+    def __init__(self) -> None:
+        self.batch_sizes: list[int] = []
+        self.release = asyncio.Event()
+        self.fail = False
+        self.images = 0
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        if request.method == "GET":
+            # a localai image download
+            self.images += 1
+            return httpx.Response(200, content=PNG + bytes([self.images]))
+        body = json.loads(request.content)
+        if "batch_size" not in body:
+            # localai makes one image per call
+            self.batch_sizes.append(1)
+            await self.release.wait()
+            return httpx.Response(200, json={"data": [{"url": "http://ai/1.png"}]})
+        self.batch_sizes.append(body["batch_size"])
+        await self.release.wait()
+        if self.fail:
+            return httpx.Response(500, text="out of memory")
+        images = []
+        for _ in range(body["batch_size"]):
+            self.images += 1
+            images.append(base64.b64encode(PNG + bytes([self.images])).decode())
+        return httpx.Response(200, json={"images": images})
+
+
+def make_queue(backend: Backend, backend_type: str = "sdwui") -> ImageQueue:
+    aclient = httpx.AsyncClient(transport=httpx.MockTransport(backend.handler))
+    return ImageQueue(aclient, "http://sdwui/txt2img", backend_type, concurrency=1)
+
+
+async def settle() -> None:
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def test_identical_queued_jobs_are_batched():
+    async def run():
+        backend = Backend()
+        queue = make_queue(backend)
+        jobs = [
+            queue.submit(prompt, image_format="png")
+            for prompt in ("a cat", "a dog", "a cat", "a cat")
+        ]
+        assert [queue.position(job) for job in jobs] == [0, 1, 2, 3]
+        await settle()
+        backend.release.set()
+        results = await asyncio.gather(*(job.future for job in jobs))
+        assert backend.batch_sizes == [1, 1, 2]
+        # every job gets an image of its own
+        data = [images[0][1] for images in results]
+        assert len(set(data)) == 4
+        assert all(len(images) == 1 for images in results)
+        assert queue.stats()["batched_jobs"] == 4
+
+    asyncio.run(run())
+
+
+def test_backends_without_batching_run_one_by_one():
+    async def run():
+        backend = Backend()
+        queue = make_queue(backend, "localai")
+        jobs = [queue.submit("a cat", image_format="png") for _ in range(3)]
+        backend.release.set()
+        results = await asyncio.gather(*(job.future for job in jobs))
+        assert backend.batch_sizes == [1, 1, 1]
+        assert len({images[0][1] for images in results}) == 3
+
+    asyncio.run(run())
+
+
+def test_failure_reaches_every_job_of_the_batch():
+    async def run():
+        backend = Backend()
+        queue = make_queue(backend)
+        first = queue.submit("a cat", image_format="png")
+        batch = [queue.submit("a dog", image_format="png") for _ in range(2)]
+        await settle()
+        backend.fail = True
+        backend.release.set()
+        for job in [first, *batch]:
+            with pytest.raises(Exception, match="500"):
+                await job.future
+        assert backend.batch_sizes == [1, 2]
+        assert queue.stats()["running"] == 0
+
+    asyncio.run(run())
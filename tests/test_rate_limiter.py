@@ -0,0 +1,93 @@
+import asyncio
+import time
+import httpx
+import pytest
+from rate_limiter import Bucket, RateLimiter, parse_duration
+
+
+@pytest.mark.parametrize(
+    "value, seconds",
+    [("1s", 1.0), ("6m0s", 360.0), ("20ms", 0.02), ("1h2m", 3720.0), ("", None)],
+)
+def test_parse_duration(value, seconds):
+    assert parse_duration(value) == (pytest.approx(seconds) if seconds else None)
+
+
+def test_bucket_refills_over_a_minute(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    bucket = Bucket(60)
+    assert bucket.wait_time(60) == 0.0
+    bucket.consume(60)
+    assert bucket.wait_time(1) == pytest.approx(1.0)
+    now[0] += 0.5
+    assert bucket.wait_time(1) == pytest.approx(0.5)
+    # larger than the bucket only waits for a full one
+    assert bucket.wait_time(1000) == pytest.approx(59.5)
+    assert Bucket().wait_time(10**9) == 0.0
+
+
+def test_sync_from_headers(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    limiter = RateLimiter(requests_per_minute=3500, tokens_per_minute=90000)
+    limiter.update(
+        "key",
+        httpx.Headers(
+            {
+                "x-ratelimit-limit-requests": "100",
+                "x-ratelimit-remaining-requests": "10",
+                "x-ratelimit-reset-requests": "6m0s",
+                "x-ratelimit-limit-tokens": "not a number",
+                "x-ratelimit-remaining-tokens": "5",
+            }
+        ),
+    )
+    requests, tokens = limiter.buckets["key"]
+    assert (requests.capacity, requests.available) == (100, 10)
+    # the 90 used requests come back within 6 minutes
+    assert requests.rate == pytest.approx(90 / 360)
+    assert tokens.capacity == 90000
+
+
+def test_waits_in_order_for_budget():
+    async def run():
+        limiter = RateLimiter(requests_per_minute=100)
+        limiter.update(
+            "key",
+            httpx.Headers(
+                {
+                    "x-ratelimit-limit-requests": "2",
+                    "x-ratelimit-remaining-requests": "1",
+                    "x-ratelimit-reset-requests": "100ms",
+                }
+            ),
+        )
+        admitted = []
+
+        async def request(name: str) -> None:
+            await limiter.acquire("key", 0)
+            admitted.append((name, time.monotonic()))
+
+        start = time.monotonic()
+        await asyncio.gather(*(request(name) for name in "abc"))
+        assert [name for name, _ in admitted] == ["a", "b", "c"]
+        # one request was available, the others wait 50ms each
+        assert admitted[0][1] - start < 0.03
+        assert admitted[2][1] - start >= 0.09
+        stats = limiter.stats()
+        assert (stats["admitted"], stats["delayed"]) == (3, 2)
+        # other keys have their own budget
+        await asyncio.wait_for(limiter.acquire("other", 0), 0.01)
+
+    asyncio.run(run())
+
+
+def test_unlimited():
+    async def run():
+        limiter = RateLimiter()
+        for _ in range(100):
+            await limiter.acquire("key", 10**6)
+        assert limiter.stats()["delayed"] == 0
+
+    asyncio.run(run())
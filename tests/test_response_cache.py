@@ -0,0 +1,146 @@
+import asyncio
+import time
+import pytest
+from response_cache import ResponseCache
+
+
+def make_key(cache: ResponseCache, prompt: str, temperature: float = 0.0):
+    return cache.make_key(prompt, "user", "gpt-3.5-turbo", temperature, 1.0, 0, 0)
+
+
+def test_keys():
+    cache = ResponseCache()
+    assert make_key(cache, "hello  world") == make_key(cache, " hello world\n")
+    assert make_key(cache, "hello", temperature=0.8) is None
+    assert make_key(ResponseCache(cache_nondeterministic=True), "hi", 0.8)
+    assert make_key(ResponseCache(max_size=0), "hello") is None
+
+
+def test_lru_and_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    cache = ResponseCache(max_size=2, ttl=60)
+    cache.put(("a",), "A", 10)
+    cache.put(("b",), "B", 10)
+    assert cache.get(("a",)) == "A"
+    cache.put(("c",), "C", 10)
+    assert cache.get(("b",)) is None
+    now[0] += 61
+    assert cache.get(("a",)) is None
+    assert cache.stats()["saved_tokens"] == 10
+
+
+def test_concurrent_requests_share_one_fetch():
+    async def run():
+        cache = ResponseCache()
+        calls = 0
+
+        async def fetch():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return "answer", 30
+
+        responses = await asyncio.gather(
+            *(cache.get_or_fetch(("k",), fetch) for _ in range(5))
+        )
+        assert responses == ["answer"] * 5
+        assert await cache.get_or_fetch(("k",), fetch) == "answer"
+        assert calls == 1
+        stats = cache.stats()
+        assert (stats["misses"], stats["coalesced"], stats["hits"]) == (1, 4, 1)
+        assert stats["saved_tokens"] == 150
+
+    asyncio.run(run())
+
+
+def test_failed_fetch_is_shared_and_not_cached():
+    async def run():
+        cache = ResponseCache()
+
+        async def fetch():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("upstream down")
+
+        results = await asyncio.gather(
+            *(cache.get_or_fetch(("k",), fetch) for _ in range(3)),
+            return_exceptions=True,
+        )
+        assert all(isinstance(r, RuntimeError) for r in results)
+        assert cache.inflight == {} and cache.get(("k",)) is None
+
+    asyncio.run(run())
+
+
+def test_streams_once_for_concurrent_readers():
+    async def run():
+        cache = ResponseCache()
+        calls = 0
+
+        async def fetch():
+            nonlocal calls
+            calls += 1
+            for chunk in ("a", "b", "c"):
+                await asyncio.sleep(0.01)
+                yield chunk
+
+        async def read():
+            return [c async for c in cache.stream_or_fetch(("k",), fetch, len)]
+
+        assert await asyncio.gather(read(), read(), read()) == [
+            ["a", "b", "c"],
+            ["abc"],
+            ["abc"],
+        ]
+        assert await read() == ["abc"]
+        assert calls == 1
+        stats = cache.stats()
+        assert (stats["misses"], stats["coalesced"], stats["hits"]) == (1, 2, 1)
+
+    asyncio.run(run())
+
+
+def test_reader_takes_over_when_the_first_stops():
+    async def run():
+        cache = ResponseCache()
+
+        async def fetch():
+            for chunk in ("a", "b"):
+                await asyncio.sleep(0.01)
+                yield chunk
+
+        async def first():
+            stream = cache.stream_or_fetch(("k",), fetch, len)
+            async for _ in stream:
+                break
+            await stream.aclose()
+
+        async def second():
+            await asyncio.sleep(0.001)
+            return [c async for c in cache.stream_or_fetch(("k",), fetch, len)]
+
+        _, chunks = await asyncio.gather(first(), second())
+        assert chunks == ["a", "b"]
+        assert cache.inflight == {}
+
+    asyncio.run(run())
+
+
+def test_stream_error_reaches_every_reader():
+    async def run():
+        cache = ResponseCache()
+
+        async def fetch():
+            yield "a"
+            await asyncio.sleep(0.01)
+            raise RuntimeError("upstream down")
+
+        async def read():
+            return [c async for c in cache.stream_or_fetch(("k",), fetch, len)]
+
+        for result in await asyncio.gather(read(), read(), return_exceptions=True):
+            assert isinstance(result, RuntimeError)
+        with pytest.raises(RuntimeError):
+            await read()
+
+    asyncio.run(run())
@@ -0,0 +1,152 @@
+import asyncio
+import contextvars
+from scheduler import Scheduler
+
+
+class Jobs:
+    """
+    Jobs that record when they run and wait to be released
+    """
+
+    def __init__(self) -> None:
+        self.started: list[str] = []
+        self.finished: list[str] = []
+        self.releases: dict[str, asyncio.Event] = {}
+
+    def job(self, name: str, block: bool = False):
+        release = self.releases[name] = asyncio.Event()
+        if not block:
+            release.set()
+
+        async def run() -> None:
+            self.started.append(name)
+            await release.wait()
+            self.finished.append(name)
+
+        return run
+
+
+async def settle() -> None:
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def test_jobs_of_a_key_run_in_order_one_at_a_time():
+    async def run():
+        scheduler = Scheduler(max_concurrency=4)
+        jobs = Jobs()
+        assert scheduler.submit("alice", "chat", jobs.job("a1", block=True)) == 0
+        assert scheduler.submit("alice", "chat", jobs.job("a2")) == 1
+        assert scheduler.submit("alice", "chat", jobs.job("a3")) == 2
+        await settle()
+        assert jobs.started == ["a1"]
+        jobs.releases["a1"].set()
+        await settle()
+        assert jobs.finished == ["a1", "a2", "a3"]
+        assert scheduler.stats()["completed"] == 3
+
+    asyncio.run(run())
+
+
+def test_keys_take_turns():
+    async def run():
+        scheduler = Scheduler(max_concurrency=1)
+        jobs = Jobs()
+        scheduler.submit("x", "chat", jobs.job("x1", block=True))
+        positions = [
+            scheduler.submit("a", "chat", jobs.job("a1")),
+            scheduler.submit("a", "chat", jobs.job("a2")),
+            scheduler.submit("b", "chat", jobs.job("b1")),
+            scheduler.submit("c", "chat", jobs.job("c1")),
+        ]
+        # a2 and b1 are both second in line, a2 after a's and b1 after
+        # a1's turn
+        assert positions == [1, 2, 2, 3]
+        jobs.releases["x1"].set()
+        await settle()
+        assert jobs.started == ["x1", "a1", "b1", "c1", "a2"]
+
+    asyncio.run(run())
+
+
+def test_full_queue_rejects():
+    async def run():
+        scheduler = Scheduler(max_concurrency=1, max_queue_size=2)
+        jobs = Jobs()
+        scheduler.submit("a", "chat", jobs.job("a1", block=True))
+        assert scheduler.submit("b", "chat", jobs.job("b1")) > 0
+        assert scheduler.submit("c", "chat", jobs.job("c1")) > 0
+        assert scheduler.submit("d", "chat", jobs.job("d1")) == -1
+        assert scheduler.stats()["rejected"] == 1
+        await scheduler.close()
+
+    asyncio.run(run())
+
+
+def test_backend_limits():
+    async def run():
+        scheduler = Scheduler(max_concurrency=4, backend_limits={"image": 1})
+        jobs = Jobs()
+        scheduler.submit("a", "image", jobs.job("a1", block=True))
+        scheduler.submit("b", "image", jobs.job("b1", block=True))
+        scheduler.submit("c", "chat", jobs.job("c1", block=True))
+        await settle()
+        assert jobs.started == ["a1", "c1"]
+        assert scheduler.stats()["backend_running"] == {"image": 1, "chat": 1}
+        jobs.releases["a1"].set()
+        await settle()
+        assert jobs.started == ["a1", "c1", "b1"]
+        await scheduler.close()
+
+    asyncio.run(run())
+
+
+def test_failed_job_doesnt_stop_the_queue():
+    async def run():
+        scheduler = Scheduler(max_concurrency=1)
+        jobs = Jobs()
+
+        async def fail() -> None:
+            raise RuntimeError("boom")
+
+        scheduler.submit("a", "chat", fail)
+        scheduler.submit("a", "chat", jobs.job("a2"))
+        await settle()
+        assert jobs.finished == ["a2"]
+        assert scheduler.stats()["running"] == 0
+
+    asyncio.run(run())
+
+
+def test_jobs_run_in_the_context_of_their_submitter():
+    async def run():
+        scheduler = Scheduler(max_concurrency=1)
+        user = contextvars.ContextVar("user")
+        seen = []
+
+        async def job() -> None:
+            await asyncio.sleep(0)
+            seen.append(user.get())
+
+        for name in ("alice", "bob"):
+            user.set(name)
+            scheduler.submit(name, "chat", job)
+        await settle()
+        assert seen == ["alice", "bob"]
+
+    asyncio.run(run())
+
+
+def test_close_cancels_running_and_drops_pending():
+    async def run():
+        scheduler = Scheduler(max_concurrency=1)
+        jobs = Jobs()
+        scheduler.submit("a", "chat", jobs.job("a1", block=True))
+        scheduler.submit("b", "chat", jobs.job("b1"))
+        await settle()
+        await scheduler.close()
+        assert jobs.finished == []
+        assert scheduler.stats()["queue_depth"] == 0
+        assert not scheduler.tasks
+
+    asyncio.run(run())
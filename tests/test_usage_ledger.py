@@ -0,0 +1,98 @@
+import asyncio
+import time
+import pytest
+from usage_ledger import UsageLedger, Window
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    return now
+
+
+def test_window_add_and_expire():
+    window = Window()
+    window.add(1, 10, 5, 0)
+    window.add(1, 1, 1, 1)
+    window.add(2, 20, 10, 0)
+    window.add(4, 0, 0, 2)
+    assert [entry[0] for entry in window.buckets] == [1, 2, 4]
+    assert window.tokens == 47
+    assert window.images == 3
+
+    window.expire(2)
+    assert [entry[0] for entry in window.buckets] == [2, 4]
+    assert (window.prompt_tokens, window.completion_tokens) == (20, 10)
+    assert window.images == 2
+
+    window.expire(5)
+    assert not window.buckets
+    assert (window.tokens, window.images) == (0, 0)
+
+
+def test_over_user_quota(clock):
+    ledger = UsageLedger(window=60, user_token_quota=100)
+    ledger.record("alice", "town", 60, 30)
+    assert ledger.check("alice", "town", "chat") is None
+
+    ledger.record("alice", "town", 5, 5)
+    reason = ledger.check("alice", "town", "chat")
+    assert reason.startswith("The user quota of 100 tokens per 1m")
+    # other users and images aren't limited
+    assert ledger.check("bob", "town", "chat") is None
+    assert ledger.check("alice", "town", "image") is None
+    assert ledger.stats()["rejected"] == 1
+
+    # the usage leaves the window
+    clock[0] += 61
+    assert ledger.check("alice", "town", "chat") is None
+
+
+def test_over_channel_image_quota(clock):
+    ledger = UsageLedger(window=3600, channel_image_quota=2)
+    ledger.record("alice", "town", images=1)
+    ledger.record("bob", "town", images=1)
+    reason = ledger.check("carol", "town", "image")
+    assert reason.startswith("The channel quota of 2 images per 1h")
+    assert ledger.check("carol", "village", "image") is None
+
+
+def test_charge_needs_an_account(clock):
+    ledger = UsageLedger(user_token_quota=10)
+    ledger.charge(prompt_tokens=100)
+    assert ledger.stats()["recorded_tokens"] == 0
+
+
+def test_restore_from_sqlite(clock, tmp_path):
+    db_path = str(tmp_path / "usage.db")
+    ledger = UsageLedger(window=60, user_token_quota=100, db_path=db_path)
+    ledger.record("alice", "town", 70, 40, 1)
+    asyncio.run(ledger.close())
+
+    ledger = UsageLedger(window=60, user_token_quota=100, db_path=db_path)
+    assert ledger.check("alice", "town", "chat") is not None
+    assert "You: 110/100 tokens (70 prompt, 40 completion), 1 images" in (
+        ledger.usage("alice", "town")
+    )
+    asyncio.run(ledger.close())
+
+    # buckets that left the window aren't restored
+    clock[0] += 61
+    ledger = UsageLedger(window=60, user_token_quota=100, db_path=db_path)
+    assert ledger.windows == {}
+    assert ledger.check("alice", "town", "chat") is None
+    asyncio.run(ledger.close())
+
+
+def test_flush_deletes_buckets_that_left_the_window(clock, tmp_path):
+    db_path = str(tmp_path / "usage.db")
+    ledger = UsageLedger(window=60, db_path=db_path)
+    ledger.record("alice", "town", 10, 10)
+    asyncio.run(ledger.flush())
+    clock[0] += 61
+    ledger.record("bob", "town", 5, 5)
+    asyncio.run(ledger.flush())
+    subjects = ledger.db.execute("SELECT DISTINCT subject FROM usage").fetchall()
+    assert sorted(subjects) == [("channel:town",), ("user:bob",)]
+    asyncio.run(ledger.close())